@@ -3,8 +3,6 @@ Configurations and general functions for serving models.
 """
 import os
 
-import torch
-
 
 def is_true(value):
     """Convert from string to boolean."""
@@ -25,6 +23,10 @@ MODEL_LOAD_IN_4BIT = is_true(os.getenv("MODEL_LOAD_IN_4BIT", ""))
 MODEL_LOCAL_FILES_ONLY = is_true(os.getenv("MODEL_LOCAL_FILES_ONLY", ""))
 MODEL_TRUST_REMOTE_CODE = is_true(os.getenv("MODEL_TRUST_REMOTE_CODE", ""))
 MODEL_HALF_PRECISION = is_true(os.getenv("MODEL_HALF_PRECISION", ""))
+MODEL_DRAFT = os.getenv("MODEL_DRAFT", "")
+MODEL_DRAFT_TOKENS = int(os.getenv("MODEL_DRAFT_TOKENS", "4"))
+MODEL_CHAT_TEMPLATE = os.getenv("MODEL_CHAT_TEMPLATE", "")
+MODEL_MMAP = is_true(os.getenv("MODEL_MMAP", ""))
 
 # Server-related arguments:
 # https://docs.pylonsproject.org/projects/waitress/en/stable/arguments.html
@@ -33,19 +35,60 @@ SERVER_IDENTITY = os.getenv("SERVER_IDENTITY", "basaran")
 SERVER_CONNECTION_LIMIT = int(os.getenv("SERVER_CONNECTION_LIMIT", "512"))
 SERVER_CHANNEL_TIMEOUT = int(os.getenv("SERVER_CHANNEL_TIMEOUT", "300"))
 SERVER_MODEL_NAME = os.getenv("SERVER_MODEL_NAME", "") or MODEL
+SERVER_MODELS = os.getenv("SERVER_MODELS", "")  # name=path,name=path
+SERVER_MODEL_IDLE_TIMEOUT = int(
+    os.getenv("SERVER_MODEL_IDLE_TIMEOUT", "0")
+)  # in seconds
 SERVER_NO_PLAYGROUND = is_true(os.getenv("SERVER_NO_PLAYGROUND", ""))
+SERVER_NO_METRICS = is_true(os.getenv("SERVER_NO_METRICS", ""))
 SERVER_CORS_ORIGINS = os.getenv("SERVER_CORS_ORIGINS", "*")
+SERVER_ASGI = is_true(os.getenv("SERVER_ASGI", ""))
+SERVER_STREAM_QUEUE_SIZE = int(os.getenv("SERVER_STREAM_QUEUE_SIZE", "8"))
+SERVER_TOKEN_BUDGET = int(os.getenv("SERVER_TOKEN_BUDGET", "0"))
+SERVER_MAX_QUEUE = int(os.getenv("SERVER_MAX_QUEUE", "64"))
+SERVER_HEALTH_TIMEOUT = int(os.getenv("SERVER_HEALTH_TIMEOUT", "60"))
+SERVER_PROFILE = os.getenv("SERVER_PROFILE", "")  # cprofile or torch
+SERVER_PROFILE_DIR = os.getenv("SERVER_PROFILE_DIR", "profiles")
+SERVER_PROFILE_RATE = float(os.getenv("SERVER_PROFILE_RATE", "1.0"))
 
 # Completion-related arguments:
 COMPLETION_MAX_PROMPT = int(os.getenv("COMPLETION_MAX_PROMPT", "32768"))
+COMPLETION_PREFIX_CACHE_SIZE = int(
+    os.getenv("COMPLETION_PREFIX_CACHE_SIZE", "0")
+)  # in MiB
+COMPLETION_PREFIX_CACHE_BLOCK = int(
+    os.getenv("COMPLETION_PREFIX_CACHE_BLOCK", "16")
+)
+COMPLETION_ENCODER_CACHE_SIZE = int(
+    os.getenv("COMPLETION_ENCODER_CACHE_SIZE", "0")
+)  # in MiB
+COMPLETION_TOKEN_CACHE_SIZE = int(
+    os.getenv("COMPLETION_TOKEN_CACHE_SIZE", "0")
+)  # in tokens
+COMPLETION_TOKEN_CACHE_SEGMENT = int(
+    os.getenv("COMPLETION_TOKEN_CACHE_SEGMENT", "1024")
+)  # in characters
+COMPLETION_RESULT_CACHE_SIZE = int(
+    os.getenv("COMPLETION_RESULT_CACHE_SIZE", "0")
+)  # in MiB
+COMPLETION_RESULT_CACHE_TTL = int(
+    os.getenv("COMPLETION_RESULT_CACHE_TTL", "3600")
+)  # in seconds
+COMPLETION_RESULT_CACHE_DIR = os.getenv("COMPLETION_RESULT_CACHE_DIR", "")
+COMPLETION_MAX_PROMPTS = int(os.getenv("COMPLETION_MAX_PROMPTS", "32"))
 COMPLETION_MAX_TOKENS = int(os.getenv("COMPLETION_MAX_TOKENS", "8192"))
 COMPLETION_MAX_N = int(os.getenv("COMPLETION_MAX_N", "5"))
 COMPLETION_MAX_LOGPROBS = int(os.getenv("COMPLETION_MAX_LOGPROBS", "5"))
+COMPLETION_MAX_STOP = int(os.getenv("COMPLETION_MAX_STOP", "4"))
 COMPLETION_MAX_INTERVAL = int(os.getenv("COMPLETION_MAX_INTERVAL", "50"))
+COMPLETION_MAX_BUFFER = int(os.getenv("COMPLETION_MAX_BUFFER", "4096"))
+COMPLETION_TIMEOUT = int(os.getenv("COMPLETION_TIMEOUT", "0"))  # in seconds
+
+# Engine-related arguments:
+ENGINE_CONTINUOUS_BATCHING = is_true(
+    os.getenv("ENGINE_CONTINUOUS_BATCHING", "")
+)
+ENGINE_MAX_BATCH_SIZE = int(os.getenv("ENGINE_MAX_BATCH_SIZE", "32"))
 
 # CUDA-related arguments:
 CUDA_MEMORY_FRACTION = float(os.getenv("CUDA_MEMORY_FRACTION", "1.0"))
-
-# Set memory fraction for the process if specified.
-if torch.cuda.is_available() and CUDA_MEMORY_FRACTION < 1:
-    torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION)
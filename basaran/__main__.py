@@ -1,17 +1,27 @@
 """
 Basaran API server.
 """
-import json
 import secrets
+import sys
 import time
 
 import waitress
 from flask import Flask, Response, abort, jsonify, render_template, request
 from flask_cors import CORS
+from werkzeug.exceptions import TooManyRequests
 
 from . import is_true
+from . import metrics
+from .admission import PRIORITIES, AdmissionController, QueueFull
+from .asgi import ASGIAdapter
+from .chat import ROLES
 from .choice import reduce_choice
-from .model import load_model
+from .health import check_health
+from .profiler import RequestProfiler
+from .registry import ModelRegistry
+from .results import ResultCache
+from .sse import StreamEncoder
+from .startup import Startup
 
 # Configurations from environment variables.
 from . import MODEL
@@ -24,30 +34,191 @@ from . import MODEL_LOAD_IN_4BIT
 from . import MODEL_LOCAL_FILES_ONLY
 from . import MODEL_TRUST_REMOTE_CODE
 from . import MODEL_HALF_PRECISION
+from . import MODEL_DRAFT
+from . import MODEL_DRAFT_TOKENS
+from . import MODEL_CHAT_TEMPLATE
+from . import MODEL_MMAP
 from . import SERVER_THREADS
 from . import SERVER_IDENTITY
 from . import SERVER_CONNECTION_LIMIT
 from . import SERVER_CHANNEL_TIMEOUT
 from . import SERVER_MODEL_NAME
+from . import SERVER_MODELS
+from . import SERVER_MODEL_IDLE_TIMEOUT
 from . import SERVER_NO_PLAYGROUND
+from . import SERVER_NO_METRICS
 from . import SERVER_CORS_ORIGINS
+from . import SERVER_ASGI
+from . import SERVER_STREAM_QUEUE_SIZE
+from . import SERVER_TOKEN_BUDGET
+from . import SERVER_MAX_QUEUE
+from . import SERVER_HEALTH_TIMEOUT
+from . import SERVER_PROFILE
+from . import SERVER_PROFILE_DIR
+from . import SERVER_PROFILE_RATE
 from . import COMPLETION_MAX_PROMPT
+from . import COMPLETION_PREFIX_CACHE_SIZE
+from . import COMPLETION_PREFIX_CACHE_BLOCK
+from . import COMPLETION_ENCODER_CACHE_SIZE
+from . import COMPLETION_TOKEN_CACHE_SIZE
+from . import COMPLETION_TOKEN_CACHE_SEGMENT
+from . import COMPLETION_RESULT_CACHE_SIZE
+from . import COMPLETION_RESULT_CACHE_TTL
+from . import COMPLETION_RESULT_CACHE_DIR
+from . import COMPLETION_MAX_PROMPTS
 from . import COMPLETION_MAX_TOKENS
 from . import COMPLETION_MAX_N
 from . import COMPLETION_MAX_LOGPROBS
+from . import COMPLETION_MAX_STOP
 from . import COMPLETION_MAX_INTERVAL
+from . import COMPLETION_MAX_BUFFER
+from . import COMPLETION_TIMEOUT
+from . import ENGINE_CONTINUOUS_BATCHING
+from . import ENGINE_MAX_BATCH_SIZE
+
+
+def load_served_model(name_or_path, chat_template=""):
+    """Load a model and attach the caches and engine that are enabled."""
+    from .cache import EncoderCache, PrefixCache, TokenCache, probe_layout
+    from .chat import ChatTemplate
+    from .engine import GenerationEngine
+    from .model import load_model
+
+    stream_model = load_model(
+        name_or_path=name_or_path,
+        revision=MODEL_REVISION,
+        cache_dir=MODEL_CACHE_DIR,
+        load_in_8bit=MODEL_LOAD_IN_8BIT,
+        load_in_4bit=MODEL_LOAD_IN_4BIT,
+        local_files_only=MODEL_LOCAL_FILES_ONLY,
+        trust_remote_code=MODEL_TRUST_REMOTE_CODE,
+        half_precision=MODEL_HALF_PRECISION,
+        mmap=MODEL_MMAP,
+    )
+
+    # Encode long prompts in batched segments, and reuse token IDs of
+    # repeated prompts and prompt headers if enabled.
+    stream_model.token_cache = TokenCache(
+        stream_model.tokenizer,
+        max_size=COMPLETION_TOKEN_CACHE_SIZE,
+        segment_size=COMPLETION_TOKEN_CACHE_SEGMENT,
+    )
+
+    # Compile the template for rendering chat history into prompts.
+    stream_model.chat_template = ChatTemplate.load(
+        chat_template, stream_model.tokenizer
+    )
+
+    # Reuse past key values of shared prompt prefixes if enabled.
+    if COMPLETION_PREFIX_CACHE_SIZE > 0:
+        layout = probe_layout(stream_model.model, stream_model.device)
+        if layout is not None:
+            stream_model.prefix_cache = PrefixCache(
+                layout,
+                max_size=COMPLETION_PREFIX_CACHE_SIZE * 1024 * 1024,
+                block_size=COMPLETION_PREFIX_CACHE_BLOCK,
+            )
+
+    # Reuse encoder outputs of repeated inputs to seq2seq models if enabled.
+    if (
+        COMPLETION_ENCODER_CACHE_SIZE > 0
+        and stream_model.model.config.is_encoder_decoder
+    ):
+        stream_model.encoder_cache = EncoderCache(
+            max_size=COMPLETION_ENCODER_CACHE_SIZE * 1024 * 1024
+        )
+
+    # Merge concurrent requests into shared forward passes if enabled.
+    if ENGINE_CONTINUOUS_BATCHING:
+        stream_model.engine = GenerationEngine(
+            stream_model, max_batch_size=ENGINE_MAX_BATCH_SIZE
+        )
+
+    return stream_model
+
+
+def load():
+    """Load the models to be served and register the default one."""
+
+    # Import PyTorch and Transformers only after the port is bound.
+    with startup.measure("import"):
+        from .model import load_model
+        from .speculative import Speculator
+
+    # Load the language model to be served.
+    with startup.measure("model"):
+        stream_model = load_served_model(MODEL, MODEL_CHAT_TEMPLATE)
+
+    # Verify tokens proposed by a smaller draft model if specified.
+    if MODEL_DRAFT:
+        with startup.measure("draft"):
+            draft_model = load_model(
+                name_or_path=MODEL_DRAFT,
+                revision=MODEL_REVISION,
+                cache_dir=MODEL_CACHE_DIR,
+                load_in_8bit=MODEL_LOAD_IN_8BIT,
+                load_in_4bit=MODEL_LOAD_IN_4BIT,
+                local_files_only=MODEL_LOCAL_FILES_ONLY,
+                trust_remote_code=MODEL_TRUST_REMOTE_CODE,
+                half_precision=MODEL_HALF_PRECISION,
+                mmap=MODEL_MMAP,
+            )
+            stream_model.speculator = Speculator(
+                stream_model, draft_model.model, num_tokens=MODEL_DRAFT_TOKENS
+            )
+
+    registry.register(
+        SERVER_MODEL_NAME, MODEL, model=stream_model, pinned=True
+    )
+    metrics.STARTUP_DURATION.set(time.perf_counter() - startup.started)
 
-# Load the language model to be served.
-stream_model = load_model(
-    name_or_path=MODEL,
-    revision=MODEL_REVISION,
-    cache_dir=MODEL_CACHE_DIR,
-    load_in_8bit=MODEL_LOAD_IN_8BIT,
-    load_in_4bit=MODEL_LOAD_IN_4BIT,
-    local_files_only=MODEL_LOCAL_FILES_ONLY,
-    trust_remote_code=MODEL_TRUST_REMOTE_CODE,
-    half_precision=MODEL_HALF_PRECISION,
+
+# Serve additional models under their names, loading them on first use.
+registry = ModelRegistry(
+    load_served_model, idle_timeout=SERVER_MODEL_IDLE_TIMEOUT
+)
+for item in filter(None, SERVER_MODELS.split(",")):
+    name, _, path = item.strip().partition("=")
+    registry.register(name, path or name)
+metrics.PREFIX_CACHE_BYTES.set_function(
+    lambda: sum(
+        m.prefix_cache.size for m in registry.loaded() if m.prefix_cache
+    )
 )
+metrics.ENCODER_CACHE_BYTES.set_function(
+    lambda: sum(
+        m.encoder_cache.size for m in registry.loaded() if m.encoder_cache
+    )
+)
+
+# Load the default model in the background, so that the server can accept
+# connections and report its progress in the meantime.
+startup = Startup(["import", "model"] + (["draft"] if MODEL_DRAFT else []))
+startup.start(load)
+
+# Queue requests that exceed the token budget if enabled.
+admission = None
+if SERVER_TOKEN_BUDGET > 0:
+    admission = AdmissionController(
+        SERVER_TOKEN_BUDGET, max_queue=SERVER_MAX_QUEUE
+    )
+    metrics.QUEUED_REQUESTS.set_function(lambda: len(admission.queue))
+
+# Reuse the results of deterministic completions if enabled.
+results = None
+if COMPLETION_RESULT_CACHE_SIZE > 0:
+    results = ResultCache(
+        COMPLETION_RESULT_CACHE_SIZE * 1024 * 1024,
+        ttl=COMPLETION_RESULT_CACHE_TTL,
+        directory=COMPLETION_RESULT_CACHE_DIR,
+    )
+
+# Dump traces of sampled requests if profiling is enabled.
+profiler = None
+if SERVER_PROFILE:
+    profiler = RequestProfiler(
+        SERVER_PROFILE, SERVER_PROFILE_DIR, rate=SERVER_PROFILE_RATE
+    )
 
 # Create and configure application.
 app = Flask(__name__)
@@ -88,22 +259,67 @@ def parse_options(schema):
         ):
             options[key] = dtype(payload[key])
 
-        # Temporary workaround for multiple prompts (#198).
+        # Accept arrays of prompts and prompts of token IDs.
         if (
             key == "prompt"
+            and key not in request.args
             and isinstance(payload, dict)
             and key in payload
             and isinstance(payload[key], list)
         ):
-            prompts = payload[key]
-            if len(prompts) == 1:
-                options[key] = prompts[0]
-            elif len(prompts) > 1:
-                abort(400, description="only one prompt is supported")
+            options[key] = parse_prompts(payload[key])
+
+        # Accept arrays of stop sequences.
+        if (
+            key == "stop"
+            and key not in request.args
+            and isinstance(payload, dict)
+            and isinstance(payload.get(key), list)
+        ):
+            if not all(isinstance(s, str) for s in payload[key]):
+                abort(400, description="stop must be strings")
+            options[key] = payload[key]
+
+        # Accept maps of token IDs to biases.
+        if key == "logit_bias" and key in options:
+            options[key] = parse_logit_bias(options[key])
 
     return options
 
 
+def parse_logit_bias(logit_bias):
+    """Parse a map of token IDs to biases added to their logits."""
+    parsed = {}
+    for token, bias in logit_bias.items():
+        try:
+            token = int(token)
+        except ValueError:
+            abort(400, description="logit_bias keys must be token IDs")
+        if isinstance(bias, bool) or not isinstance(bias, (int, float)):
+            abort(400, description="logit_bias values must be numbers")
+        parsed[token] = min(max(float(bias), -100.0), 100.0)
+    return parsed
+
+
+def parse_prompts(prompts):
+    """Parse an array of strings, tokens or token arrays into prompts."""
+
+    # Use custom function to exclude booleans from integers.
+    def is_tokens(value):
+        return isinstance(value, list) and all(
+            isinstance(t, int) and not isinstance(t, bool) for t in value
+        )
+
+    if not prompts:
+        return [""]
+    if is_tokens(prompts):
+        return [prompts]
+    for prompt in prompts:
+        if not isinstance(prompt, str) and not is_tokens(prompt):
+            abort(400, description="prompt must be strings or token arrays")
+    return prompts
+
+
 @app.route("/")
 def render_playground():
     """Render model playground."""
@@ -112,130 +328,455 @@ def render_playground():
     return render_template("playground.html", model=SERVER_MODEL_NAME)
 
 
+@app.route("/metrics")
+def export_metrics():
+    """Export metrics in Prometheus text format."""
+    if SERVER_NO_METRICS:
+        abort(404)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/health")
+def check_liveness():
+    """Report whether the generation loops are making progress."""
+    health = check_health(
+        registry.loaded(), admission, timeout=SERVER_HEALTH_TIMEOUT
+    )
+    return jsonify(health), 200 if health["status"] == "ok" else 503
+
+
+@app.route("/ready")
+def check_readiness():
+    """Report whether the server is loaded and can take more requests."""
+    status = startup.status()
+    health = check_health(
+        registry.loaded(), admission, timeout=SERVER_HEALTH_TIMEOUT
+    )
+    status["health"] = health
+
+    # Route traffic away while loading, stalled or saturated.
+    ready = (
+        startup.is_ready()
+        and health["status"] == "ok"
+        and not health["saturated"]
+    )
+    return jsonify(status), 200 if ready else 503
+
+
 @app.route("/v1/models")
 def list_models():
     """List the currently available models."""
-    info = {"id": SERVER_MODEL_NAME, "object": "model"}
-    return jsonify(data=[info], object="list")
+    data = [{"id": name, "object": "model"} for name in registry.names()]
+    return jsonify(data=data, object="list")
 
 
 @app.route("/v1/models/<path:name>")
 def retrieve_model(name):
     """Retrieve basic information about the model."""
-    if name != SERVER_MODEL_NAME:
+    if name not in registry.names():
         abort(404, description="model does not exist")
-    return jsonify(id=SERVER_MODEL_NAME, object="model")
+    return jsonify(id=name, object="model")
 
 
 @app.route("/v1/completions", methods=["GET", "POST"])
 def create_completion():
     """Create a completion for the provided prompt and parameters."""
     schema = {
+        "model": str,
         "prompt": str,
         "min_tokens": int,
         "max_tokens": int,
         "temperature": float,
         "top_p": float,
+        "top_k": int,
+        "frequency_penalty": float,
+        "presence_penalty": float,
+        "repetition_penalty": float,
+        "logit_bias": dict,
         "n": int,
         "stream": bool,
         "logprobs": int,
         "echo": bool,
+        "stop": str,
     }
+    metrics.REQUESTS.inc()
     options = parse_options(schema)
     if "prompt" not in options:
         options["prompt"] = ""
 
+    # Hold the requested model until the response is closed.
+    name, stream_model, release = acquire_model(options.pop("model", ""))
+    try:
+        response = prepare_completion(stream_model, name, options)
+    except BaseException:
+        release()
+        raise
+    response.call_on_close(release)
+    return response
+
+
+def prepare_completion(stream_model, name, options):
+    """Validate the options of a completion and create its response."""
+
     # Limit maximum resource usage.
-    if len(options["prompt"]) > COMPLETION_MAX_PROMPT:
+    if isinstance(options["prompt"], list):
+        prompts = options["prompt"]
+        if len(prompts) > COMPLETION_MAX_PROMPTS:
+            abort(400, description="too many prompts")
+        vocab_size = len(stream_model.tokenizer)
+        for prompt in prompts:
+            if isinstance(prompt, list) and any(
+                t < 0 or t >= vocab_size for t in prompt
+            ):
+                abort(400, description="prompt contains invalid tokens")
+        options["prompt"] = [p[:COMPLETION_MAX_PROMPT] for p in prompts]
+    elif len(options["prompt"]) > COMPLETION_MAX_PROMPT:
         options["prompt"] = options["prompt"][:COMPLETION_MAX_PROMPT]
-    if options.get("min_tokens", 0) > COMPLETION_MAX_TOKENS:
-        options["min_tokens"] = COMPLETION_MAX_TOKENS
-    if options.get("max_tokens", 0) > COMPLETION_MAX_TOKENS:
-        options["max_tokens"] = COMPLETION_MAX_TOKENS
-    if options.get("n", 0) > COMPLETION_MAX_N:
-        options["n"] = COMPLETION_MAX_N
-    if options.get("logprobs", 0) > COMPLETION_MAX_LOGPROBS:
-        options["logprobs"] = COMPLETION_MAX_LOGPROBS
+    limit_options(options, stream_model.model.config.vocab_size)
+
+    # Tokenize the prompts beforehand to count token usage.
+    if isinstance(options["prompt"], list):
+        options["prompt"] = [
+            stream_model.tokenize(p) if isinstance(p, str) else p
+            for p in options["prompt"]
+        ]
+    else:
+        options["prompt"] = stream_model.tokenize(options["prompt"])
 
     # Create response body template.
     template = {
         "id": f"cmpl-{secrets.token_hex(12)}",
         "object": "text_completion",
         "created": round(time.time()),
-        "model": SERVER_MODEL_NAME,
+        "model": name,
         "choices": [],
     }
 
     # Return in event stream or plain JSON.
     if options.pop("stream", False):
-        return create_completion_stream(options, template)
+        return create_completion_stream(stream_model, options, template)
     else:
-        return create_completion_json(options, template)
+        return create_completion_json(stream_model, options, template)
 
 
-def create_completion_stream(options, template):
-    """Return text completion results in event stream."""
+@app.route("/v1/chat/completions", methods=["POST"])
+def create_chat_completion():
+    """Create a chat completion for the provided messages and parameters."""
+    schema = {
+        "model": str,
+        "min_tokens": int,
+        "max_tokens": int,
+        "temperature": float,
+        "top_p": float,
+        "top_k": int,
+        "frequency_penalty": float,
+        "presence_penalty": float,
+        "repetition_penalty": float,
+        "logit_bias": dict,
+        "n": int,
+        "stream": bool,
+        "stop": str,
+    }
+    metrics.REQUESTS.inc()
+    options = parse_options(schema)
+    messages = parse_messages()
+
+    # Limit maximum resource usage.
+    if sum(len(m["content"]) for m in messages) > COMPLETION_MAX_PROMPT:
+        abort(400, description="messages are too long")
+
+    # Hold the requested model until the response is closed.
+    name, stream_model, release = acquire_model(options.pop("model", ""))
+    try:
+        response = prepare_chat_completion(
+            stream_model, name, options, messages
+        )
+    except BaseException:
+        release()
+        raise
+    response.call_on_close(release)
+    return response
+
+
+def prepare_chat_completion(stream_model, name, options, messages):
+    """Render the chat history of a completion and create its response."""
+    limit_options(options, stream_model.model.config.vocab_size)
+
+    # Render the chat history into the tokens of a prompt.
+    options["prompt"] = [stream_model.chat_template.tokenize(messages)]
+
+    # Create response body template.
+    stream = options.pop("stream", False)
+    template = {
+        "id": f"chatcmpl-{secrets.token_hex(12)}",
+        "object": "chat.completion.chunk" if stream else "chat.completion",
+        "created": round(time.time()),
+        "model": name,
+        "choices": [],
+    }
+
+    # Return in event stream or plain JSON.
+    if stream:
+        return create_completion_stream(
+            stream_model, options, template, chat=True
+        )
+    else:
+        return create_completion_json(
+            stream_model, options, template, convert_chat_choice
+        )
 
-    # Serialize data for event stream.
-    def serialize(data):
-        data = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
-        return f"data: {data}\n\n"
+
+def parse_messages():
+    """Parse chat messages specified in request body."""
+    payload = request.get_json(force=True, silent=True)
+    messages = payload.get("messages") if isinstance(payload, dict) else None
+    if not isinstance(messages, list) or not messages:
+        abort(400, description="messages must be a non-empty array")
+    for message in messages:
+        if (
+            not isinstance(message, dict)
+            or message.get("role") not in ROLES
+            or not isinstance(message.get("content"), str)
+        ):
+            abort(400, description="messages must have a role and a content")
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+
+def convert_chat_choice(choice):
+    """Convert a merged choice into a chat choice."""
+    return {
+        "index": choice["index"],
+        "message": {"role": "assistant", "content": choice["text"]},
+        "finish_reason": choice["finish_reason"],
+    }
+
+
+def acquire_model(name):
+    """Acquire the requested model, falling back to the default one."""
+    if not startup.is_ready():
+        abort(503, description="model is loading")
+    if name not in registry.names():
+        name = SERVER_MODEL_NAME
+    stream_model, release = registry.acquire(name)
+    return name, stream_model, release
+
+
+def limit_options(options, vocab_size):
+    """Limit maximum resource usage and set up cancellation."""
+    if options.get("min_tokens", 0) > COMPLETION_MAX_TOKENS:
+        options["min_tokens"] = COMPLETION_MAX_TOKENS
+    if options.get("max_tokens", 0) > COMPLETION_MAX_TOKENS:
+        options["max_tokens"] = COMPLETION_MAX_TOKENS
+    if options.get("n", 0) > COMPLETION_MAX_N:
+        options["n"] = COMPLETION_MAX_N
+    if options.get("logprobs", 0) > COMPLETION_MAX_LOGPROBS:
+        options["logprobs"] = COMPLETION_MAX_LOGPROBS
+
+    # Ignore empty stop sequences.
+    stop = options.pop("stop", [])
+    stop = [s for s in ([stop] if isinstance(stop, str) else stop) if s]
+    if len(stop) > COMPLETION_MAX_STOP:
+        abort(400, description="too many stop sequences")
+    if stop:
+        options["stop"] = stop
+
+    # Keep penalties within the ranges accepted by OpenAI.
+    for key in ("frequency_penalty", "presence_penalty"):
+        if key in options:
+            options[key] = min(max(options[key], -2.0), 2.0)
+    if options.get("repetition_penalty", 1.0) <= 0:
+        abort(400, description="repetition_penalty must be positive")
+
+    # Reject biases of tokens that have no logits.
+    logit_bias = options.pop("logit_bias", {})
+    if any(t < 0 or t >= vocab_size for t in logit_bias):
+        abort(400, description="logit_bias contains invalid tokens")
+    if logit_bias:
+        options["logit_bias"] = logit_bias
+
+    # Stop generating when the client disconnects or the deadline passes.
+    options["is_cancelled"] = create_cancellation()
+
+
+def create_cancellation():
+    """Create a function that checks whether a request should be aborted."""
+    disconnected = None
+    for key in ("waitress.client_disconnected", "basaran.client_disconnected"):
+        disconnected = request.environ.get(key, disconnected)
+    deadline = None
+    if COMPLETION_TIMEOUT > 0:
+        deadline = time.monotonic() + COMPLETION_TIMEOUT
+
+    def is_cancelled():
+        if disconnected is not None and disconnected():
+            return True
+        return deadline is not None and time.monotonic() > deadline
+
+    return is_cancelled
+
+
+def admit_request(options):
+    """Wait for the token budget of a request and return its release."""
+    if admission is None:
+        return lambda: None
+
+    # Estimate the footprint from the prompt and completion tokens.
+    prompts = options["prompt"]
+    if not isinstance(prompts, list):
+        prompts = [prompts]
+    completion_tokens = options.get("max_tokens", 16) * options.get("n", 1)
+    cost = sum(len(p) + completion_tokens for p in prompts)
+
+    # Take the priority class from the request header.
+    name = request.headers.get("X-Priority", "normal").lower()
+    priority = PRIORITIES.get(name, PRIORITIES["normal"])
+    try:
+        return admission.acquire(cost, priority, options.get("is_cancelled"))
+    except QueueFull as e:
+        metrics.REJECTED_REQUESTS.inc()
+        raise TooManyRequests(
+            description="too many requests", retry_after=e.retry_after
+        )
+
+
+def generate_choices(stream_model, options, template):
+    """Generate choices for a completion, profiling it if sampled."""
+    choices = stream_model(**options)
+    if profiler is not None:
+        choices = profiler.wrap(template["id"], choices)
+    return choices
+
+
+def result_key(name, options):
+    """Return the cache key of a deterministic completion, or None."""
+    if results is None or (
+        options.get("temperature", 1.0) > 0 and options.get("top_p", 1.0) > 0
+    ):
+        return None
+
+    # Prompts may be tensors of token IDs or lists of them.
+    prompts = options["prompt"]
+    if not isinstance(prompts, list):
+        prompts = [prompts]
+    prompts = [p.tolist() if hasattr(p, "tolist") else p for p in prompts]
+    params = {
+        k: v for k, v in options.items() if k not in ("prompt", "is_cancelled")
+    }
+    return results.key(name, prompts, params)
+
+
+def lookup_result(key):
+    """Find the merged choices and token count of a cached completion."""
+    if key is None:
+        return None
+    cached = results.get(key)
+    if cached is not None:
+        metrics.CACHED_COMPLETIONS.inc()
+    return cached
+
+
+def store_result(key, choices, completion_tokens, options):
+    """Cache the merged choices of a completion that was not cancelled."""
+    is_cancelled = options.get("is_cancelled")
+    if key is None or (is_cancelled is not None and is_cancelled()):
+        return
+    results.put(
+        key, {"choices": choices, "completion_tokens": completion_tokens}
+    )
+
+
+def create_completion_stream(stream_model, options, template, chat=False):
+    """Return text completion results in event stream."""
+    started = time.perf_counter()
+    key = result_key(template["model"], options)
+    cached = lookup_result(key)
+    release = admit_request(options) if cached is None else lambda: None
 
     def stream():
+        encoder = StreamEncoder(
+            template,
+            chat=chat,
+            max_interval=COMPLETION_MAX_INTERVAL,
+            max_size=COMPLETION_MAX_BUFFER,
+        )
+
+        # Replay merged choices of a cached completion.
+        if cached is not None:
+            choices = cached["choices"]
+        else:
+            choices = generate_choices(stream_model, options, template)
+
+        # Yield data when the buffer exceeds the maximum interval or size,
+        # and keep the choices if the completion is to be cached.
         buffers = {}
-        times = {}
-        for choice in stream_model(**options):
-            index = choice["index"]
-            now = time.time_ns()
-            if index not in buffers:
-                buffers[index] = []
-            if index not in times:
-                times[index] = now
-            buffers[index].append(choice)
-
-            # Yield data when exceeded the maximum buffering interval.
-            elapsed = (now - times[index]) // 1_000_000
-            if elapsed > COMPLETION_MAX_INTERVAL:
-                data = template.copy()
-                data["choices"] = [reduce_choice(buffers[index])]
-                yield serialize(data)
-                buffers[index].clear()
-                times[index] = now
-
-        # Yield remaining data in the buffers.
-        for _, buffer in buffers.items():
-            if buffer:
-                data = template.copy()
-                data["choices"] = [reduce_choice(buffer)]
-                yield serialize(data)
+        completion_tokens = 0
+        for choice in choices:
+            event = encoder.add(choice)
+            if event is not None:
+                yield event
+            if key is not None and cached is None:
+                completion_tokens += 1
+                buffers.setdefault(choice["index"], []).append(choice)
+
+        # Yield remaining data in the buffer.
+        event = encoder.flush()
+        if event is not None:
+            yield event
+
+        if key is not None and cached is None:
+            choices = [reduce_choice(b) for b in buffers.values() if b]
+            store_result(key, choices, completion_tokens, options)
 
         yield "data: [DONE]\n\n"
 
-    return Response(stream(), mimetype="text/event-stream")
+    # Record the duration and release the budget once the response is closed.
+    response = Response(stream(), mimetype="text/event-stream")
+    response.call_on_close(
+        lambda: metrics.REQUEST_DURATION.observe(time.perf_counter() - started)
+    )
+    response.call_on_close(release)
+    return response
 
 
-def create_completion_json(options, template):
+def create_completion_json(stream_model, options, template, convert=None):
     """Return text completion results in plain JSON."""
-
-    # Tokenize the prompt beforehand to count token usage.
-    options["prompt"] = stream_model.tokenize(options["prompt"])
-    prompt_tokens = options["prompt"].shape[-1]
-    completion_tokens = 0
-
-    # Add data to the corresponding buffer according to the index.
-    buffers = {}
-    for choice in stream_model(**options):
-        completion_tokens += 1
-        index = choice["index"]
-        if index not in buffers:
-            buffers[index] = []
-        buffers[index].append(choice)
-
-    # Merge choices with the same index.
+    started = time.perf_counter()
+    if isinstance(options["prompt"], list):
+        prompt_tokens = sum(len(p) for p in options["prompt"])
+    else:
+        prompt_tokens = len(options["prompt"])
+
+    # Reuse the choices of an identical deterministic completion.
+    key = result_key(template["model"], options)
+    cached = lookup_result(key)
+    if cached is not None:
+        choices = cached["choices"]
+        completion_tokens = cached["completion_tokens"]
+    else:
+        # Add data to the corresponding buffer according to the index.
+        completion_tokens = 0
+        buffers = {}
+        release = admit_request(options)
+        try:
+            for choice in generate_choices(stream_model, options, template):
+                completion_tokens += 1
+                index = choice["index"]
+                if index not in buffers:
+                    buffers[index] = []
+                buffers[index].append(choice)
+        finally:
+            release()
+
+        # Merge choices with the same index.
+        choices = [reduce_choice(b) for b in buffers.values() if b]
+        store_result(key, choices, completion_tokens, options)
+
+    # Convert the merged choices if needed.
     data = template.copy()
-    for _, buffer in buffers.items():
-        if buffer:
-            data["choices"].append(reduce_choice(buffer))
+    for choice in choices:
+        if convert is not None:
+            choice = convert(choice)
+        data["choices"].append(choice)
 
     # Include token usage info.
     data["usage"] = {
@@ -244,21 +785,54 @@ def create_completion_json(options, template):
         "total_tokens": prompt_tokens + completion_tokens,
     }
 
+    metrics.REQUEST_DURATION.observe(time.perf_counter() - started)
     return jsonify(data)
 
 
 @app.errorhandler(400)
 @app.errorhandler(404)
 @app.errorhandler(405)
+@app.errorhandler(429)
 @app.errorhandler(500)
+@app.errorhandler(503)
 def http_error_handler(error):
     """Handler function for all expected HTTP errors."""
-    return jsonify(error={"message": error.description}), error.code
+    response = jsonify(error={"message": error.description})
+    if getattr(error, "retry_after", None) is not None:
+        response.headers["Retry-After"] = str(error.retry_after)
+    return response, error.code
 
 
 def main():
     """Start serving API requests."""
     print(f"start listening on {HOST}:{PORT}")
+
+    # Exit if the models cannot be loaded, so that the server is restarted.
+    startup.fatal = True
+    if startup.error is not None:
+        sys.exit("failed to load models")
+
+    # Serve with an asyncio server if enabled.
+    if SERVER_ASGI:
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit("install basaran[asgi] to enable SERVER_ASGI")
+        uvicorn.run(
+            ASGIAdapter(
+                app,
+                threads=SERVER_THREADS,
+                queue_size=SERVER_STREAM_QUEUE_SIZE,
+            ),
+            host=HOST,
+            port=PORT,
+            limit_concurrency=SERVER_CONNECTION_LIMIT,
+            timeout_keep_alive=SERVER_CHANNEL_TIMEOUT,
+            server_header=False,
+            headers=[("server", SERVER_IDENTITY)],
+        )
+        return
+
     waitress.serve(
         app,
         host=HOST,
@@ -267,6 +841,8 @@ def main():
         ident=SERVER_IDENTITY,
         connection_limit=SERVER_CONNECTION_LIMIT,
         channel_timeout=SERVER_CHANNEL_TIMEOUT,
+        # Keep reading from channels to detect disconnected clients.
+        channel_request_lookahead=1,
     )
 
 
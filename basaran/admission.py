@@ -0,0 +1,95 @@
+"""
+Admission control of requests by their token footprint.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# Priority classes, with lower values admitted first.
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class QueueFull(Exception):
+    """QueueFull is raised when a request cannot wait for admission."""
+
+    def __init__(self, retry_after):
+        super().__init__("too many requests")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """AdmissionController limits the tokens held by concurrent requests.
+
+    Requests that do not fit into the remaining budget wait in a queue
+    ordered by priority and arrival. Requests larger than the whole budget
+    are admitted alone, so that they cannot wait forever.
+    """
+
+    def __init__(self, budget, max_queue=64):
+        super().__init__()
+        self.budget = max(budget, 1)
+        self.max_queue = max(max_queue, 0)
+        self.used = 0
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+        # Moving average of how long requests hold their tokens.
+        self.duration = 1.0
+
+    def acquire(self, cost, priority=PRIORITIES["normal"], is_cancelled=None):
+        """Wait until a request fits and return a function to release it."""
+        cost = min(max(cost, 1), self.budget)
+        with self.condition:
+            if not self.queue and self.used + cost <= self.budget:
+                self.used += cost
+                return self._release(cost)
+            if len(self.queue) >= self.max_queue:
+                raise QueueFull(self.retry_after())
+
+            # Wait for the turn of the request, checking for cancellation.
+            entry = [priority, next(self.counter), cost]
+            heapq.heappush(self.queue, entry)
+            try:
+                while (
+                    self.queue[0] is not entry
+                    or self.used + cost > self.budget
+                ):
+                    if is_cancelled is not None and is_cancelled():
+                        raise QueueFull(self.retry_after())
+                    self.condition.wait(timeout=1)
+            except BaseException:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+                raise
+            heapq.heappop(self.queue)
+            self.used += cost
+
+            # The next request in line may fit as well.
+            self.condition.notify_all()
+            return self._release(cost)
+
+    def retry_after(self):
+        """Estimate the number of seconds before retrying a request."""
+        return max(math.ceil(self.duration), 1)
+
+    def _release(self, cost):
+        """Create a function that returns the tokens of a request once."""
+        started = time.monotonic()
+        released = False
+
+        def release():
+            nonlocal released
+            with self.condition:
+                if released:
+                    return
+                released = True
+                self.used -= cost
+                elapsed = time.monotonic() - started
+                self.duration = 0.9 * self.duration + 0.1 * elapsed
+                self.condition.notify_all()
+
+        return release
@@ -0,0 +1,183 @@
+"""
+An asyncio server interface with backpressure-aware streaming.
+"""
+import asyncio
+import concurrent.futures
+import threading
+
+from werkzeug.test import EnvironBuilder
+
+# Event sent to stream clients before aborting a failed response.
+STREAM_ERROR = b'data: {"error":{"message":"failed to stream response"}}\n\n'
+
+
+class ASGIAdapter:
+    """ASGIAdapter serves a Flask application over ASGI.
+
+    Requests are dispatched to a bounded pool of worker threads. Response
+    bodies are pulled from the application one chunk at a time into a
+    bounded queue per request, so a thread is only occupied while a chunk
+    is being produced. Slow readers pause the production of their chunks,
+    and clients that disconnect have their response closed, which stops
+    the generation behind it. Responses that fail while streaming abort
+    the connection instead of ending as if they were complete.
+    """
+
+    def __init__(self, app, threads=32, queue_size=8):
+        super().__init__()
+        self.app = app
+        self.queue_size = max(queue_size, 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    async def __call__(self, scope, receive, send):
+        """Handle an ASGI connection."""
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        """Acknowledge startup and shutdown events."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        """Dispatch an HTTP request and stream the response."""
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        # Let the application check whether the client has disconnected.
+        disconnected = threading.Event()
+        disconnect = asyncio.ensure_future(
+            self._disconnect(receive, disconnected)
+        )
+        environ = self._environ(scope, b"".join(body))
+        environ["basaran.client_disconnected"] = disconnected.is_set
+        try:
+            response = await self._run(self._dispatch, environ)
+        except BaseException:
+            disconnect.cancel()
+            raise
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (k.lower().encode("latin-1"), v.encode("latin-1"))
+                    for k, v in response.headers.items()
+                ],
+            }
+        )
+
+        # Forward chunks until the response ends or the client goes away.
+        queue = asyncio.Queue(self.queue_size)
+        stop = asyncio.Event()
+        producer = asyncio.ensure_future(self._pump(response, queue, stop))
+        try:
+            while True:
+                chunk = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    {chunk, disconnect},
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not chunk.done():
+                    chunk.cancel()
+                    break
+                if chunk.result() is None:
+                    await send({"type": "http.response.body", "body": b""})
+                    break
+                if isinstance(chunk.result(), Exception):
+                    await self._abort(response, send, chunk.result())
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk.result(),
+                        "more_body": True,
+                    }
+                )
+        finally:
+            # Unblock the producer so that it can close the response.
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await producer
+            disconnect.cancel()
+
+    async def _pump(self, response, queue, stop):
+        """Pull chunks from a response while there is room in the queue."""
+        iterator = iter(response.iter_encoded())
+        try:
+            while not stop.is_set():
+                chunk = await self._run(next, iterator, None)
+                await queue.put(chunk)
+                if chunk is None:
+                    break
+        except Exception as e:
+            if not stop.is_set():
+                await queue.put(e)
+        finally:
+            await self._run(response.close)
+
+    async def _abort(self, response, send, error):
+        """Report an error to event stream clients and abort the response."""
+        if response.mimetype == "text/event-stream":
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": STREAM_ERROR,
+                    "more_body": True,
+                }
+            )
+        raise error
+
+    async def _disconnect(self, receive, disconnected):
+        """Wait until the client disconnects."""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    async def _run(self, fn, *args):
+        """Run a blocking function in the worker threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def _dispatch(self, environ):
+        """Run the application for a WSGI environment."""
+        with self.app.request_context(environ):
+            try:
+                return self.app.full_dispatch_request()
+            except Exception as e:
+                return self.app.handle_exception(e)
+
+    def _environ(self, scope, body):
+        """Build a WSGI environment from an ASGI scope."""
+        client = scope.get("client") or ("", 0)
+        builder = EnvironBuilder(
+            path=scope.get("root_path", "") + scope["path"],
+            method=scope["method"],
+            query_string=scope.get("query_string", b"").decode("latin-1"),
+            headers=[
+                (k.decode("latin-1"), v.decode("latin-1"))
+                for k, v in scope.get("headers", [])
+            ],
+            data=body,
+            environ_base={"REMOTE_ADDR": client[0]},
+        )
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
@@ -0,0 +1,214 @@
+"""
+A load generator for measuring the serving performance.
+"""
+import concurrent.futures
+import json
+import os
+import random
+import time
+import urllib.request
+
+# Words used to build prompts of a given length.
+WORDS = ("once", "upon", "a", "time", "hello", "world", "the", "quick", "fox")
+
+
+def percentile(values, q):
+    """Compute the q-th percentile of values using linear interpolation."""
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    weight = position - lower
+    return values[lower] * (1 - weight) + values[upper] * weight
+
+
+def summarize(values):
+    """Summarize a distribution of values."""
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values),
+    }
+
+
+def load_app(model):
+    """Load the API server application in-process for a model."""
+    import basaran
+
+    # Override the configuration before the server module reads it.
+    basaran.MODEL = model
+    if not os.getenv("SERVER_MODEL_NAME"):
+        basaran.SERVER_MODEL_NAME = model
+    from basaran.__main__ import app, startup
+
+    # Wait for the model that is loaded in the background.
+    startup.wait()
+    return app
+
+
+class AppClient:
+    """AppClient sends requests to an in-process application."""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def post(self, path, payload):
+        """Send a request and iterate over the chunks of the response."""
+        client = self.app.test_client()
+        response = client.post(path, json=payload, buffered=False)
+        try:
+            if response.status_code != 200:
+                raise RuntimeError(f"unexpected status {response.status}")
+            yield from response.iter_encoded()
+        finally:
+            response.close()
+
+
+class HTTPClient:
+    """HTTPClient sends requests to a server over HTTP."""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url.rstrip("/")
+
+    def post(self, path, payload):
+        """Send a request and iterate over the lines of the response."""
+        request = urllib.request.Request(
+            self.url + path,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                yield line
+
+
+class Benchmark:
+    """Benchmark sends concurrent completion requests and measures them."""
+
+    def __init__(
+        self,
+        client,
+        requests=32,
+        concurrency=4,
+        prompt_lengths=(8, 32, 128),
+        max_tokens=16,
+        n=1,
+        logprobs=0,
+        stream=True,
+        seed=0,
+    ):
+        super().__init__()
+        self.client = client
+        self.requests = max(requests, 1)
+        self.concurrency = max(concurrency, 1)
+        self.prompt_lengths = list(prompt_lengths)
+        self.max_tokens = max(max_tokens, 1)
+        self.n = max(n, 1)
+        self.logprobs = max(logprobs, 0)
+        self.stream = stream
+        self.random = random.Random(seed)
+
+    def payload(self):
+        """Create the payload of a request with a random prompt length."""
+        length = self.random.choice(self.prompt_lengths)
+        prompt = " ".join(self.random.choice(WORDS) for _ in range(length))
+
+        # Forbid early stops so that every choice has the same length.
+        return {
+            "prompt": prompt,
+            "min_tokens": self.max_tokens,
+            "max_tokens": self.max_tokens,
+            "n": self.n,
+            "logprobs": self.logprobs,
+            "stream": self.stream,
+        }
+
+    def send(self, payload):
+        """Send a request and measure its latencies."""
+        start = time.perf_counter()
+        times = []
+        body = b""
+        for chunk in self.client.post("/v1/completions", payload):
+            now = time.perf_counter()
+            body += chunk
+
+            # Record the arrival time of each event in the stream.
+            if self.stream:
+                *lines, body = body.split(b"\n")
+                for line in lines:
+                    if line.startswith(b"data: {"):
+                        times.append(now)
+        end = time.perf_counter()
+
+        # Count tokens from the usage info of non-streaming responses.
+        tokens = self.n * self.max_tokens
+        if not self.stream:
+            tokens = json.loads(body)["usage"]["completion_tokens"]
+
+        result = {"latency": end - start, "tokens": tokens}
+        if times:
+            result["time_to_first_token"] = times[0] - start
+            if self.max_tokens > 1:
+                result["inter_token_latency"] = (times[-1] - times[0]) / (
+                    self.max_tokens - 1
+                )
+        return result
+
+    def run(self):
+        """Run the benchmark and return a report."""
+        payloads = [self.payload() for _ in range(self.requests)]
+
+        results = []
+        errors = []
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+            futures = [pool.submit(self.send, p) for p in payloads]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+        duration = time.perf_counter() - start
+
+        tokens = sum(r["tokens"] for r in results)
+        return {
+            "config": {
+                "requests": self.requests,
+                "concurrency": self.concurrency,
+                "prompt_lengths": self.prompt_lengths,
+                "max_tokens": self.max_tokens,
+                "n": self.n,
+                "logprobs": self.logprobs,
+                "stream": self.stream,
+            },
+            "completed": len(results),
+            "errors": errors,
+            "duration": duration,
+            "completion_tokens": tokens,
+            "requests_per_second": len(results) / duration,
+            "tokens_per_second": tokens / duration,
+            "latency": summarize([r["latency"] for r in results]),
+            "time_to_first_token": summarize(
+                [
+                    r["time_to_first_token"]
+                    for r in results
+                    if "time_to_first_token" in r
+                ]
+            ),
+            "inter_token_latency": summarize(
+                [
+                    r["inter_token_latency"]
+                    for r in results
+                    if "inter_token_latency" in r
+                ]
+            ),
+        }
@@ -0,0 +1,76 @@
+"""
+Run a load benchmark and print the report as JSON.
+"""
+import argparse
+import json
+
+from . import AppClient, Benchmark, HTTPClient, load_app
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(prog="python -m basaran.bench")
+    parser.add_argument(
+        "--url",
+        help="URL of a running server, or run in-process if not specified",
+    )
+    parser.add_argument(
+        "--model",
+        default="./tests/data/tiny-random-bloom",
+        help="model to load when running in-process",
+    )
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--prompt-lengths",
+        default="8,32,128",
+        help="comma-separated prompt lengths in words to sample from",
+    )
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--n", type=int, default=1)
+    parser.add_argument("--logprobs", type=int, default=0)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        help="number of requests to send before measuring",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the report to")
+    return parser.parse_args()
+
+
+def main():
+    """Run a load benchmark."""
+    args = parse_args()
+    if args.url:
+        client = HTTPClient(args.url)
+    else:
+        client = AppClient(load_app(args.model))
+
+    options = {
+        "concurrency": args.concurrency,
+        "prompt_lengths": [int(x) for x in args.prompt_lengths.split(",")],
+        "max_tokens": args.max_tokens,
+        "n": args.n,
+        "logprobs": args.logprobs,
+        "stream": not args.no_stream,
+        "seed": args.seed,
+    }
+
+    # Warm up the model before measuring.
+    if args.warmup > 0:
+        Benchmark(client, requests=args.warmup, **options).run()
+
+    report = Benchmark(client, requests=args.requests, **options).run()
+    report["target"] = args.url or args.model
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data + "\n")
+    print(data)
+
+
+if __name__ == "__main__":
+    main()
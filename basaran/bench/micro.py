@@ -0,0 +1,179 @@
+"""
+Micro-benchmarks of the functions that run per token per sequence.
+"""
+import argparse
+import json
+import time
+
+from ..choice import map_choice, reduce_choice
+from ..model import load_model
+from ..sse import StreamEncoder, serialize
+from ..stop import StopMatcher
+from ..tokenizer import StreamTokenizer
+
+
+def measure(fn, number=100, repeat=5):
+    """Measure the time per call of a function in seconds."""
+    timings = []
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        for _ in range(max(number, 1)):
+            fn()
+        timings.append((time.perf_counter() - start) / max(number, 1))
+    return {
+        "mean": sum(timings) / len(timings),
+        "min": min(timings),
+        "calls_per_second": 1 / min(timings),
+    }
+
+
+def benchmark_decode(model, number, repeat):
+    """Benchmark decoding a token with a stream tokenizer."""
+    tokens = model.tokenize("once upon a time, hello world " * 8).tolist()
+    detokenizer = StreamTokenizer(model.tokenizer)
+    position = 0
+
+    def decode():
+        nonlocal detokenizer, position
+        if position == len(tokens):
+            detokenizer = StreamTokenizer(model.tokenizer)
+            position = 0
+        detokenizer.decode(tokens[position])
+        position += 1
+
+    return measure(decode, number, repeat)
+
+
+def benchmark_sample(model, number, repeat):
+    """Benchmark sampling log probabilities of the most likely tokens."""
+    top_tokens = list(range(5))
+    top_logprobs = [-0.5, -1.0, -1.5, -2.0, -2.5]
+    return measure(
+        lambda: model._sample(7, -0.75, top_tokens, top_logprobs),
+        number,
+        repeat,
+    )
+
+
+def benchmark_map_choice(model, number, repeat):
+    """Benchmark creating a choice object with log probabilities."""
+    samples = model._sample(7, -0.75, list(range(5)), [-0.5] * 5)
+    return measure(
+        lambda: map_choice(" hello", 0, text_offset=42, **samples),
+        number,
+        repeat,
+    )
+
+
+def benchmark_reduce_choice(model, number, repeat):
+    """Benchmark merging the choices buffered for one event."""
+    samples = model._sample(7, -0.75, list(range(5)), [-0.5] * 5)
+    choices = [
+        map_choice(" hello", 0, text_offset=i, **samples) for i in range(16)
+    ]
+    return measure(lambda: reduce_choice(choices), number, repeat)
+
+
+def benchmark_serialize(model, number, repeat):
+    """Benchmark serializing an event with a merged choice."""
+    samples = model._sample(7, -0.75, list(range(5)), [-0.5] * 5)
+    choices = [
+        map_choice(" hello", 0, text_offset=i, **samples) for i in range(16)
+    ]
+    data = {
+        "id": "cmpl-0",
+        "object": "text_completion",
+        "created": 0,
+        "model": "model",
+        "choices": [reduce_choice(choices)],
+    }
+    return measure(lambda: serialize(data), number, repeat)
+
+
+def benchmark_encode(model, number, repeat):
+    """Benchmark buffering a choice into a stream encoder."""
+    samples = model._sample(7, -0.75, list(range(5)), [-0.5] * 5)
+    choice = map_choice(" hello", 0, text_offset=42, **samples)
+    template = {
+        "id": "cmpl-0",
+        "object": "text_completion",
+        "created": 0,
+        "model": "model",
+        "choices": [],
+    }
+    encoder = StreamEncoder(template, max_interval=60_000, max_size=4096)
+    return measure(lambda: encoder.add(choice), number, repeat)
+
+
+def benchmark_stop(model, number, repeat):
+    """Benchmark scanning the text of a token for stop sequences."""
+    scanner = StopMatcher(["\n\n", "###", "</s>", "Human:"]).scanner()
+    return measure(lambda: scanner.feed(" hello"), number, repeat)
+
+
+def benchmark_step(model, number, repeat):
+    """Benchmark one decoding step of a batch of sequences."""
+    input_ids = model.tokenize("once upon a time")[None, :].expand(2, -1)
+    timings = []
+    for _ in range(max(repeat, 1)):
+        steps = model.generate(
+            input_ids,
+            logprobs=5,
+            min_new_tokens=number + 1,
+            max_new_tokens=number + 1,
+            temperature=1.0,
+            top_p=0.9,
+            top_k=0,
+        )
+
+        # Exclude the prefill step from the measurement.
+        next(steps)
+        timings.append(measure(lambda: next(steps), number, 1)["min"])
+        steps.close()
+    return {
+        "mean": sum(timings) / len(timings),
+        "min": min(timings),
+        "calls_per_second": 1 / min(timings),
+    }
+
+
+BENCHMARKS = {
+    "stream_tokenizer.decode": benchmark_decode,
+    "stream_model._sample": benchmark_sample,
+    "map_choice": benchmark_map_choice,
+    "reduce_choice": benchmark_reduce_choice,
+    "serialize": benchmark_serialize,
+    "stream_encoder.add": benchmark_encode,
+    "stop_scanner.feed": benchmark_stop,
+    "stream_model.generate.step": benchmark_step,
+}
+
+
+def run(model, number=100, repeat=5, names=None):
+    """Run micro-benchmarks and return the time per call of each."""
+    if isinstance(model, str):
+        model = load_model(model)
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        results[name] = benchmark(model, number, repeat)
+    return results
+
+
+def main():
+    """Run micro-benchmarks and print the results as JSON."""
+    parser = argparse.ArgumentParser(prog="python -m basaran.bench.micro")
+    parser.add_argument("--model", default="./tests/data/tiny-random-bloom")
+    parser.add_argument("--number", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "names", nargs="*", help="benchmarks to run, or all if not specified"
+    )
+    args = parser.parse_args()
+    results = run(args.model, args.number, args.repeat, args.names)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+Caches for reusing computation across requests.
+"""
+import collections
+import threading
+
+import torch
+
+from .tokenizer import is_concatenable
+
+
+def probe_layout(model, device):
+    """Find the sequence dimension of each tensor in the model cache."""
+    input_ids = torch.zeros((1, 2), dtype=torch.long, device=device)
+
+    # Models with custom cache structures are not supported.
+    try:
+        # Compare the caches of two inputs with different lengths.
+        caches = []
+        for length in (1, 2):
+            with torch.inference_mode():
+                outputs = model(
+                    input_ids=input_ids[:, :length],
+                    use_cache=True,
+                    return_dict=True,
+                )
+            caches.append(outputs.get("past_key_values"))
+
+        layout = []
+        for short, long in zip(*caches):
+            dims = []
+            for a, b in zip(short, long):
+                changed = [
+                    d for d in range(a.dim()) if a.shape[d] != b.shape[d]
+                ]
+                if len(changed) != 1 or changed[0] == 0:
+                    return None
+                dims.append(changed[0])
+            layout.append(dims)
+    except Exception:
+        return None
+
+    return layout or None
+
+
+def map_cache(caches, layout, fn):
+    """Apply a function to the corresponding tensors of one or more caches."""
+    layers = []
+    for i, layer in enumerate(zip(*caches)):
+        tensors = []
+        for j, items in enumerate(zip(*layer)):
+            tensors.append(fn(list(items), layout[i][j]))
+        layers.append(tuple(tensors))
+    return tuple(layers)
+
+
+def expand_cache(cache, batch_size):
+    """Share a cache of a single sequence with a batch of sequences."""
+    layers = []
+    for layer in cache:
+        if not isinstance(layer, (tuple, list)):
+            raise TypeError("cache must be a sequence of tensor tuples")
+        tensors = []
+        for tensor in layer:
+            if not isinstance(tensor, torch.Tensor):
+                raise TypeError("cache must be a sequence of tensor tuples")
+
+            # Use copy-on-write views unless heads are folded into batches.
+            if tensor.shape[0] == 1:
+                tensor = tensor.expand(batch_size, *tensor.shape[1:])
+            else:
+                tensor = tensor.repeat(batch_size, *[1] * (tensor.dim() - 1))
+            tensors.append(tensor)
+        layers.append(tuple(tensors))
+    return tuple(layers)
+
+
+def select_cache(cache, rows, batch_size):
+    """Keep the given rows of a cache of a batch of sequences."""
+    layers = []
+    for layer in cache:
+        if not isinstance(layer, (tuple, list)):
+            raise TypeError("cache must be a sequence of tensor tuples")
+        tensors = []
+        for tensor in layer:
+            if not isinstance(tensor, torch.Tensor):
+                raise TypeError("cache must be a sequence of tensor tuples")
+
+            # Some models fold attention heads into the batch dimension.
+            stride = tensor.shape[0] // batch_size
+            offsets = torch.arange(stride, device=tensor.device)
+            index = rows.to(tensor.device)[:, None] * stride + offsets
+            tensors.append(tensor.index_select(0, index.flatten()))
+        layers.append(tuple(tensors))
+    return tuple(layers)
+
+
+def cache_size(cache):
+    """Count the number of bytes used by a cache."""
+    if isinstance(cache, torch.Tensor):
+        return cache.numel() * cache.element_size()
+    if isinstance(cache, (tuple, list)):
+        return sum(cache_size(c) for c in cache)
+    return 0
+
+
+class PrefixCache:
+    """PrefixCache stores past key values of previously seen prompts."""
+
+    def __init__(self, layout, max_size, block_size=16):
+        super().__init__()
+        self.layout = layout
+        self.max_size = max_size
+        self.block_size = max(block_size, 1)
+        self.entries = collections.OrderedDict()
+        self.blocks = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, input_ids, batch_size=1):
+        """Find past key values for the longest cached prefix of a prompt."""
+        tokens = input_ids.tolist()
+
+        # Leave at least one token to compute the logits of the next token.
+        hashes = self._hashes(tokens[:-1])
+        with self.lock:
+            for length, block in reversed(hashes):
+                key = self.blocks.get(block)
+                if key is None or key[:length] != tuple(tokens[:length]):
+                    continue
+                self.entries.move_to_end(key)
+                cache, _ = self.entries[key]
+                break
+            else:
+                return 0, None
+
+        # Narrow the cache to the matched prefix.
+        def narrow(tensors, dim):
+            (tensor,) = tensors
+            return tensor.narrow(dim, 0, length)
+
+        cache = map_cache([cache], self.layout, narrow)
+        return length, expand_cache(cache, batch_size)
+
+    def put(self, input_ids, cache, batch_size=1):
+        """Store past key values of the block-aligned prefix of a prompt."""
+        tokens = input_ids.tolist()
+        hashes = self._hashes(tokens)
+        if not hashes:
+            return
+        key = tuple(tokens[: hashes[-1][0]])
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+
+        # Copy the first sequence so that the batch can be released.
+        def copy(tensors, dim):
+            (tensor,) = tensors
+            stride = tensor.shape[0] // batch_size
+            tensor = tensor.narrow(0, 0, stride)
+            return tensor.narrow(dim, 0, len(key)).clone()
+
+        cache = map_cache([cache], self.layout, copy)
+        size = cache_size(cache)
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (cache, size)
+            self.size += size
+            for _, block in hashes:
+                self.blocks[block] = key
+
+            # Evict least recently used prompts until within budget.
+            while self.size > self.max_size:
+                evicted, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+                for _, block in self._hashes(evicted):
+                    if self.blocks.get(block) == evicted:
+                        del self.blocks[block]
+
+    def _hashes(self, tokens):
+        """Hash each block-aligned prefix by chaining the block hashes."""
+        hashes = []
+        block = None
+        size = self.block_size
+        for length in range(size, len(tokens) + 1, size):
+            block = hash((block, tuple(tokens[length - size : length])))
+            hashes.append((length, block))
+        return hashes
+
+
+class EncoderCache:
+    """EncoderCache stores encoder outputs of previously seen inputs."""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Find the encoder hidden states of an input."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, hidden_states):
+        """Store the encoder hidden states of an input."""
+        size = cache_size(hidden_states)
+        if size > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (hidden_states, size)
+            self.size += size
+
+            # Evict least recently used inputs until within budget.
+            while self.size > self.max_size:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+
+
+class TokenCache:
+    """TokenCache stores token IDs of previously seen texts.
+
+    Long texts are split into line-aligned segments, which are cached on
+    their own so that texts sharing long headers only need to encode the
+    rest. Segments that miss the cache are encoded in a single batch,
+    which fast tokenizers process in parallel without holding the GIL.
+    A maximum size of zero only disables caching, not the batching.
+    """
+
+    def __init__(self, tokenizer, max_size, segment_size=1024):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.segment_size = max(segment_size, 0)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # Segments can only be joined if boundaries are left unchanged.
+        if self.segment_size > 0 and not is_concatenable(tokenizer):
+            self.segment_size = 0
+
+    def encode(self, text):
+        """Encode a text into a list of token IDs."""
+        tokens = self._get((text, True))
+        if tokens is not None:
+            return list(tokens)
+
+        # Look up each segment, only the first of which has special tokens.
+        keys = [(s, i == 0) for i, s in enumerate(self._split(text))]
+        results = [self._get(k) for k in keys]
+        for special in (True, False):
+            misses = [
+                i
+                for i, (key, result) in enumerate(zip(keys, results))
+                if result is None and key[1] == special
+            ]
+            if not misses:
+                continue
+            batch = self.tokenizer(
+                [keys[i][0] for i in misses], add_special_tokens=special
+            )
+            for i, ids in zip(misses, batch["input_ids"]):
+                results[i] = tuple(ids)
+                self._put(keys[i], results[i])
+
+        tokens = [t for result in results for t in result]
+        if len(keys) > 1:
+            self._put((text, True), tuple(tokens))
+        return tokens
+
+    def _split(self, text):
+        """Split a text after line breaks into segments of a minimum size."""
+        segments = []
+        start = 0
+        while self.segment_size > 0 and len(text) - start > self.segment_size:
+            # Split before non-whitespace to keep whitespace runs intact.
+            end = start + self.segment_size
+            while True:
+                end = text.find("\n", end) + 1
+                if end == 0 or (end < len(text) and not text[end].isspace()):
+                    break
+            if end == 0:
+                break
+            segments.append(text[start:end])
+            start = end
+        segments.append(text[start:])
+        return segments
+
+    def _get(self, key):
+        """Find the token IDs of a text."""
+        with self.lock:
+            tokens = self.entries.get(key)
+            if tokens is not None:
+                self.entries.move_to_end(key)
+            return tokens
+
+    def _put(self, key, tokens):
+        """Store the token IDs of a text."""
+        if self.max_size <= 0 or len(tokens) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = tokens
+            self.size += len(tokens)
+
+            # Evict least recently used texts until within budget.
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
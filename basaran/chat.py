@@ -0,0 +1,92 @@
+"""
+Prompt rendering for chat completions.
+"""
+import os
+
+import jinja2
+
+from .tokenizer import is_concatenable
+
+# Roles accepted in chat messages.
+ROLES = ("system", "user", "assistant")
+
+# Template used if the model does not specify one.
+DEFAULT_TEMPLATE = os.path.join(
+    os.path.dirname(__file__), "templates", "default.chat.jinja"
+)
+
+
+def split_point(text, start, end):
+    """Find the last line break in a range that tokens can be split after.
+
+    Line breaks followed by more whitespace are skipped, since tokenizers
+    may merge consecutive whitespace into one token. The start is returned
+    if no such line break is found.
+    """
+    index = text.rfind("\n", start, end - 1)
+    while index >= start:
+        if not text[index + 1].isspace():
+            return index + 1
+        index = text.rfind("\n", start, index)
+    return start
+
+
+class ChatTemplate:
+    """ChatTemplate renders chat history into the tokens of a prompt.
+
+    The history is split at the line breaks after which rendering one more
+    message only appends text, and each segment is tokenized separately.
+    Tokens of earlier turns thus stay the same as the conversation grows,
+    so their past key values can be reused from the prefix cache.
+    """
+
+    def __init__(self, source, tokenizer):
+        super().__init__()
+        self.template = jinja2.Template(source)
+        self.tokenizer = tokenizer
+
+        # Segments can only be tokenized separately if the tokenizer does
+        # not alter the text at their boundaries, e.g. by adding spaces.
+        self.incremental = is_concatenable(tokenizer)
+
+    @classmethod
+    def load(cls, path, tokenizer):
+        """Load and compile a template from a file."""
+        with open(path or DEFAULT_TEMPLATE, encoding="utf-8") as f:
+            return cls(f.read(), tokenizer)
+
+    def render(self, messages):
+        """Render chat history into a prompt."""
+        return self.template.render(messages=messages)
+
+    def segments(self, messages):
+        """Split the prompt of chat history into appended segments."""
+        segments = []
+        offset = 0
+        previous = None
+        for i in range(1, len(messages) + 1):
+            text = self.render(messages[:i])
+            if previous is not None:
+                common = len(os.path.commonprefix([previous, text]))
+
+                # Only split at line breaks, where tokens are not merged.
+                common = split_point(text, offset, common)
+                if common > offset:
+                    segments.append(text[offset:common])
+                    offset = common
+            previous = text
+        if previous is not None and len(previous) > offset:
+            segments.append(previous[offset:])
+        return segments
+
+    def tokenize(self, messages):
+        """Render and tokenize chat history into a list of token IDs."""
+        segments = self.segments(messages) if self.incremental else []
+        if len(segments) < 2:
+            return self.tokenizer.encode(self.render(messages))
+        tokens = []
+        for i, segment in enumerate(segments):
+            tokens += self.tokenizer.encode(
+                segment, add_special_tokens=i == 0
+            )
+        return tokens
@@ -0,0 +1,462 @@
+"""
+A generation engine with continuous batching.
+"""
+import collections
+import queue
+import threading
+import time
+
+import torch
+
+from . import metrics
+from .cache import cache_size, map_cache, probe_layout
+from .sampler import Sampler
+
+
+class Request:
+    """Request holds the decoding state of the sequences of one call."""
+
+    def __init__(self, input_ids, logprobs, is_cancelled, stopped, kwargs):
+        super().__init__()
+        self.input_ids = input_ids
+        self.logprobs = logprobs
+        self.is_cancelled = is_cancelled
+        self.stopped = stopped
+        self.kwargs = kwargs
+        self.outputs = queue.Queue()
+        self.cancelled = False
+        self.created = time.perf_counter()
+
+        # Decoding state initialized by the engine upon admission.
+        self.config = None
+        self.sampler = None
+        self.unfinished = None
+        self.rows = None
+        self.input_length = 0
+        self.length = 0
+
+    @property
+    def size(self):
+        """Number of sequences in the request."""
+        return self.input_ids.shape[0]
+
+    @property
+    def done(self):
+        """Whether the request no longer needs any decoding steps."""
+        return self.cancelled or self.unfinished is None
+
+
+class Batch:
+    """Batch holds the sequences that share a single forward pass."""
+
+    def __init__(
+        self,
+        request,
+        input_ids,
+        kwargs,
+        mergeable,
+        prompt=None,
+        attention_mask=None,
+    ):
+        super().__init__()
+        self.requests = [request]
+        self.input_ids = input_ids
+        self.kwargs = kwargs
+        self.mergeable = mergeable
+        self.prompt = prompt
+        self.prefilled = False
+        self.sampler = request.sampler
+
+        # Attention masks are only needed for left-padded batches.
+        self.attention_mask = attention_mask
+        if mergeable and attention_mask is None:
+            self.attention_mask = torch.ones_like(input_ids)
+
+    @property
+    def size(self):
+        """Number of sequences in the batch."""
+        return self.input_ids.shape[0]
+
+    @property
+    def cached(self):
+        """Whether the prompts have already been processed."""
+        return self.kwargs.get("past_key_values") is not None
+
+
+class GenerationEngine:
+    """GenerationEngine owns a model and batches concurrent requests."""
+
+    def __init__(self, stream_model, max_batch_size=32):
+        super().__init__()
+        self.stream_model = stream_model
+        self.max_batch_size = max(max_batch_size, 1)
+        self.pending = collections.deque()
+        self.batches = []
+        self.layout = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # Sequences and cache bytes currently reported to the gauges.
+        self.active = 0
+        self.cache_bytes = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def generate(
+        self,
+        input_ids,
+        logprobs=0,
+        is_cancelled=None,
+        stopped=None,
+        **kwargs,
+    ):
+        """Submit sequences to the engine and stream predicted tokens."""
+        request = Request(input_ids, logprobs, is_cancelled, stopped, kwargs)
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+
+        # Stop decoding the sequences once the consumer goes away.
+        try:
+            while True:
+                outputs = request.outputs.get()
+                if isinstance(outputs, Exception):
+                    raise outputs
+                yield outputs
+                if outputs[-1].max() <= 0:
+                    break
+        finally:
+            request.cancelled = True
+
+    def stats(self):
+        """Return the number of pending requests and the longest wait."""
+        with self.condition:
+            pending = len(self.pending)
+            created = self.pending[0].created if self.pending else None
+        waited = 0 if created is None else time.perf_counter() - created
+        return pending, waited
+
+    def close(self):
+        """Stop the engine once all submitted sequences are finished."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _run(self):
+        """Keep admitting, decoding and evicting sequences."""
+        model = self.stream_model.model
+        if not model.config.is_encoder_decoder:
+            self.layout = probe_layout(model, self.stream_model.device)
+
+        while True:
+            with self.condition:
+                while not self.pending and not self.batches:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                requests = self._admit()
+
+            # Create a new batch for each admitted request.
+            for request in requests:
+                try:
+                    self.batches.append(self._prepare(request))
+                except Exception as e:
+                    request.outputs.put(e)
+
+            # Run one decoding step for every batch.
+            for batch in self.batches:
+                try:
+                    self._step(batch)
+                except Exception as e:
+                    for request in batch.requests:
+                        request.outputs.put(e)
+                        request.unfinished = None
+
+            # Evict finished sequences and merge the remaining ones.
+            self.batches = [b for b in map(self._evict, self.batches) if b]
+            self._merge()
+            self._report()
+
+    def _admit(self):
+        """Pop pending requests that fit into the current batch size."""
+        requests = []
+        size = sum(b.size for b in self.batches)
+        while self.pending:
+            request = self.pending[0]
+            if request.cancelled:
+                self.pending.popleft()
+                continue
+            if size > 0 and size + request.size > self.max_batch_size:
+                break
+            requests.append(self.pending.popleft())
+            size += request.size
+            metrics.QUEUE_TIME.observe(time.perf_counter() - request.created)
+        return requests
+
+    def _report(self):
+        """Update the gauges of active sequences and cache memory."""
+        active = sum(b.size for b in self.batches)
+        cache_bytes = sum(
+            cache_size(b.kwargs.get("past_key_values")) for b in self.batches
+        )
+        metrics.ACTIVE_SEQUENCES.inc(active - self.active)
+        metrics.KV_CACHE_BYTES.inc(cache_bytes - self.cache_bytes)
+        self.active = active
+        self.cache_bytes = cache_bytes
+
+    def _prepare(self, request):
+        """Initialize the decoding state of a newly admitted request."""
+        stream_model = self.stream_model
+        config, kwargs = stream_model._generation_config(**request.kwargs)
+        input_ids, kwargs = stream_model._prepare_inputs(
+            request.input_ids, config, kwargs
+        )
+
+        request.config = config
+        request.input_length = input_ids.shape[-1]
+        request.length = request.input_length
+        request.sampler = Sampler.from_config(
+            config,
+            input_ids,
+            stream_model.model.config.vocab_size,
+            kwargs.get("attention_mask"),
+        )
+        request.unfinished = input_ids.new_ones(request.size)
+        request.rows = torch.arange(request.size, device=input_ids.device)
+
+        # Attention masks of decoder-only models are extended every step.
+        attention_mask = None
+        if not stream_model.model.config.is_encoder_decoder:
+            attention_mask = kwargs.pop("attention_mask", None)
+
+        # Sequences sharing the same prompt only need to process it once.
+        prompt = stream_model._shared_prompt(input_ids, kwargs)
+
+        # Reuse past key values of a previously seen prompt prefix.
+        kwargs = stream_model._reuse_prefix(prompt, input_ids, kwargs)
+
+        # Only plain decoder-only requests can share a batch with others.
+        mergeable = (
+            self.layout is not None
+            and config.use_cache
+            and config.pad_token_id is not None
+            and set(kwargs) - {"past_key_values"} == {
+                "output_attentions",
+                "output_hidden_states",
+                "use_cache",
+            }
+        )
+
+        return Batch(
+            request, input_ids, kwargs, mergeable, prompt, attention_mask
+        )
+
+    def _step(self, batch):
+        """Run a forward pass and sample the next tokens for a batch."""
+        stream_model = self.stream_model
+        started = time.perf_counter()
+        kwargs = batch.kwargs
+        if batch.attention_mask is not None:
+            kwargs = {**kwargs, "attention_mask": batch.attention_mask}
+        logits, past_key_values = stream_model._forward(
+            batch.input_ids, kwargs, shared=batch.prompt is not None
+        )
+
+        # Sample all sequences at once with their own parameters.
+        logprobs = max(r.logprobs for r in batch.requests)
+        outputs = stream_model._next_tokens(logits, batch.sampler, logprobs)
+
+        # Split the predictions between the requests.
+        start = 0
+        results = []
+        for request in batch.requests:
+            width = request.rows.shape[0]
+            rows = slice(start, start + width)
+            start += width
+            config = request.config
+            tokens, token_logprobs, top_tokens, top_logprobs = (
+                output[rows] for output in outputs
+            )
+            top_tokens = top_tokens[:, : request.logprobs]
+            top_logprobs = top_logprobs[:, : request.logprobs]
+
+            # Place the predictions of the remaining rows in the request.
+            if width < request.size:
+                (
+                    tokens,
+                    token_logprobs,
+                    top_tokens,
+                    top_logprobs,
+                ) = stream_model._spread(
+                    request.rows,
+                    request.size,
+                    tokens,
+                    token_logprobs,
+                    top_tokens,
+                    top_logprobs,
+                )
+
+            # Finished sequences should have their next token be a padding.
+            unfinished = stream_model._stopped(
+                request.unfinished, request.stopped
+            )
+            if config.pad_token_id is not None:
+                padding = config.pad_token_id * (1 - unfinished)
+                tokens = tokens * unfinished + padding
+
+            # Mark sequences with eos tokens as finished.
+            request.unfinished = stream_model._unfinished(
+                tokens, unfinished, config
+            )
+            request.length += 1
+
+            # Set status to -1 if exceeded the max length, or to -2 if
+            # cancelled.
+            status = request.unfinished.clone()
+            if request.length - request.input_length >= config.max_new_tokens:
+                status = 0 - status
+            elif request.is_cancelled is not None and request.is_cancelled():
+                status = -2 * status
+
+            results.append(tokens[request.rows])
+            request.outputs.put(
+                (tokens, token_logprobs, top_tokens, top_logprobs, status)
+            )
+            if status.max() <= 0:
+                request.unfinished = None
+
+        # Record the duration of the step after tokens have been synced.
+        elapsed = time.perf_counter() - started
+        metrics.observe_step(elapsed, batch.size, not batch.prefilled)
+        batch.prefilled = True
+
+        # Append selected tokens to the inputs.
+        tokens = torch.cat(results)
+        batch.input_ids = torch.cat([batch.input_ids, tokens[:, None]], dim=-1)
+        if batch.attention_mask is not None:
+            mask = batch.attention_mask
+            ones = mask.new_ones((mask.shape[0], 1))
+            batch.attention_mask = torch.cat([mask, ones], dim=-1)
+
+        # Keep past key values for the next step.
+        if past_key_values is not None:
+            batch.kwargs["past_key_values"] = past_key_values
+
+        # Store past key values of the prompt for later requests.
+        if batch.prompt is not None:
+            stream_model._cache_prefix(
+                batch.prompt, past_key_values, batch.size
+            )
+            batch.prompt = None
+
+    def _evict(self, batch):
+        """Remove finished sequences from a batch."""
+        requests = [r for r in batch.requests if not r.done]
+        if not requests:
+            return None
+
+        # Select the rows of the remaining sequences. Finished sequences of
+        # unfinished requests are only removed from mergeable batches.
+        rows = []
+        start = 0
+        for request in batch.requests:
+            width = request.rows.shape[0]
+            if not request.done:
+                kept = list(range(width))
+                if batch.mergeable:
+                    unfinished = request.unfinished[request.rows].tolist()
+                    kept = [i for i in kept if unfinished[i]]
+                    request.rows = request.rows[kept]
+                rows += [start + i for i in kept]
+            start += width
+        if len(rows) == batch.size:
+            return batch
+        rows = torch.tensor(rows, device=batch.input_ids.device)
+        batch.requests = requests
+        self._select(batch, rows)
+
+        # Drop leading columns that are padding for every sequence.
+        padding = batch.attention_mask.bool().any(dim=0).long()
+        columns = padding.argmax().item()
+        if columns > 0:
+            self._trim(batch, columns)
+
+        return batch
+
+    def _merge(self):
+        """Merge all batches that have been prefilled into a single batch."""
+        batches = [b for b in self.batches if b.mergeable and b.cached]
+        if len(batches) < 2:
+            return
+
+        # Left-pad all sequences to the same length.
+        length = max(b.input_ids.shape[-1] for b in batches)
+        for batch in batches:
+            self._pad(batch, length - batch.input_ids.shape[-1])
+
+        # Concatenate inputs and caches along the batch dimension.
+        merged = batches[0]
+        merged.requests = [r for b in batches for r in b.requests]
+        merged.input_ids = torch.cat([b.input_ids for b in batches])
+        merged.attention_mask = torch.cat([b.attention_mask for b in batches])
+        merged.sampler = Sampler.cat([b.sampler for b in batches])
+        merged.kwargs["past_key_values"] = map_cache(
+            [b.kwargs["past_key_values"] for b in batches],
+            self.layout,
+            lambda tensors, _: torch.cat(tensors),
+        )
+        self.batches = [b for b in self.batches if b not in batches[1:]]
+
+    def _pad(self, batch, columns):
+        """Insert padding columns to the left of a batch."""
+        if columns <= 0:
+            return
+        pad_token_id = batch.requests[0].config.pad_token_id
+        batch.input_ids = torch.nn.functional.pad(
+            batch.input_ids, (columns, 0), value=pad_token_id
+        )
+        batch.attention_mask = torch.nn.functional.pad(
+            batch.attention_mask, (columns, 0), value=0
+        )
+
+        def pad(tensors, dim):
+            (tensor,) = tensors
+            padding = [0, 0] * (tensor.dim() - dim - 1) + [columns, 0]
+            return torch.nn.functional.pad(tensor, padding)
+
+        batch.kwargs["past_key_values"] = map_cache(
+            [batch.kwargs["past_key_values"]], self.layout, pad
+        )
+
+    def _trim(self, batch, columns):
+        """Remove columns from the left of a batch."""
+        batch.input_ids = batch.input_ids[:, columns:]
+        batch.attention_mask = batch.attention_mask[:, columns:]
+
+        def trim(tensors, dim):
+            (tensor,) = tensors
+            return tensor.narrow(dim, columns, tensor.shape[dim] - columns)
+
+        batch.kwargs["past_key_values"] = map_cache(
+            [batch.kwargs["past_key_values"]], self.layout, trim
+        )
+
+    def _select(self, batch, rows):
+        """Keep only the given rows of a batch."""
+        size = batch.size
+        batch.input_ids = batch.input_ids[rows]
+        batch.attention_mask = batch.attention_mask[rows]
+        batch.sampler = batch.sampler.take(rows)
+
+        # Some models fold attention heads into the batch dimension.
+        def select(tensors, _):
+            (tensor,) = tensors
+            stride = tensor.shape[0] // size
+            offsets = torch.arange(stride, device=rows.device)
+            index = (rows[:, None] * stride + offsets).flatten()
+            return tensor.index_select(0, index.to(tensor.device))
+
+        batch.kwargs["past_key_values"] = map_cache(
+            [batch.kwargs["past_key_values"]], self.layout, select
+        )
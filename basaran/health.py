@@ -0,0 +1,78 @@
+"""
+Liveness and saturation reports of the generation loops.
+"""
+import sys
+import time
+
+from . import metrics
+
+
+def memory_info():
+    """Return the free and total bytes of memory used for inference."""
+
+    # Only query CUDA devices if PyTorch has already been imported.
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        free = total = 0
+        for i in range(torch.cuda.device_count()):
+            device_free, device_total = torch.cuda.mem_get_info(i)
+            free += device_free
+            total += device_total
+        return {"device": "cuda", "free_bytes": free, "total_bytes": total}
+
+    # Fall back to the memory of the system on Linux.
+    info = {}
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    if "MemAvailable" not in info or "MemTotal" not in info:
+        return None
+    return {
+        "device": "cpu",
+        "free_bytes": info["MemAvailable"],
+        "total_bytes": info["MemTotal"],
+    }
+
+
+def check_health(models, admission=None, timeout=60):
+    """Check whether the generation loops are making progress.
+
+    The loops are considered stalled if sequences are being generated but
+    no decoding step has finished within the timeout, or if a request has
+    waited longer than the timeout to enter a batching engine.
+    """
+    now = time.time()
+    active = metrics.ACTIVE_SEQUENCES.value
+    idle = now - metrics.LAST_PROGRESS.value if active > 0 else 0
+
+    # Collect the requests waiting in the batching engines.
+    pending = 0
+    waited = 0
+    for model in models:
+        if model.engine is not None:
+            count, seconds = model.engine.stats()
+            pending += count
+            waited = max(waited, seconds)
+
+    # Collect the requests waiting for admission.
+    queued = 0
+    saturated = False
+    if admission is not None:
+        queued = len(admission.queue)
+        saturated = queued >= admission.max_queue
+
+    stalled = timeout > 0 and (idle > timeout or waited > timeout)
+    return {
+        "status": "stalled" if stalled else "ok",
+        "saturated": saturated,
+        "active_sequences": active,
+        "queued_requests": queued,
+        "pending_requests": pending,
+        "last_step_seconds": metrics.LAST_STEP_TIME.value,
+        "seconds_since_progress": round(idle, 3),
+        "memory": memory_info(),
+    }
@@ -0,0 +1,293 @@
+"""
+Metrics of request and generation phases in Prometheus format.
+"""
+import bisect
+import threading
+import time
+
+# Metrics are rendered in the order of registration.
+registry = []
+
+# Latency buckets in seconds.
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+TOKEN_LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def format_value(value):
+    """Format a sample value for the text exposition format."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """Metric is the base class of all metric types."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        """Render the metric in the text exposition format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+    def samples(self):
+        """Return the samples of the metric."""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Counter is a monotonically increasing value."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.value = 0
+
+    def inc(self, value=1):
+        """Increase the counter."""
+        with self.lock:
+            self.value += value
+
+    def samples(self):
+        return [("", "", self.value)]
+
+
+class Gauge(Metric):
+    """Gauge is a value that can go up and down."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.value = 0
+        self.function = None
+
+    def inc(self, value=1):
+        """Increase the gauge."""
+        with self.lock:
+            self.value += value
+
+    def dec(self, value=1):
+        """Decrease the gauge."""
+        with self.lock:
+            self.value -= value
+
+    def set(self, value):
+        """Set the gauge to a value."""
+        with self.lock:
+            self.value = value
+
+    def set_function(self, function):
+        """Read the value from a function at collection time."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [("", "", self.function())]
+        return [("", "", self.value)]
+
+
+class Histogram(Metric):
+    """Histogram counts observations in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """Record an observation."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        count = 0
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            count += n
+            samples.append(("_bucket", f'{{le="{bound}"}}', count))
+        samples.append(("_sum", "", total))
+        samples.append(("_count", "", count))
+        return samples
+
+
+def render():
+    """Render all registered metrics in the text exposition format."""
+    return "\n".join(m.render() for m in registry) + "\n"
+
+
+STARTUP_DURATION = Gauge(
+    "basaran_startup_seconds",
+    "Time from starting the server until the default model is loaded.",
+)
+REQUESTS = Counter(
+    "basaran_requests_total",
+    "Number of completion requests received.",
+)
+CACHED_COMPLETIONS = Counter(
+    "basaran_cached_completions_total",
+    "Number of completion requests served from the result cache.",
+)
+REJECTED_REQUESTS = Counter(
+    "basaran_rejected_requests_total",
+    "Number of completion requests rejected by admission control.",
+)
+QUEUED_REQUESTS = Gauge(
+    "basaran_queued_requests",
+    "Number of completion requests waiting for admission.",
+)
+REQUEST_DURATION = Histogram(
+    "basaran_request_duration_seconds",
+    "Time from receiving a completion request until its response ends.",
+)
+PROMPT_TOKENS = Counter(
+    "basaran_prompt_tokens_total",
+    "Number of prompt tokens processed.",
+)
+GENERATED_TOKENS = Counter(
+    "basaran_generated_tokens_total",
+    "Number of tokens generated, whose rate is the throughput.",
+)
+CANCELLED_SEQUENCES = Counter(
+    "basaran_cancelled_sequences_total",
+    "Number of sequences cancelled by disconnects or deadlines.",
+)
+QUEUE_TIME = Histogram(
+    "basaran_queue_seconds",
+    "Time sequences wait for admission into the batching engine.",
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "basaran_time_to_first_token_seconds",
+    "Time from starting a completion until its first tokens are generated.",
+)
+INTER_TOKEN_LATENCY = Histogram(
+    "basaran_inter_token_seconds",
+    "Time between consecutive tokens of a completion.",
+    buckets=TOKEN_LATENCY_BUCKETS,
+)
+PREFILL_TIME = Histogram(
+    "basaran_prefill_seconds",
+    "Duration of decoding steps that process prompts.",
+)
+DECODE_TIME = Histogram(
+    "basaran_decode_seconds",
+    "Duration of decoding steps that extend cached sequences.",
+    buckets=TOKEN_LATENCY_BUCKETS,
+)
+BATCH_SIZE = Histogram(
+    "basaran_batch_size",
+    "Number of sequences in each decoding step.",
+    buckets=BATCH_SIZE_BUCKETS,
+)
+ACTIVE_SEQUENCES = Gauge(
+    "basaran_active_sequences",
+    "Number of sequences being generated.",
+)
+KV_CACHE_BYTES = Gauge(
+    "basaran_kv_cache_bytes",
+    "Bytes of past key values held by sequences being generated.",
+)
+PREFIX_CACHE_BYTES = Gauge(
+    "basaran_prefix_cache_bytes",
+    "Bytes of past key values held by the prefix cache.",
+)
+ENCODER_CACHE_BYTES = Gauge(
+    "basaran_encoder_cache_bytes",
+    "Bytes of encoder outputs held by the encoder cache.",
+)
+LAST_STEP_TIME = Gauge(
+    "basaran_last_step_seconds",
+    "Duration of the latest decoding step.",
+)
+LAST_PROGRESS = Gauge(
+    "basaran_last_progress_timestamp_seconds",
+    "Unix time of the latest decoding step or started sequences.",
+)
+
+
+def observe_step(elapsed, batch_size, prefill):
+    """Record a decoding step of a batch of sequences."""
+    if prefill:
+        PREFILL_TIME.observe(elapsed)
+    else:
+        DECODE_TIME.observe(elapsed)
+    BATCH_SIZE.observe(batch_size)
+    LAST_STEP_TIME.set(elapsed)
+    LAST_PROGRESS.set(time.time())
+
+
+class Tracker:
+    """Tracker records the decoding steps of a batch of sequences."""
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self.prefilled = False
+        self.cache_bytes = 0
+        ACTIVE_SEQUENCES.inc(batch_size)
+        LAST_PROGRESS.set(time.time())
+
+    def step(self, start, cache_bytes=None):
+        """Record a decoding step that started at the given time."""
+        elapsed = time.perf_counter() - start
+        observe_step(elapsed, self.batch_size, not self.prefilled)
+        self.prefilled = True
+
+        # Track memory used by the cache of the sequences.
+        if cache_bytes is not None:
+            KV_CACHE_BYTES.inc(cache_bytes - self.cache_bytes)
+            self.cache_bytes = cache_bytes
+
+    def close(self):
+        """Release the sequences from the gauges."""
+        ACTIVE_SEQUENCES.dec(self.batch_size)
+        KV_CACHE_BYTES.dec(self.cache_bytes)
+        self.batch_size = 0
+        self.cache_bytes = 0
@@ -2,21 +2,32 @@
 A text generation model with stream decoding.
 """
 import copy
+import math
+import time
 
 import torch
 from transformers import (
     AutoModelForCausalLM,
     AutoModelForSeq2SeqLM,
     AutoTokenizer,
-    LogitsProcessorList,
-    MinNewTokensLengthLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopPLogitsWarper,
 )
+from transformers.modeling_outputs import BaseModelOutput
 
+from . import CUDA_MEMORY_FRACTION
+from . import metrics
+from .cache import cache_size, expand_cache, select_cache
 from .choice import map_choice
+from .sampler import Sampler
+from .stop import StopMatcher
 from .tokenizer import StreamTokenizer
 
+# Keep log probabilities of masked tokens finite for serialization.
+MIN_LOGPROB = math.log(1e-7)
+
+# Set memory fraction for the process if specified.
+if torch.cuda.is_available() and CUDA_MEMORY_FRACTION < 1:
+    torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION)
+
 
 class StreamModel:
     """StreamModel wraps around a language model to provide stream decoding."""
@@ -31,6 +42,17 @@ class StreamModel:
         else:
             self.device = "cpu"
         self.model = model.to(self.device)
+        self.engine = None
+        self.encoder_cache = None
+        self.prefix_cache = None
+        self.speculator = None
+        self.token_cache = None
+        self.chat_template = None
+
+        # Decode every token once to avoid decoding samples per step.
+        self.token_strings = tokenizer.batch_decode(
+            [[i] for i in range(len(tokenizer))]
+        )
 
     def __call__(
         self,
@@ -39,18 +61,33 @@ class StreamModel:
         max_tokens=16,
         temperature=1.0,
         top_p=1.0,
+        top_k=0,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+        repetition_penalty=1.0,
+        logit_bias=None,
         n=1,
         logprobs=0,
         echo=False,
+        stop=None,
         **kwargs,
     ):
-        """Create a completion stream for the provided prompt."""
-        if isinstance(prompt, str):
-            input_ids = self.tokenize(prompt)
-        elif isinstance(prompt, torch.Tensor) and prompt.dim() == 1:
-            input_ids = prompt
-        else:
-            raise TypeError("prompt must be a string or a 1-d tensor")
+        """Create a completion stream for the provided prompt(s)."""
+        started = time.perf_counter()
+        prompts = list(prompt) if isinstance(prompt, list) else [prompt]
+        for i, prompt in enumerate(prompts):
+            if isinstance(prompt, str):
+                prompts[i] = self.tokenize(prompt)
+            elif isinstance(prompt, list):
+                prompts[i] = torch.tensor(
+                    prompt, dtype=torch.long, device=self.device
+                )
+            elif not isinstance(prompt, torch.Tensor) or prompt.dim() != 1:
+                raise TypeError(
+                    "prompt must be a string, a 1-d tensor or a list of them"
+                )
+        if not prompts:
+            prompts = [self.tokenize("")]
 
         # Ensure arguments are non-negative.
         min_tokens = max(min_tokens, 0)
@@ -58,22 +95,43 @@ class StreamModel:
         n = max(n, 1)
         logprobs = max(logprobs, 0)
 
+        # Sequences are laid out as n consecutive choices per prompt.
+        size = len(prompts) * n
+        metrics.PROMPT_TOKENS.inc(sum(p.shape[-1] for p in prompts))
+
         # Keep track of the finish reason of each sequence.
-        finish_reasons = [None] * n
+        finish_reasons = [None] * size
 
         # Create stateful detokenizer for each sequence.
         detokenizers = []
-        for i in range(n):
+        for i in range(size):
             detokenizers.append(StreamTokenizer(self.tokenizer))
 
+        # Scan the text of each sequence for stop sequences if specified.
+        if isinstance(stop, str):
+            stop = [stop]
+        scanners = None
+        stopped = None
+        if stop:
+            matcher = StopMatcher(stop)
+            scanners = [matcher.scanner() for _ in range(size)]
+
+            # Flag sequences that hit a stop sequence to stop decoding them.
+            stopped = [False] * size
+
         # Echo prompt tokens if required.
-        for token in input_ids:
-            samples = self._sample(token, 0, [], []) if logprobs > 0 else {}
-            for i in range(n):
-                text = detokenizers[i].decode(token)
-                offset = detokenizers[i].start
-                if echo:
-                    yield map_choice(text, i, text_offset=offset, **samples)
+        for p, input_ids in enumerate(prompts):
+            for token in input_ids.tolist():
+                samples = {}
+                if logprobs > 0:
+                    samples = self._sample(token, 0, [], [])
+                for i in range(p * n, (p + 1) * n):
+                    text = detokenizers[i].decode(token)
+                    offset = detokenizers[i].start
+                    if echo:
+                        yield map_choice(
+                            text, i, text_offset=offset, **samples
+                        )
 
         generate_kwargs = {
             **dict(
@@ -82,45 +140,101 @@ class StreamModel:
                 max_new_tokens=max_tokens,
                 temperature=temperature,
                 top_p=top_p,
+                top_k=top_k,
+                frequency_penalty=frequency_penalty,
+                presence_penalty=presence_penalty,
+                repetition_penalty=repetition_penalty,
+                logit_bias=logit_bias,
+                stopped=stopped,
             ),
             **kwargs,
         }
 
+        # Left-pad multiple prompts into a single batch.
+        if len(prompts) == 1:
+            input_ids = prompts[0][None, :].expand(n, -1)
+        else:
+            input_ids, attention_mask = self._pad_prompts(prompts)
+            input_ids = input_ids.repeat_interleave(n, dim=0)
+            attention_mask = attention_mask.repeat_interleave(n, dim=0)
+            generate_kwargs["attention_mask"] = attention_mask
+
+        # Dispatch generation to the batching engine if one is attached.
+        generate = self.generate
+        if self.engine is not None:
+            generate = self.engine.generate
+
         # Generate completion tokens.
+        last = None
+        steps = generate(input_ids, **generate_kwargs)
         for (
             tokens,
             token_logprobs,
             top_tokens,
             top_logprobs,
             status,
-        ) in self.generate(
-            input_ids[None, :].repeat(n, 1),
-            **generate_kwargs,
-        ):
-            for i in range(n):
+        ) in steps:
+            # Move predictions to the host in a single transfer. Token IDs
+            # are small enough to be represented exactly as floats.
+            k = top_tokens.shape[-1]
+            outputs = torch.cat(
+                [
+                    tokens[:, None].float(),
+                    status[:, None].float(),
+                    token_logprobs[:, None].float(),
+                    top_tokens.float(),
+                    top_logprobs.float(),
+                ],
+                dim=1,
+            ).tolist()
+
+            # Record the latency of the first and subsequent tokens.
+            now = time.perf_counter()
+            if last is None:
+                metrics.TIME_TO_FIRST_TOKEN.observe(now - started)
+            else:
+                metrics.INTER_TOKEN_LATENCY.observe(now - last)
+            last = now
+            metrics.GENERATED_TOKENS.inc(finish_reasons.count(None))
+
+            for i, row in enumerate(outputs):
+                token = int(row[0])
+
                 # Check and update the finish status of the sequence.
                 if finish_reasons[i]:
                     continue
-                if status[i] == 0:
+                if row[1] == 0:
                     finish_reasons[i] = "stop"
-                elif status[i] == -1:
+                elif row[1] == -1:
                     finish_reasons[i] = "length"
+                elif row[1] == -2:
+                    finish_reasons[i] = "cancelled"
+                    metrics.CANCELLED_SEQUENCES.inc()
 
                 # Collect samples of the most likely tokens if required.
                 samples = (
                     self._sample(
-                        token=tokens[i],
-                        token_logprob=token_logprobs[i],
-                        top_tokens=top_tokens[i],
-                        top_logprobs=top_logprobs[i],
+                        token=token,
+                        token_logprob=row[2],
+                        top_tokens=[int(t) for t in row[3 : 3 + k]],
+                        top_logprobs=row[3 + k :],
                     )
                     if logprobs > 0
                     else {}
                 )
 
-                # Yield predicted tokens.
-                text = detokenizers[i].decode(tokens[i])
+                # Hold back text that may be part of a stop sequence.
+                text = detokenizers[i].decode(token)
                 offset = detokenizers[i].start
+                if scanners is not None:
+                    text, matched = scanners[i].feed(text)
+                    if matched:
+                        finish_reasons[i] = "stop"
+                        stopped[i] = True
+                    elif finish_reasons[i]:
+                        text += scanners[i].flush()
+
+                # Yield predicted tokens.
                 yield map_choice(
                     text,
                     i,
@@ -129,10 +243,41 @@ class StreamModel:
                     **samples,
                 )
 
+            # Stop generating once every sequence has been stopped.
+            if all(finish_reasons):
+                steps.close()
+                break
+
+    def _pad_prompts(self, prompts):
+        """Left-pad prompts of different lengths into a batch."""
+        config = self.model.generation_config
+        eos_token_id = config.eos_token_id
+        if isinstance(eos_token_id, list):
+            eos_token_id = eos_token_id[0]
+        pad_token_id = config.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id if eos_token_id is not None else 0
+
+        # Generate from eos for empty prompts, as for a single prompt.
+        prompts = list(prompts)
+        for i, p in enumerate(prompts):
+            if p.shape[-1] == 0 and eos_token_id is not None:
+                prompts[i] = p.new_tensor([eos_token_id]).long()
+
+        length = max(p.shape[-1] for p in prompts)
+        input_ids = prompts[0].new_full((len(prompts), length), pad_token_id)
+        attention_mask = prompts[0].new_zeros((len(prompts), length))
+        for i, p in enumerate(prompts):
+            if p.shape[-1] > 0:
+                input_ids[i, -p.shape[-1] :] = p
+                attention_mask[i, -p.shape[-1] :] = 1
+
+        return input_ids, attention_mask
+
     def _sample(self, token, token_logprob, top_tokens, top_logprobs):
         """Sample log probabilities of the most likely tokens."""
-        token = self.tokenizer.decode(token)
-        top_tokens = self.tokenizer.batch_decode(top_tokens)
+        token = self._token_string(token)
+        top_tokens = [self._token_string(t) for t in top_tokens]
 
         # Do not use tensor operations as arguments may be of list type.
         token_logprob = round(float(token_logprob), 8)
@@ -148,166 +293,487 @@ class StreamModel:
             "top_logprobs": top_logprobs,
         }
 
-    def _logits_processor(self, config, input_length):
-        """Set up logits processor based on the generation config."""
-        processor = LogitsProcessorList()
-
-        # Add processor for enforcing a min-length of new tokens.
-        if (
-            config.min_new_tokens is not None
-            and config.min_new_tokens > 0
-            and config.eos_token_id is not None
-        ):
-            processor.append(
-                MinNewTokensLengthLogitsProcessor(
-                    prompt_length_to_skip=input_length,
-                    min_new_tokens=config.min_new_tokens,
-                    eos_token_id=config.eos_token_id,
-                )
-            )
-
-        # Add processor for scaling output probability distribution.
-        if (
-            config.temperature is not None
-            and config.temperature > 0
-            and config.temperature != 1.0
-        ):
-            processor.append(TemperatureLogitsWarper(config.temperature))
+    def _token_string(self, token):
+        """Look up the decoded string of a token ID."""
+        if 0 <= token < len(self.token_strings):
+            return self.token_strings[token]
+        return self.tokenizer.decode(token)
 
-        # Add processor for nucleus sampling.
-        if config.top_p is not None and config.top_p > 0 and config.top_p < 1:
-            processor.append(TopPLogitsWarper(config.top_p))
-
-        return processor
+    def close(self):
+        """Stop the engine of the model so that it can be unloaded."""
+        if self.engine is not None:
+            self.engine.close()
+            self.engine = None
 
     def tokenize(self, text):
         """Tokenize a string into a tensor of token IDs."""
+        if self.token_cache is not None:
+            tokens = self.token_cache.encode(text)
+            return torch.tensor(tokens, dtype=torch.long, device=self.device)
         batch = self.tokenizer.encode(text, return_tensors="pt")
         return batch[0].to(self.device)
 
-    def generate(self, input_ids, logprobs=0, **kwargs):
-        """Generate a stream of predicted tokens using the language model."""
+    def generate(
+        self,
+        input_ids,
+        logprobs=0,
+        is_cancelled=None,
+        stopped=None,
+        **kwargs,
+    ):
+        """Generate a stream of predicted tokens using the language model.
+
+        Sequences whose flags in the optional list of stopped sequences are
+        set by the consumer are finished and no longer decoded.
+        """
 
-        # Store the original batch size and input length.
+        # Store the original batch size.
         batch_size = input_ids.shape[0]
-        input_length = input_ids.shape[-1]
 
         # Separate model arguments from generation config.
+        config, kwargs = self._generation_config(**kwargs)
+
+        # Prepare inputs for decoder-only or encoder-decoder models.
+        input_ids, kwargs = self._prepare_inputs(input_ids, config, kwargs)
+
+        # Set up the sampling parameters of each sequence.
+        sampler = Sampler.from_config(
+            config,
+            input_ids,
+            self.model.config.vocab_size,
+            kwargs.get("attention_mask"),
+        )
+
+        # Record metrics of the decoding steps until the stream is closed.
+        tracker = metrics.Tracker(batch_size)
+        try:
+            # Propose and verify several tokens per step with a draft model,
+            # unless penalties depend on the tokens that are not yet verified.
+            if (
+                self.speculator is not None
+                and self.speculator.supports(kwargs)
+                and not sampler.penalized
+            ):
+                yield from self.speculator.generate(
+                    input_ids,
+                    config,
+                    sampler,
+                    logprobs,
+                    is_cancelled,
+                    stopped,
+                    tracker,
+                )
+                return
+
+            # Sequences sharing the same prompt only need to process it once.
+            prompt = self._shared_prompt(input_ids, kwargs)
+
+            # Reuse past key values of a previously seen prompt prefix.
+            kwargs = self._reuse_prefix(prompt, input_ids, kwargs)
+
+            # Start auto-regressive generation.
+            yield from self._decode(
+                input_ids,
+                kwargs,
+                config,
+                sampler,
+                logprobs,
+                is_cancelled,
+                stopped,
+                prompt,
+                tracker,
+            )
+        finally:
+            tracker.close()
+
+    def _decode(
+        self,
+        input_ids,
+        kwargs,
+        config,
+        sampler,
+        logprobs,
+        is_cancelled,
+        stopped,
+        prompt,
+        tracker,
+    ):
+        """Run decoding steps until all sequences are finished."""
+        batch_size = input_ids.shape[0]
+        input_length = input_ids.shape[-1]
+
+        # Keep track of which sequences are already finished, and of the
+        # rows of the sequences that are still in the batch.
+        unfinished = input_ids.new_ones(batch_size)
+        rows = None
+
+        # Preallocate buffers to write selected tokens in place and to
+        # attend to them by slicing the attention mask.
+        buffer = self._allocate(input_ids, config.max_new_tokens)
+        mask = self._allocate_attention_mask(kwargs, buffer.shape[-1])
+        position = input_length
+
+        while True:
+            start = time.perf_counter()
+            logits, past_key_values = self._forward(
+                input_ids, kwargs, shared=prompt is not None
+            )
+
+            # Select the next tokens and collect their log probabilities.
+            (
+                tokens,
+                token_logprobs,
+                top_tokens,
+                top_logprobs,
+            ) = self._next_tokens(logits, sampler, logprobs)
+
+            # Place the predictions of the remaining rows in the batch.
+            if rows is not None:
+                (
+                    tokens,
+                    token_logprobs,
+                    top_tokens,
+                    top_logprobs,
+                ) = self._spread(
+                    rows,
+                    batch_size,
+                    tokens,
+                    token_logprobs,
+                    top_tokens,
+                    top_logprobs,
+                )
+
+            # Finished sequences should have their next token be a padding.
+            if config.pad_token_id is not None:
+                padding = config.pad_token_id * (1 - unfinished)
+                tokens = tokens * unfinished + padding
+
+            # Append selected tokens to the inputs.
+            if position == buffer.shape[-1]:
+                buffer = torch.cat([buffer, torch.zeros_like(buffer)], dim=-1)
+                if mask is not None:
+                    mask = torch.cat([mask, torch.ones_like(mask)], dim=-1)
+            buffer[:, position] = tokens if rows is None else tokens[rows]
+            position += 1
+            input_ids = buffer[:, :position]
+            if mask is not None:
+                kwargs["attention_mask"] = mask[:, :position]
+
+            # Keep past key values for the next step.
+            if past_key_values is not None:
+                kwargs["past_key_values"] = past_key_values
+
+            # Store past key values of the prompt for later requests.
+            if prompt is not None:
+                self._cache_prefix(prompt, past_key_values, batch_size)
+                prompt = None
+
+            # Mark sequences with eos tokens as finished.
+            unfinished = self._unfinished(tokens, unfinished, config)
+
+            # Set status to -1 if exceeded the max length, or to -2 if
+            # cancelled.
+            status = unfinished.clone()
+            if input_ids.shape[-1] - input_length >= config.max_new_tokens:
+                status = 0 - status
+            elif is_cancelled is not None and is_cancelled():
+                status = -2 * status
+            finished = bool(status.max() <= 0)
+            tracker.step(start, cache_size(past_key_values))
+
+            # Yield predictions and status.
+            yield tokens, token_logprobs, top_tokens, top_logprobs, status
+
+            # Stop when finished or exceeded the max length.
+            if finished:
+                break
+
+            # Drop the rows of finished sequences from the batch.
+            unfinished = self._stopped(unfinished, stopped)
+            remaining = unfinished.nonzero()[:, 0]
+            if remaining.shape[0] == 0:
+                break
+            if remaining.shape[0] == input_ids.shape[0]:
+                continue
+            index = remaining
+            if rows is not None:
+                index = torch.searchsorted(rows, remaining)
+            try:
+                kwargs = self._select_rows(kwargs, index, input_ids.shape[0])
+            except TypeError:
+                continue
+            rows = remaining
+            sampler = sampler.take(index)
+            buffer = buffer[index]
+            input_ids = buffer[:, :position]
+            if mask is not None:
+                mask = mask[index]
+                kwargs["attention_mask"] = mask[:, :position]
+
+    def _spread(self, rows, batch_size, *outputs):
+        """Place the outputs of the given rows in a batch of zeros."""
+        spread = []
+        for output in outputs:
+            tensor = output.new_zeros((batch_size, *output.shape[1:]))
+            tensor[rows] = output
+            spread.append(tensor)
+        return spread
+
+    def _select_rows(self, kwargs, rows, batch_size):
+        """Keep the given rows of the model arguments of a batch."""
+        kwargs = kwargs.copy()
+        for key, value in kwargs.items():
+            if key == "past_key_values" and value is not None:
+                kwargs[key] = select_cache(value, rows, batch_size)
+            elif key == "encoder_outputs":
+                hidden_states = value.last_hidden_state[rows]
+                kwargs[key] = BaseModelOutput(last_hidden_state=hidden_states)
+            elif isinstance(value, torch.Tensor):
+                kwargs[key] = value[rows]
+        return kwargs
+
+    def _generation_config(self, **kwargs):
+        """Separate model arguments from generation config."""
         config = self.model.generation_config
         config = copy.deepcopy(config)
         kwargs = config.update(**kwargs)
+
+        # Keep sampling options unknown to transformers in the config.
+        for key in ("frequency_penalty", "presence_penalty", "logit_bias"):
+            setattr(config, key, kwargs.pop(key, None))
         kwargs["output_attentions"] = False
         kwargs["output_hidden_states"] = False
         kwargs["use_cache"] = config.use_cache
 
-        # Collect special token IDs.
-        pad_token_id = config.pad_token_id
-        bos_token_id = config.bos_token_id
+        # Normalize special token IDs.
+        if isinstance(config.eos_token_id, int):
+            config.eos_token_id = [config.eos_token_id]
+        if config.pad_token_id is None and config.eos_token_id is not None:
+            config.pad_token_id = config.eos_token_id[0]
+
+        return config, kwargs
+
+    def _allocate_attention_mask(self, kwargs, capacity):
+        """Allocate a mask of decoder-only models attending to new tokens."""
+        attention_mask = kwargs.get("attention_mask")
+        if attention_mask is None or self.model.config.is_encoder_decoder:
+            return None
+        length = attention_mask.shape[-1]
+        mask = attention_mask.new_ones((attention_mask.shape[0], capacity))
+        mask[:, :length] = attention_mask
+        return mask
+
+    def _allocate(self, input_ids, max_new_tokens):
+        """Allocate a token buffer for the inputs and the new tokens."""
+        input_length = input_ids.shape[-1]
+        capacity = input_length + max(max_new_tokens or 0, 1)
+        buffer = input_ids.new_zeros((input_ids.shape[0], capacity))
+        buffer[:, :input_length] = input_ids
+        return buffer
+
+    def _prepare_inputs(self, input_ids, config, kwargs):
+        """Prepare initial inputs for decoder-only or encoder-decoder models."""
+        batch_size = input_ids.shape[0]
+        input_length = input_ids.shape[-1]
         eos_token_id = config.eos_token_id
-        if isinstance(eos_token_id, int):
-            eos_token_id = [eos_token_id]
-        if pad_token_id is None and eos_token_id is not None:
-            pad_token_id = eos_token_id[0]
 
         # Generate from eos if no input is specified.
         if input_length == 0:
             input_ids = input_ids.new_ones((batch_size, 1)).long()
             if eos_token_id is not None:
                 input_ids = input_ids * eos_token_id[0]
-            input_length = 1
 
         # Prepare inputs for encoder-decoder models.
         if self.model.config.is_encoder_decoder:
             # Get outputs from the encoder.
-            encoder = self.model.get_encoder()
-            encoder_kwargs = kwargs.copy()
-            encoder_kwargs.pop("use_cache", None)
-            encoder_kwargs["input_ids"] = input_ids
-            encoder_kwargs["return_dict"] = True
-            with torch.inference_mode():
-                kwargs["encoder_outputs"] = encoder(**encoder_kwargs)
+            kwargs["encoder_outputs"] = self._encode(input_ids, kwargs)
 
             # Reinitialize inputs for the decoder.
             decoder_start_token_id = config.decoder_start_token_id
             if decoder_start_token_id is None:
-                decoder_start_token_id = bos_token_id
+                decoder_start_token_id = config.bos_token_id
             input_ids = input_ids.new_ones((batch_size, 1))
             input_ids = input_ids * decoder_start_token_id
-            input_length = 1
-
-        # Set up logits processor.
-        processor = self._logits_processor(config, input_length)
-
-        # Keep track of which sequences are already finished.
-        unfinished = input_ids.new_ones(batch_size)
-
-        # Start auto-regressive generation.
-        while True:
-            inputs = self.model.prepare_inputs_for_generation(
-                input_ids, **kwargs
-            )  # noqa: E501
-            with torch.inference_mode():
-                outputs = self.model(
-                    **inputs,
-                    return_dict=True,
-                    output_attentions=False,
-                    output_hidden_states=False,
-                )
 
-            # Pre-process the probability distribution of the next tokens.
-            logits = outputs.logits[:, -1, :]
-            with torch.inference_mode():
-                logits = processor(input_ids, logits)
-            probs = torch.nn.functional.softmax(logits, dim=-1)
-
-            # Select deterministic or stochastic decoding strategy.
-            if (config.top_p is not None and config.top_p <= 0) or (
-                config.temperature is not None and config.temperature <= 0
-            ):
-                tokens = torch.argmax(probs, dim=-1)[:, None]
-            else:
-                tokens = torch.multinomial(probs, num_samples=1)
-
-            # Collect log probabilities of the selected tokens.
-            token_logprobs = torch.gather(probs, 1, tokens)
-            token_logprobs = torch.log(token_logprobs + 1e-7).squeeze(1)
-            tokens = tokens.squeeze(1)
+        return input_ids, kwargs
 
-            # Collect log probabilities of the most likely tokens.
-            top_logprobs, top_tokens = probs.topk(logprobs)
-            top_logprobs = torch.log(top_logprobs + 1e-7)
-
-            # Finished sequences should have their next token be a padding.
-            if pad_token_id is not None:
-                tokens = tokens * unfinished + pad_token_id * (1 - unfinished)
-
-            # Append selected tokens to the inputs.
-            input_ids = torch.cat([input_ids, tokens[:, None]], dim=-1)
+    def _encode(self, input_ids, kwargs):
+        """Run the encoder once for each unique input of a batch."""
+        batch_size, length = input_ids.shape
 
-            # Extract past key values from model outputs.
-            if "past_key_values" in outputs:
-                kwargs["past_key_values"] = outputs.past_key_values
-            elif "mems" in outputs:
-                kwargs["past_key_values"] = outputs.mems
-            elif "past_buckets_states" in outputs:
-                kwargs["past_key_values"] = outputs.past_buckets_states
+        # Find the unique inputs, which are often repeated n times.
+        rows = input_ids
+        attention_mask = kwargs.get("attention_mask")
+        if attention_mask is not None:
+            rows = torch.cat([input_ids, attention_mask.long()], dim=-1)
+        inverse = None
+        if (rows == rows[0]).all():
+            rows = rows[:1]
+        else:
+            rows, inverse = torch.unique(rows, dim=0, return_inverse=True)
 
-            # Mark sequences with eos tokens as finished.
-            if eos_token_id is not None:
-                not_eos = sum(tokens != i for i in eos_token_id)
-                unfinished = unfinished.mul(not_eos.long())
+        # Look up encoder outputs of previously seen inputs.
+        keys = [tuple(row) for row in rows.tolist()]
+        states = [None] * len(keys)
+        if self.encoder_cache is not None:
+            states = [self.encoder_cache.get(key) for key in keys]
 
-            # Set status to -1 if exceeded the max length.
-            status = unfinished.clone()
-            if input_ids.shape[-1] - input_length >= config.max_new_tokens:
-                status = 0 - status
+        # Encode the remaining inputs in a single batch.
+        misses = [i for i, state in enumerate(states) if state is None]
+        if misses:
+            encoder = self.model.get_encoder()
+            encoder_kwargs = kwargs.copy()
+            encoder_kwargs.pop("use_cache", None)
+            encoder_kwargs["input_ids"] = rows[misses, :length]
+            if attention_mask is not None:
+                encoder_kwargs["attention_mask"] = rows[misses, length:]
+            encoder_kwargs["return_dict"] = True
+            with torch.inference_mode():
+                outputs = encoder(**encoder_kwargs)
+            for i, state in zip(misses, outputs.last_hidden_state):
+                states[i] = state
+                if self.encoder_cache is not None:
+                    self.encoder_cache.put(keys[i], state.clone())
+
+        if len(misses) == len(keys):
+            hidden_states = outputs.last_hidden_state
+        else:
+            hidden_states = torch.stack(states)
 
-            # Yield predictions and status.
-            yield tokens, token_logprobs, top_tokens, top_logprobs, status
+        # Share the outputs between sequences, without copying if they all
+        # have the same input.
+        if inverse is None:
+            hidden_states = hidden_states.expand(batch_size, -1, -1)
+        else:
+            hidden_states = hidden_states.index_select(0, inverse)
+        return BaseModelOutput(last_hidden_state=hidden_states)
 
-            # Stop when finished or exceeded the max length.
-            if status.max() <= 0:
-                break
+    def _shared_prompt(self, input_ids, kwargs):
+        """Return the prompt if it can be processed once for all sequences."""
+        if (
+            self.model.config.is_encoder_decoder
+            or not kwargs.get("use_cache")
+            or kwargs.get("past_key_values") is not None
+        ):
+            return None
+
+        # All sequences are required to share the same prompt.
+        prompt = input_ids[0]
+        if not (input_ids == prompt).all():
+            return None
+
+        return prompt
+
+    def _reuse_prefix(self, prompt, input_ids, kwargs):
+        """Look up past key values of the longest cached prompt prefix."""
+        if self.prefix_cache is None or prompt is None:
+            return kwargs
+
+        length, past_key_values = self.prefix_cache.get(prompt)
+        if past_key_values is None:
+            return kwargs
+
+        # Make sure that the model will only process the uncached suffix.
+        cached = {**kwargs, "past_key_values": past_key_values}
+        inputs = self.model.prepare_inputs_for_generation(
+            prompt[None, :], **cached
+        )
+        suffix = inputs.get("input_ids")
+        if suffix is None or suffix.shape[-1] != prompt.shape[-1] - length:
+            return kwargs
+
+        return cached
+
+    def _cache_prefix(self, prompt, past_key_values, batch_size):
+        """Store past key values of a prompt for later requests."""
+        if self.prefix_cache is not None and past_key_values is not None:
+            self.prefix_cache.put(prompt, past_key_values, batch_size)
+
+    def _forward(self, input_ids, kwargs, shared=False):
+        """Run a forward pass and return the last logits and the cache."""
+        batch_size = input_ids.shape[0]
+        model_input_ids = input_ids
+        model_kwargs = kwargs
+
+        # Process the shared prompt with a batch size of one.
+        shared = shared and batch_size > 1
+        if shared:
+            model_input_ids = input_ids[:1]
+            attention_mask = kwargs.get("attention_mask")
+            if attention_mask is not None:
+                model_kwargs = {**kwargs, "attention_mask": attention_mask[:1]}
+
+        inputs = self.model.prepare_inputs_for_generation(
+            model_input_ids, **model_kwargs
+        )
+        with torch.inference_mode():
+            outputs = self.model(
+                **inputs,
+                return_dict=True,
+                output_attentions=False,
+                output_hidden_states=False,
+            )
+        logits = outputs.logits[:, -1, :]
+        past_key_values = self._past_key_values(outputs)
+
+        # Share the results of the prompt with all sequences.
+        if shared:
+            try:
+                past_key_values = expand_cache(past_key_values, batch_size)
+            except TypeError:
+                return self._forward(input_ids, kwargs)
+            logits = logits.repeat(batch_size, 1)
+
+        return logits, past_key_values
+
+    def _next_tokens(self, logits, sampler, logprobs):
+        """Select the next tokens from the logits of the last position."""
+
+        # Pre-process the probability distribution of the next tokens.
+        logits = sampler.process(logits)
+        scores = torch.nn.functional.log_softmax(logits, dim=-1)
+
+        # Select deterministic or stochastic decoding per sequence.
+        tokens = sampler.select(scores.exp())
+        sampler.update(tokens)
+
+        # Collect log probabilities of the selected tokens.
+        token_logprobs = torch.gather(scores, 1, tokens[:, None]).squeeze(1)
+        token_logprobs = token_logprobs.clamp(min=MIN_LOGPROB)
+
+        # Collect log probabilities of the most likely tokens if required.
+        if logprobs > 0:
+            top_logprobs, top_tokens = scores.topk(logprobs)
+            top_logprobs = top_logprobs.clamp(min=MIN_LOGPROB)
+        else:
+            top_logprobs = scores.new_empty((scores.shape[0], 0))
+            top_tokens = tokens.new_empty((tokens.shape[0], 0))
+
+        return tokens, token_logprobs, top_tokens, top_logprobs
+
+    def _past_key_values(self, outputs):
+        """Extract past key values from model outputs."""
+        if "past_key_values" in outputs:
+            return outputs.past_key_values
+        if "mems" in outputs:
+            return outputs.mems
+        if "past_buckets_states" in outputs:
+            return outputs.past_buckets_states
+        return None
+
+    def _stopped(self, unfinished, stopped):
+        """Mark sequences that hit a stop sequence as finished."""
+        if stopped is None or not any(stopped):
+            return unfinished
+        mask = torch.tensor(stopped, device=unfinished.device)
+        return unfinished.masked_fill(mask, 0)
+
+    def _unfinished(self, tokens, unfinished, config):
+        """Mark sequences with eos tokens as finished."""
+        if config.eos_token_id is not None:
+            not_eos = sum(tokens != i for i in config.eos_token_id)
+            unfinished = unfinished.mul(not_eos.long())
+        return unfinished
 
 
 def load_model(
@@ -319,6 +785,7 @@ def load_model(
     local_files_only=False,
     trust_remote_code=False,
     half_precision=False,
+    mmap=False,
 ):
     """Load a text generation model and make it stream-able."""
     kwargs = {
@@ -342,6 +809,13 @@ def load_model(
         if half_precision or load_in_8bit or load_in_4bit:
             kwargs["torch_dtype"] = torch.float16
 
+    # Keep weights backed by memory-mapped safetensors files, so that
+    # processes serving the same files share them in the page cache.
+    if mmap:
+        kwargs = kwargs.copy()
+        kwargs["use_safetensors"] = True
+        kwargs["low_cpu_mem_usage"] = True
+
     # Support both decoder-only and encoder-decoder models.
     try:
         model = AutoModelForCausalLM.from_pretrained(name_or_path, **kwargs)
@@ -0,0 +1,69 @@
+"""
+Opt-in profiling of completion requests.
+"""
+import cProfile
+import os
+import random
+import threading
+
+
+class RequestProfiler:
+    """RequestProfiler samples requests and dumps a trace for each of them.
+
+    The cProfile profiler only records the production of each choice, so
+    that time spent waiting for slow clients is excluded. The PyTorch
+    profiler is process-wide and thus profiles one request at a time.
+    """
+
+    def __init__(self, kind, directory, rate=1.0):
+        super().__init__()
+        if kind not in ("cprofile", "torch"):
+            raise ValueError(f"unknown profiler {kind}")
+        self.kind = kind
+        self.directory = directory
+        self.rate = rate
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def wrap(self, name, iterator):
+        """Profile an iterator if the request is sampled."""
+        if random.random() >= self.rate:
+            return iterator
+        if self.kind == "cprofile":
+            return self._cprofile(name, iter(iterator))
+        return self._torch(name, iter(iterator))
+
+    def _cprofile(self, name, iterator):
+        """Profile Python function calls with cProfile."""
+        profile = cProfile.Profile()
+        try:
+            while True:
+                profile.enable()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    profile.disable()
+                yield item
+        finally:
+            profile.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+
+    def _torch(self, name, iterator):
+        """Profile operators with the PyTorch profiler."""
+        import torch.profiler
+
+        if not self.lock.acquire(blocking=False):
+            yield from iterator
+            return
+        try:
+            profile = torch.profiler.profile()
+            profile.start()
+            try:
+                yield from iterator
+            finally:
+                profile.stop()
+                path = os.path.join(self.directory, f"{name}.json")
+                profile.export_chrome_trace(path)
+        finally:
+            self.lock.release()
@@ -0,0 +1,120 @@
+"""
+Registry of models served under different names.
+"""
+import gc
+import threading
+import time
+
+
+class Entry:
+    """Entry holds a registered model and its usage."""
+
+    def __init__(self, path, model=None, pinned=False):
+        super().__init__()
+        self.path = path
+        self.model = model
+        self.pinned = pinned
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """ModelRegistry loads models on first use and unloads idle ones.
+
+    Models are loaded by calling the loader with their path, and unloaded
+    by calling their close method once no request has used them for the
+    idle timeout. Pinned models are never unloaded.
+    """
+
+    def __init__(self, loader, idle_timeout=0):
+        super().__init__()
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        # Check for idle models periodically if eviction is enabled.
+        if idle_timeout > 0:
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+
+    def register(self, name, path, model=None, pinned=False):
+        """Register a model, optionally with an already loaded instance."""
+        with self.lock:
+            self.entries[name] = Entry(path, model=model, pinned=pinned)
+
+    def names(self):
+        """Return the names of all registered models."""
+        with self.lock:
+            return list(self.entries)
+
+    def loaded(self):
+        """Return the models that are currently loaded."""
+        with self.lock:
+            return [e.model for e in self.entries.values() if e.model]
+
+    def acquire(self, name):
+        """Return a model and a function to release it after use."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                raise KeyError(name)
+            entry.users += 1
+
+        # Load the model while holding only the lock of the entry, so that
+        # concurrent requests wait for a single load of the same model.
+        try:
+            with entry.lock:
+                if entry.model is None:
+                    entry.model = self.loader(entry.path)
+        except BaseException:
+            self._release(entry)
+            raise
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._release(entry)
+
+        return entry.model, release
+
+    def evict(self, now=None):
+        """Unload models that have been idle for longer than the timeout."""
+        if now is None:
+            now = time.monotonic()
+        evicted = []
+        with self.lock:
+            for entry in self.entries.values():
+                if (
+                    entry.model is not None
+                    and not entry.pinned
+                    and entry.users == 0
+                    and now - entry.last_used > self.idle_timeout
+                ):
+                    evicted.append(entry.model)
+                    entry.model = None
+
+        # Release memory held by the unloaded models.
+        count = len(evicted)
+        for model in evicted:
+            model.close()
+        if count:
+            evicted.clear()
+            gc.collect()
+        return count
+
+    def _release(self, entry):
+        """Mark the end of a use of an entry."""
+        with self.lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+
+    def _run(self):
+        """Keep unloading idle models."""
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            self.evict()
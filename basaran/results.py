@@ -0,0 +1,155 @@
+"""
+Caching of the results of deterministic completions.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ResultCache:
+    """ResultCache stores the choices of deterministic completions.
+
+    Entries expire after their time to live, and the least recently used
+    ones are evicted once the serialized entries exceed the maximum size.
+    If a directory is given, entries are also written to disk under the
+    same limits, so that they are kept across restarts and can be shared
+    by processes serving the same models.
+    """
+
+    def __init__(self, max_size, ttl=0, directory=None):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory or None
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Create a key from JSON-serializable parts."""
+        return json.dumps(parts, sort_keys=True, separators=(",", ":"))
+
+    def get(self, key):
+        """Find the value of a key that has not expired."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                data, expires = entry
+                if expires is None or expires > now:
+                    self.entries.move_to_end(key)
+                    return json.loads(data)
+                self._remove(key)
+
+        # Fall back to the disk and keep the entry in memory again.
+        entry = self._load(key, now)
+        if entry is None:
+            return None
+        data, expires = entry
+        self._insert(key, data, expires)
+        return json.loads(data)
+
+    def put(self, key, value):
+        """Store the value of a key."""
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        if len(data) > self.max_size:
+            return
+        expires = time.time() + self.ttl if self.ttl > 0 else None
+        self._insert(key, data, expires)
+        self._store(key, data, expires)
+
+    def _insert(self, key, data, expires):
+        """Keep an entry in memory."""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (data, expires)
+            self.size += len(data)
+
+            # Evict least recently used entries until within budget.
+            while self.size > self.max_size:
+                evicted = next(iter(self.entries))
+                self._remove(evicted)
+
+    def _remove(self, key):
+        """Remove an entry from memory."""
+        data, _ = self.entries.pop(key)
+        self.size -= len(data)
+
+    def _path(self, key):
+        """Return the path of the file of a key."""
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _load(self, key, now):
+        """Read an entry from disk."""
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Different keys may share a file in the unlikely event of a hash
+        # collision, and expired entries are removed when read.
+        if entry.get("key") != key:
+            return None
+        expires = entry.get("expires")
+        if expires is not None and expires <= now:
+            self._unlink(path)
+            return None
+        return entry["data"], expires
+
+    def _store(self, key, data, expires):
+        """Write an entry to disk and prune the directory."""
+        if self.directory is None:
+            return
+        path = self._path(key)
+        entry = {"key": key, "expires": expires, "data": data}
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(temp, path)
+        except OSError:
+            self._unlink(temp)
+            return
+        self._prune()
+
+    def _prune(self):
+        """Remove expired and least recently written files beyond budget."""
+        files = []
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if item.name.endswith(".json"):
+                        stat = item.stat()
+                        files.append((stat.st_mtime, stat.st_size, item.path))
+        except OSError:
+            return
+
+        # Files outlive their entries by at most the time to live.
+        now = time.time()
+        files.sort()
+        size = sum(f[1] for f in files)
+        for mtime, file_size, path in files:
+            expired = self.ttl > 0 and mtime + self.ttl <= now
+            if not expired and size <= self.max_size:
+                continue
+            self._unlink(path)
+            size -= file_size
+
+    def _unlink(self, path):
+        """Remove a file if it still exists."""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,332 @@
+"""
+Batched sampling of next tokens with per-sequence parameters.
+"""
+import torch
+
+# Parameters of each sequence that are kept as one row per sequence.
+ROW_FIELDS = (
+    "temperature",
+    "top_p",
+    "top_k",
+    "min_tokens",
+    "greedy",
+    "generated",
+    "frequency_penalty",
+    "presence_penalty",
+    "repetition_penalty",
+)
+
+
+class Sampler:
+    """Sampler applies the sampling parameters of each sequence at once.
+
+    Parameters are kept as tensors with one row per sequence, so that
+    sequences of different requests can be sampled in the same batch.
+    Operations that no sequence needs are skipped entirely.
+
+    Penalties are computed from token counts that are updated with the
+    selected tokens of each step, instead of rescanning the sequences.
+    """
+
+    def __init__(
+        self,
+        temperature,
+        top_p,
+        top_k,
+        min_tokens,
+        greedy,
+        eos_token_id=None,
+        generated=None,
+        frequency_penalty=None,
+        presence_penalty=None,
+        repetition_penalty=None,
+        counts=None,
+        seen=None,
+        bias=None,
+    ):
+        super().__init__()
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.min_tokens = min_tokens
+        self.greedy = greedy
+        self.eos_token_id = eos_token_id
+        self.generated = generated
+        if generated is None:
+            self.generated = torch.zeros_like(min_tokens)
+
+        # Penalties default to values that leave logits intact.
+        zeros = torch.zeros_like(temperature)
+        self.frequency_penalty = frequency_penalty
+        if frequency_penalty is None:
+            self.frequency_penalty = zeros
+        self.presence_penalty = presence_penalty
+        if presence_penalty is None:
+            self.presence_penalty = zeros
+        self.repetition_penalty = repetition_penalty
+        if repetition_penalty is None:
+            self.repetition_penalty = torch.ones_like(temperature)
+
+        # Counts of generated tokens and masks of the tokens seen so far,
+        # including the prompts, of shape [batch, vocab].
+        self.counts = counts
+        self.seen = seen
+
+        # Biases are stored as rows, token IDs and values of a sparse matrix.
+        self.bias = bias
+
+        # Decide once which operations are needed by any sequence.
+        self.scaled = bool((temperature != 1).any())
+        self.nucleus = bool((top_p < 1).any())
+        self.max_top_k = int(top_k.max()) if top_k.numel() > 0 else 0
+        self.all_greedy = bool(greedy.all())
+        self.any_greedy = bool(greedy.any())
+        self.remaining = 0
+        if eos_token_id is not None and min_tokens.numel() > 0:
+            self.remaining = int((min_tokens - self.generated).max())
+        self.counted = counts is not None and bool(
+            (self.frequency_penalty != 0).any()
+            or (self.presence_penalty != 0).any()
+        )
+        self.repeated = seen is not None and bool(
+            (self.repetition_penalty != 1).any()
+        )
+        self.biased = bias is not None and bias[0].numel() > 0
+
+    @property
+    def penalized(self):
+        """Whether logits depend on the previously selected tokens."""
+        return self.counted or self.repeated
+
+    @classmethod
+    def from_config(cls, config, input_ids, vocab_size, attention_mask=None):
+        """Create a sampler for sequences sharing a generation config."""
+        batch_size = input_ids.shape[0]
+        device = input_ids.device
+        temperature = config.temperature
+        top_p = config.top_p
+        greedy = (top_p is not None and top_p <= 0) or (
+            temperature is not None and temperature <= 0
+        )
+
+        # Disabled parameters are set to values that leave logits intact.
+        if temperature is None or temperature <= 0:
+            temperature = 1.0
+        if top_p is None or top_p <= 0 or top_p > 1:
+            top_p = 1.0
+        top_k = config.top_k if config.top_k is not None else 0
+        min_tokens = config.min_new_tokens or 0
+        eos_token_id = None
+        if config.eos_token_id is not None:
+            eos_token_id = torch.tensor(config.eos_token_id, device=device)
+        frequency_penalty = getattr(config, "frequency_penalty", None) or 0.0
+        presence_penalty = getattr(config, "presence_penalty", None) or 0.0
+        repetition_penalty = config.repetition_penalty
+        if repetition_penalty is None or repetition_penalty <= 0:
+            repetition_penalty = 1.0
+
+        def full(value, dtype):
+            return torch.full((batch_size,), value, dtype=dtype, device=device)
+
+        # Count generated tokens only if they are penalized.
+        counts = None
+        if frequency_penalty != 0 or presence_penalty != 0:
+            counts = torch.zeros((batch_size, vocab_size), device=device)
+
+        # Mark the tokens of the prompts, excluding padding. Masks of the
+        # encoder inputs of encoder-decoder models do not apply.
+        seen = None
+        if repetition_penalty != 1:
+            mask = attention_mask
+            if mask is None or mask.shape != input_ids.shape:
+                mask = torch.ones_like(input_ids)
+            seen = torch.zeros(
+                (batch_size, vocab_size), dtype=torch.long, device=device
+            )
+            seen = seen.scatter_add(1, input_ids, mask.long()) > 0
+
+        # Compile the biases into a sparse matrix once per request.
+        bias = None
+        logit_bias = getattr(config, "logit_bias", None)
+        if logit_bias:
+            if any(t < 0 or t >= vocab_size for t in logit_bias):
+                raise ValueError("logit_bias contains invalid tokens")
+            index = torch.tensor(list(logit_bias.keys()), device=device)
+            values = torch.tensor(
+                list(logit_bias.values()), dtype=torch.float, device=device
+            )
+            rows = torch.arange(batch_size, device=device)
+            bias = (
+                rows.repeat_interleave(len(logit_bias)),
+                index.repeat(batch_size),
+                values.repeat(batch_size),
+            )
+
+        return cls(
+            temperature=full(temperature, torch.float),
+            top_p=full(top_p, torch.float),
+            top_k=full(max(top_k, 0), torch.long),
+            min_tokens=full(min_tokens, torch.long),
+            greedy=full(greedy, torch.bool),
+            eos_token_id=eos_token_id,
+            frequency_penalty=full(frequency_penalty, torch.float),
+            presence_penalty=full(presence_penalty, torch.float),
+            repetition_penalty=full(repetition_penalty, torch.float),
+            counts=counts,
+            seen=seen,
+            bias=bias,
+        )
+
+    @classmethod
+    def cat(cls, samplers):
+        """Concatenate the sequences of several samplers."""
+        kwargs = {
+            name: torch.cat([getattr(s, name) for s in samplers])
+            for name in ROW_FIELDS
+        }
+
+        # Sequences without penalties only need placeholder rows.
+        for name, dtype in (("counts", torch.float), ("seen", torch.bool)):
+            tensors = [getattr(s, name) for s in samplers]
+            widths = [t.shape[-1] for t in tensors if t is not None]
+            if not widths:
+                continue
+            kwargs[name] = torch.cat(
+                [
+                    s.greedy.new_zeros((len(s.greedy), widths[0]), dtype=dtype)
+                    if t is None
+                    else t
+                    for s, t in zip(samplers, tensors)
+                ]
+            )
+
+        # Offset the rows of the biases by the sizes of previous samplers.
+        rows, index, values = [], [], []
+        offset = 0
+        for sampler in samplers:
+            if sampler.bias is not None:
+                rows.append(sampler.bias[0] + offset)
+                index.append(sampler.bias[1])
+                values.append(sampler.bias[2])
+            offset += len(sampler.greedy)
+        if rows:
+            kwargs["bias"] = tuple(map(torch.cat, (rows, index, values)))
+
+        return cls(eos_token_id=samplers[0].eos_token_id, **kwargs)
+
+    def take(self, rows):
+        """Create a sampler for the given rows only."""
+        rows = rows.to(self.greedy.device)
+        kwargs = {name: getattr(self, name)[rows] for name in ROW_FIELDS}
+        if self.counts is not None:
+            kwargs["counts"] = self.counts[rows]
+        if self.seen is not None:
+            kwargs["seen"] = self.seen[rows]
+
+        # Map the rows of the biases to their new positions.
+        if self.bias is not None:
+            positions = torch.full_like(self.greedy, -1, dtype=torch.long)
+            positions[rows] = torch.arange(len(rows), device=rows.device)
+            bias_rows = positions[self.bias[0]]
+            kept = bias_rows >= 0
+            kwargs["bias"] = (
+                bias_rows[kept],
+                self.bias[1][kept],
+                self.bias[2][kept],
+            )
+
+        return Sampler(eos_token_id=self.eos_token_id, **kwargs)
+
+    def process(self, logits, offset=0):
+        """Apply the sampling parameters to a batch of logits.
+
+        The offset is the number of tokens that have been generated since
+        the last update, for scoring several positions ahead at once.
+        """
+        with torch.inference_mode():
+            # Add the biases of all sequences with a single scatter.
+            if self.biased:
+                rows, index, values = self.bias
+                vocab_size = logits.shape[-1]
+                logits = (
+                    logits.flatten()
+                    .scatter_add(
+                        0, rows * vocab_size + index, values.to(logits.dtype)
+                    )
+                    .view_as(logits)
+                )
+
+            # Penalize tokens that appeared before, following transformers.
+            if self.repeated:
+                penalty = self.repetition_penalty[:, None].to(logits.dtype)
+                penalized = torch.where(
+                    logits > 0, logits / penalty, logits * penalty
+                )
+                logits = torch.where(self.seen, penalized, logits)
+
+            # Penalize generated tokens by their counts, following OpenAI.
+            if self.counted:
+                counts = self.counts.to(logits.dtype)
+                logits = (
+                    logits
+                    - counts * self.frequency_penalty[:, None]
+                    - (counts > 0) * self.presence_penalty[:, None]
+                )
+
+            # Prevent eos tokens until the minimum number is generated.
+            if self.remaining > offset:
+                blocked = self.generated + offset < self.min_tokens
+                eos = self.eos_token_id
+                logits = logits.clone()
+                logits[:, eos] = logits[:, eos].masked_fill(
+                    blocked[:, None], -float("inf")
+                )
+
+            # Scale the distributions with the temperatures.
+            if self.scaled:
+                logits = logits / self.temperature[:, None]
+
+            # Keep the k most likely tokens of each sequence.
+            if self.max_top_k > 0:
+                k = min(self.max_top_k, logits.shape[-1])
+                values = torch.topk(logits, k).values
+                index = self.top_k.clamp(min=1, max=k) - 1
+                threshold = values.gather(1, index[:, None])
+                removed = (logits < threshold) & (self.top_k[:, None] > 0)
+                logits = logits.masked_fill(removed, -float("inf"))
+
+            # Keep the smallest set of tokens within the top probabilities,
+            # always including the most likely token.
+            if self.nucleus:
+                sorted_logits, indices = torch.sort(logits, descending=False)
+                probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+                removed = probs <= 1 - self.top_p[:, None]
+                removed[:, -1] = False
+                removed = removed.scatter(1, indices, removed)
+                logits = logits.masked_fill(removed, -float("inf"))
+
+        return logits
+
+    def select(self, probs):
+        """Select tokens from the probability distributions."""
+        if self.all_greedy:
+            return torch.argmax(probs, dim=-1)
+        tokens = torch.multinomial(probs, num_samples=1)[:, 0]
+        if self.any_greedy:
+            tokens = torch.where(
+                self.greedy, torch.argmax(probs, dim=-1), tokens
+            )
+        return tokens
+
+    def update(self, tokens):
+        """Count the tokens that have been generated for each sequence."""
+        with torch.inference_mode():
+            self.generated += 1
+            self.remaining -= 1
+
+            # Only the selected token of each sequence has to be updated.
+            rows = torch.arange(tokens.shape[0], device=tokens.device)
+            if self.counts is not None:
+                self.counts[rows, tokens] += 1
+            if self.seen is not None:
+                self.seen[rows, tokens] = True
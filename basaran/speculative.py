@@ -0,0 +1,208 @@
+"""
+Speculative decoding with a small draft model.
+"""
+import time
+
+import torch
+
+from .cache import cache_size, map_cache, probe_layout
+from .model import MIN_LOGPROB
+
+
+class Speculator:
+    """Speculator proposes tokens with a draft model for verification."""
+
+    def __init__(self, stream_model, draft_model, num_tokens=4):
+        super().__init__()
+        self.stream_model = stream_model
+        self.draft_model = draft_model
+        self.num_tokens = max(num_tokens, 1)
+
+        # Caches are rolled back to the accepted tokens after each step, and
+        # both models must be decoder-only and share the same vocabulary.
+        self.layout = None
+        self.draft_layout = None
+        config = stream_model.model.config
+        if not (
+            config.is_encoder_decoder
+            or draft_model.config.is_encoder_decoder
+            or config.vocab_size != draft_model.config.vocab_size
+        ):
+            device = stream_model.device
+            self.layout = probe_layout(stream_model.model, device)
+            self.draft_layout = probe_layout(draft_model, device)
+
+    def supports(self, kwargs):
+        """Check whether the inputs can be decoded speculatively."""
+        return (
+            self.layout is not None
+            and self.draft_layout is not None
+            and kwargs.get("use_cache")
+            and set(kwargs)
+            == {"output_attentions", "output_hidden_states", "use_cache"}
+        )
+
+    def generate(
+        self,
+        input_ids,
+        config,
+        sampler,
+        logprobs,
+        is_cancelled,
+        stopped,
+        tracker,
+    ):
+        """Generate a stream of predicted tokens, several per forward pass."""
+        stream_model = self.stream_model
+        batch_size = input_ids.shape[0]
+        input_length = input_ids.shape[-1]
+        greedy = sampler.greedy[:, None]
+
+        # Keep track of the tokens that each model has already processed.
+        past_key_values = None
+        draft_key_values = None
+        cached = 0
+        draft_cached = 0
+
+        # Keep track of which sequences are already finished.
+        unfinished = input_ids.new_ones(batch_size)
+
+        while True:
+            start = time.perf_counter()
+            length = input_ids.shape[-1]
+
+            # Propose tokens with the draft model.
+            draft_ids = input_ids
+            draft_probs = []
+            for i in range(self.num_tokens):
+                logits, draft_key_values = self._forward(
+                    self.draft_model,
+                    draft_ids[:, draft_cached:],
+                    draft_key_values,
+                )
+                draft_cached = draft_ids.shape[-1]
+                logits = logits[:, -1, :].to(input_ids.device).float()
+                scores = sampler.process(logits, offset=i)
+                probs = torch.nn.functional.softmax(scores, dim=-1)
+                tokens = sampler.select(probs)
+                draft_ids = torch.cat([draft_ids, tokens[:, None]], dim=-1)
+                draft_probs.append(probs)
+
+            # Verify all proposed tokens with a single forward pass.
+            logits, past_key_values = self._forward(
+                stream_model.model, draft_ids[:, cached:], past_key_values
+            )
+            logits = logits[:, -self.num_tokens - 1 :, :].float()
+            target_scores = []
+            for i in range(self.num_tokens + 1):
+                scores = sampler.process(logits[:, i], offset=i)
+                target_scores.append(
+                    torch.nn.functional.log_softmax(scores, dim=-1)
+                )
+
+            # Accept proposals with probability min(1, p / q) per sequence,
+            # while greedy sequences only accept the most likely tokens.
+            drafts = draft_ids[:, length:]
+            target_probs = torch.stack(target_scores[:-1], dim=1).exp()
+            draft_probs = torch.stack(draft_probs, dim=1)
+            p = target_probs.gather(2, drafts[..., None])[..., 0]
+            q = draft_probs.gather(2, drafts[..., None])[..., 0]
+            accepted = torch.where(
+                greedy,
+                drafts == target_probs.argmax(dim=-1),
+                torch.rand_like(p) * q < p,
+            )
+            counts = accepted.long().cumprod(dim=1).sum(dim=1)
+
+            # Advance all sequences by the same number of tokens. Rows that
+            # accepted the next proposal keep it, as it already follows the
+            # distribution of the model, while the others are resampled.
+            count = counts.min().item()
+            if count == self.num_tokens or sampler.all_greedy:
+                tokens = sampler.select(target_scores[count].exp())
+            else:
+                residual = target_probs[:, count] - draft_probs[:, count]
+                residual = residual.clamp(min=0)
+                empty = residual.sum(dim=-1, keepdim=True) <= 0
+                residual = torch.where(
+                    empty | greedy, target_probs[:, count], residual
+                )
+                tokens = sampler.select(residual)
+            if count < self.num_tokens:
+                tokens = torch.where(counts > count, drafts[:, count], tokens)
+            new_tokens = torch.cat([drafts[:, :count], tokens[:, None]], dim=-1)
+
+            # Roll back the caches to the accepted tokens.
+            cached = length + count
+            draft_cached = min(draft_cached, cached)
+            past_key_values = self._crop(past_key_values, self.layout, cached)
+            draft_key_values = self._crop(
+                draft_key_values, self.draft_layout, draft_cached
+            )
+            tracker.step(start, cache_size(past_key_values))
+
+            # Yield accepted tokens one at a time.
+            for i in range(count + 1):
+                tokens = new_tokens[:, i]
+                scores = target_scores[i]
+                sampler.update(tokens)
+                token_logprobs = scores.gather(1, tokens[:, None])[:, 0]
+                token_logprobs = token_logprobs.clamp(min=MIN_LOGPROB)
+                if logprobs > 0:
+                    top_logprobs, top_tokens = scores.topk(logprobs)
+                    top_logprobs = top_logprobs.clamp(min=MIN_LOGPROB)
+                else:
+                    top_logprobs = scores.new_empty((batch_size, 0))
+                    top_tokens = tokens.new_empty((batch_size, 0))
+
+                # Finished sequences should have their next token be a padding.
+                unfinished = stream_model._stopped(unfinished, stopped)
+                if config.pad_token_id is not None:
+                    padding = config.pad_token_id * (1 - unfinished)
+                    tokens = tokens * unfinished + padding
+
+                # Append selected tokens to the inputs.
+                input_ids = torch.cat([input_ids, tokens[:, None]], dim=-1)
+
+                # Mark sequences with eos tokens as finished.
+                unfinished = stream_model._unfinished(
+                    tokens, unfinished, config
+                )
+
+                # Set status to -1 if exceeded the max length, or to -2 if
+                # cancelled.
+                status = unfinished.clone()
+                generated = input_ids.shape[-1] - input_length
+                if generated >= config.max_new_tokens:
+                    status = 0 - status
+                elif is_cancelled is not None and is_cancelled():
+                    status = -2 * status
+
+                # Yield predictions and status.
+                yield tokens, token_logprobs, top_tokens, top_logprobs, status
+
+                # Stop when finished or exceeded the max length.
+                if status.max() <= 0:
+                    return
+
+    def _forward(self, model, input_ids, past_key_values):
+        """Run a forward pass on the tokens that are not yet cached."""
+        with torch.inference_mode():
+            outputs = model(
+                input_ids=input_ids.to(model.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+                output_attentions=False,
+                output_hidden_states=False,
+            )
+        return outputs.logits, outputs.past_key_values
+
+    def _crop(self, cache, layout, length):
+        """Keep the first tokens of a cache."""
+
+        def crop(tensors, dim):
+            (tensor,) = tensors
+            return tensor.narrow(dim, 0, length)
+
+        return map_cache([cache], layout, crop)
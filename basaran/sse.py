@@ -0,0 +1,116 @@
+"""
+Functions for serializing server-sent events.
+"""
+import json
+import time
+
+# Reuse a single encoder instead of creating one for every call.
+encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# Fields of the log probabilities of a completion choice, in order.
+LOGPROBS_FIELDS = ("tokens", "token_logprobs", "top_logprobs", "text_offset")
+
+
+def serialize(data):
+    """Serialize data into an event of an event stream."""
+    return f"data: {encode(data)}\n\n"
+
+
+class Fragments:
+    """Fragments holds the serialized parts of a choice to be sent."""
+
+    def __init__(self):
+        super().__init__()
+        self.text = []
+        self.logprobs = {key: [] for key in LOGPROBS_FIELDS}
+        self.finish_reason = None
+
+
+class StreamEncoder:
+    """StreamEncoder buffers choices and serializes them into events.
+
+    Fields of the response template are serialized only once, and each
+    choice is kept as JSON fragments until the buffer is flushed into an
+    event carrying all pending choices. The buffer is flushed when its
+    oldest choice has waited longer than the maximum interval, or when the
+    size of its fragments exceeds the maximum size.
+    """
+
+    def __init__(self, template, chat=False, max_interval=50, max_size=4096):
+        super().__init__()
+        fields = {k: v for k, v in template.items() if k != "choices"}
+        self.prefix = f'data: {encode(fields)[:-1]},"choices":['
+        self.chat = chat
+        self.max_interval = max_interval / 1000
+        self.max_size = max_size
+        self.pending = {}
+        self.started = set()
+        self.size = 0
+        self.since = None
+
+    def add(self, choice):
+        """Buffer a choice and return an event if the buffer is flushed."""
+        now = time.monotonic()
+        if self.since is None:
+            self.since = now
+        index = choice["index"]
+        fragments = self.pending.get(index)
+        if fragments is None:
+            fragments = self.pending[index] = Fragments()
+
+        # Keep the text escaped but without the surrounding quotes.
+        text = encode(choice["text"])[1:-1]
+        fragments.text.append(text)
+        fragments.finish_reason = choice["finish_reason"]
+        self.size += len(text)
+
+        # Chat choices do not include log probabilities.
+        logprobs = choice["logprobs"]
+        if logprobs is not None and not self.chat:
+            for key in LOGPROBS_FIELDS:
+                values = encode(logprobs[key])[1:-1]
+                if values:
+                    fragments.logprobs[key].append(values)
+                    self.size += len(values)
+
+        if now - self.since > self.max_interval or self.size >= self.max_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return an event with all pending choices, if there are any."""
+        if not self.pending:
+            return None
+        choices = ",".join(self._choice(i, f) for i, f in self.pending.items())
+        self.pending = {}
+        self.size = 0
+        self.since = None
+        return f"{self.prefix}{choices}]}}\n\n"
+
+    def _choice(self, index, fragments):
+        """Join the fragments of a choice into a JSON object."""
+        text = "".join(fragments.text)
+        finish_reason = encode(fragments.finish_reason)
+
+        # Only the first delta of each chat choice includes the role.
+        if self.chat:
+            role = ""
+            if index not in self.started:
+                self.started.add(index)
+                role = '"role":"assistant",'
+            return (
+                f'{{"index":{index},"delta":{{{role}"content":"{text}"}},'
+                f'"finish_reason":{finish_reason}}}'
+            )
+
+        logprobs = "null"
+        if fragments.logprobs["tokens"]:
+            logprobs = ",".join(
+                f'"{key}":[{",".join(fragments.logprobs[key])}]'
+                for key in LOGPROBS_FIELDS
+            )
+            logprobs = f"{{{logprobs}}}"
+        return (
+            f'{{"text":"{text}","index":{index},"logprobs":{logprobs},'
+            f'"finish_reason":{finish_reason}}}'
+        )
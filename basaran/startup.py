@@ -0,0 +1,86 @@
+"""
+Background loading and timing of the server startup phases.
+"""
+import contextlib
+import os
+import threading
+import time
+import traceback
+
+
+class Startup:
+    """Startup runs the loading of the server in a background thread.
+
+    Loading is divided into named phases, whose durations are recorded
+    and printed, so that the server can report its progress while it is
+    already accepting connections.
+    """
+
+    def __init__(self, phases):
+        super().__init__()
+        self.phases = list(phases)
+        self.durations = {}
+        self.phase = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.finished = None
+        self.done = threading.Event()
+
+        # Exit the process if loading fails while serving.
+        self.fatal = False
+
+    def start(self, target):
+        """Start running the loading function in the background."""
+        thread = threading.Thread(target=self._run, args=(target,))
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, timeout=None):
+        """Wait until loading is finished, raising its error if any."""
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.done.is_set()
+
+    def is_ready(self):
+        """Check whether loading has finished successfully."""
+        return self.done.is_set() and self.error is None
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        """Record the duration of a phase."""
+        self.phase = phase
+        start = time.perf_counter()
+        yield
+        self.durations[phase] = time.perf_counter() - start
+        print(f"startup phase {phase} took {self.durations[phase]:.2f}s")
+
+    def status(self):
+        """Return the status and progress of loading."""
+        if self.error is not None:
+            status = "failed"
+        elif self.done.is_set():
+            status = "ready"
+        else:
+            status = "loading"
+        end = self.finished or time.perf_counter()
+        return {
+            "status": status,
+            "phase": None if self.is_ready() else self.phase,
+            "progress": len(self.durations) / max(len(self.phases), 1),
+            "elapsed": round(end - self.started, 3),
+            "phases": {k: round(v, 3) for k, v in self.durations.items()},
+        }
+
+    def _run(self, target):
+        """Run the loading function and record its outcome."""
+        try:
+            target()
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+            if self.fatal:
+                os._exit(1)
+        finally:
+            self.finished = time.perf_counter()
+            self.done.set()
@@ -0,0 +1,100 @@
+"""
+Incremental matching of stop sequences in streamed text.
+"""
+
+
+class StopMatcher:
+    """StopMatcher is an Aho-Corasick automaton of stop sequences.
+
+    The automaton is built once per request and shared by the scanners of
+    all its sequences, which only keep their current state.
+    """
+
+    def __init__(self, patterns):
+        super().__init__()
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.match = [0]
+
+        # Build a trie of the patterns.
+        for pattern in patterns:
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                    self.match.append(0)
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            if pattern:
+                self.match[node] = len(pattern)
+
+        # Link each node to its longest proper suffix in the trie, in order
+        # of depth, and inherit the matches of the suffix.
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                suffix = self.fail[node]
+                while suffix and char not in self.goto[suffix]:
+                    suffix = self.fail[suffix]
+                self.fail[child] = self.goto[suffix].get(char, 0)
+                self.match[child] = max(
+                    self.match[child], self.match[self.fail[child]]
+                )
+
+    def step(self, node, char):
+        """Move from a node of the automaton with a character."""
+        while node and char not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(char, 0)
+
+    def scanner(self):
+        """Create a scanner for the text of one sequence."""
+        return StopScanner(self)
+
+
+class StopScanner:
+    """StopScanner finds the first stop sequence in a stream of text.
+
+    Text is released as soon as it can no longer be part of a stop
+    sequence, so only the longest suffix that is a prefix of one of the
+    patterns is held back.
+    """
+
+    def __init__(self, matcher):
+        super().__init__()
+        self.matcher = matcher
+        self.node = 0
+        self.held = ""
+
+    def feed(self, text):
+        """Scan text and return the releasable text and if it stopped."""
+        matcher = self.matcher
+        node = self.node
+        for i, char in enumerate(text):
+            node = matcher.step(node, char)
+
+            # Cut the text before the earliest starting stop sequence that
+            # ends at this character.
+            if matcher.match[node]:
+                text = self.held + text[: i + 1]
+                self.node = 0
+                self.held = ""
+                return text[: len(text) - matcher.match[node]], True
+
+        # Hold back the text that may still start a stop sequence.
+        self.node = node
+        text = self.held + text
+        keep = matcher.depth[node]
+        self.held = text[len(text) - keep :] if keep else ""
+        return text[: len(text) - keep], False
+
+    def flush(self):
+        """Release the text held back when the sequence ends."""
+        text = self.held
+        self.held = ""
+        self.node = 0
+        return text
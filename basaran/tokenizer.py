@@ -1,6 +1,58 @@
 """
 A stateful tokenizer for stream decoding.
 """
+import codecs
+import weakref
+
+# Byte tables are shared by all stream tokenizers of the same tokenizer.
+byte_vocabs = weakref.WeakKeyDictionary()
+
+
+def byte_vocab(tokenizer):
+    """Map token IDs to raw bytes for byte-level BPE tokenizers."""
+    if tokenizer in byte_vocabs:
+        return byte_vocabs[tokenizer]
+
+    # Import lazily to keep transformers out of the server startup.
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+    # Only tokenizers that decode bytes without post-processing qualify,
+    # which excludes those cleaning up spaces before punctuation.
+    vocab = None
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    decoder = getattr(backend, "decoder", None)
+    cleanup = getattr(tokenizer, "clean_up_tokenization_spaces", False)
+    if type(decoder).__name__ == "ByteLevel" and not cleanup:
+        vocab = []
+        byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+        special = set(tokenizer.all_special_ids)
+        added = {i: t for t, i in tokenizer.get_added_vocab().items()}
+        tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        for i, token in enumerate(tokens):
+            if i in special or token is None:
+                vocab.append(b"")
+            elif i in added:
+                vocab.append(added[i].encode("utf-8"))
+            elif all(c in byte_decoder for c in token):
+                vocab.append(bytes(byte_decoder[c] for c in token))
+            else:
+                vocab = None
+                break
+
+    byte_vocabs[tokenizer] = vocab
+    return vocab
+
+
+def is_concatenable(tokenizer):
+    """Check whether tokens of texts encoded separately can be joined."""
+    for head in ("hello\n", "hello\n\n", "hello \n"):
+        tail = "world"
+        whole = tokenizer.encode(head + tail)
+        parts = tokenizer.encode(head)
+        parts += tokenizer.encode(tail, add_special_tokens=False)
+        if whole != parts:
+            return False
+    return True
 
 
 class StreamTokenizer:
@@ -10,44 +62,57 @@ class StreamTokenizer:
         super().__init__()
         self.tokenizer = tokenizer
         self.replacement = chr(0xFFFD)
-        self.buffer = []
-        self.surrogates = 0
         self.start = 0
         self.end = 0
 
+        # Decode bytes incrementally if the tokenizer is byte-level. Invalid
+        # bytes are replaced as in full decoding instead of dropped.
+        self.vocab = byte_vocab(tokenizer)
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        # Otherwise decode a sliding window of tokens. Tokens before the
+        # read offset have been emitted and only serve as context.
+        self.tokens = []
+        self.read_offset = 0
+
     def decode(self, token):
         """Decode token to string while handling surrogates and whitespace."""
-
-        # <unk>, <pad> and other special tokens will be decoded into ''.
-        text = self.tokenizer.decode(token, skip_special_tokens=True)
-
-        # Handle replacement characters caused by multi-byte-pair-encoding or
-        # Unicode surrogates or multi-code-point graphemes like emojis.
-        if self.replacement in text:
-            n = -self.surrogates if self.surrogates > 0 else len(self.buffer)
-            tokens = self.buffer[n:] + [token]
-            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
-
-            # Check whether the last grapheme was successfully decoded.
-            if text and text[-1] != self.replacement:
-                text = text.replace(self.replacement, "")
-                self.surrogates = 0
-            else:
-                text = ""
-                self.surrogates += 1
+        token = int(token)
+        if self.vocab is not None:
+            text = self._decode_bytes(token)
         else:
-            self.surrogates = 0
-
-        # Handle whitespace between tokens.
-        tokens = self.buffer + [token]
-        prefix = self.tokenizer.decode(self.buffer, skip_special_tokens=True)
-        whole = self.tokenizer.decode(tokens, skip_special_tokens=True)
-        if prefix + " " + text == whole:
-            text = " " + text
+            text = self._decode_window(token)
 
-        # Update buffer and offsets.
-        self.buffer = self.buffer[-4:] + [token]
+        # Update offsets.
         self.start = self.end
         self.end += len(text)
 
         return text
+
+    def _decode_bytes(self, token):
+        """Decode the bytes of a token, holding back incomplete characters."""
+        if 0 <= token < len(self.vocab):
+            return self.decoder.decode(self.vocab[token])
+        return ""
+
+    def _decode_window(self, token):
+        """Decode the text that a token adds to the preceding tokens."""
+        self.tokens.append(token)
+
+        # <unk>, <pad> and other special tokens will be decoded into ''.
+        prefix = self.tokenizer.decode(
+            self.tokens[: self.read_offset], skip_special_tokens=True
+        )
+        whole = self.tokenizer.decode(self.tokens, skip_special_tokens=True)
+
+        # Wait for more tokens if the last character is incomplete, which is
+        # caused by multi-byte-pair-encoding or Unicode surrogates.
+        if len(whole) <= len(prefix) or whole.endswith(self.replacement):
+            return ""
+        text = whole[len(prefix) :].replace(self.replacement, "")
+
+        # Keep only the last emitted tokens as context for whitespace.
+        del self.tokens[: self.read_offset]
+        self.read_offset = len(self.tokens)
+
+        return text
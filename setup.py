@@ -29,6 +29,9 @@ setup(
         "transformers",
         "waitress",
     ],
+    extras_require={
+        "asgi": ["uvicorn"],
+    },
     keywords=["api", "huggingface", "nlp", "openai", "transformer"],
     classifiers=[
         "Development Status :: 4 - Beta",
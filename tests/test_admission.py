@@ -0,0 +1,76 @@
+"""
+Test admission control of requests by their token footprint.
+"""
+import threading
+import time
+
+import pytest
+
+from basaran.admission import PRIORITIES, AdmissionController, QueueFull
+
+
+class TestAdmissionController:
+    """Test queueing requests that exceed the token budget."""
+
+    def test_acquire(self):
+        """Test admitting requests that fit into the budget."""
+        admission = AdmissionController(100)
+        release = admission.acquire(60)
+        assert admission.used == 60
+
+        release()
+        release()
+        assert admission.used == 0
+
+    def test_oversized(self):
+        """Test admitting requests larger than the budget alone."""
+        admission = AdmissionController(100)
+        release = admission.acquire(1000)
+        assert admission.used == 100
+        release()
+        assert admission.used == 0
+
+    def test_priority(self):
+        """Test admitting queued requests by priority and arrival."""
+        admission = AdmissionController(100)
+        release = admission.acquire(100)
+
+        order = []
+
+        def worker(name, priority):
+            admission.acquire(100, priority)()
+            order.append(name)
+
+        threads = []
+        for name in ("low", "normal", "high", "normal"):
+            thread = threading.Thread(
+                target=worker, args=(name, PRIORITIES[name])
+            )
+            thread.start()
+            threads.append(thread)
+            while len(admission.queue) < len(threads):
+                time.sleep(0.01)
+
+        release()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert order == ["high", "normal", "normal", "low"]
+        assert admission.used == 0
+
+    def test_queue_full(self):
+        """Test rejecting requests when the queue is full."""
+        admission = AdmissionController(100, max_queue=0)
+        release = admission.acquire(100)
+        with pytest.raises(QueueFull) as e:
+            admission.acquire(1)
+        assert e.value.retry_after >= 1
+        release()
+
+    def test_cancelled(self):
+        """Test removing cancelled requests from the queue."""
+        admission = AdmissionController(100)
+        release = admission.acquire(100)
+        with pytest.raises(QueueFull):
+            admission.acquire(1, is_cancelled=lambda: True)
+        assert not admission.queue
+        release()
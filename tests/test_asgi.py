@@ -0,0 +1,108 @@
+"""
+Test serving a Flask application over ASGI.
+"""
+import asyncio
+import threading
+
+import pytest
+from flask import Flask, Response
+
+from basaran.asgi import STREAM_ERROR, ASGIAdapter
+
+
+class TestASGIAdapter:
+    """Test serving a Flask application over ASGI."""
+
+    def create_app(self, closed):
+        """Create an application with a plain and an endless route."""
+        app = Flask(__name__)
+
+        @app.route("/hello")
+        def hello():
+            return "hello"
+
+        @app.route("/endless")
+        def endless():
+            def stream():
+                try:
+                    while True:
+                        yield "data: x\n\n"
+                finally:
+                    closed.set()
+
+            return Response(stream(), mimetype="text/event-stream")
+
+        @app.route("/broken")
+        def broken():
+            def stream():
+                yield "data: x\n\n"
+                raise RuntimeError("broken")
+
+            return Response(stream(), mimetype="text/event-stream")
+
+        return app
+
+    def request(self, adapter, path, disconnect_after=None, messages=None):
+        """Send a request and collect the response messages."""
+        messages = [] if messages is None else messages
+        requested = False
+        disconnected = None
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b""}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            if disconnect_after and len(messages) > disconnect_after:
+                disconnected.set()
+
+        async def run():
+            nonlocal disconnected
+            disconnected = asyncio.Event()
+            scope = {
+                "type": "http",
+                "method": "GET",
+                "path": path,
+                "query_string": b"",
+                "headers": [],
+            }
+            await adapter(scope, receive, send)
+
+        asyncio.run(run())
+        return messages
+
+    def test_plain_response(self):
+        """Test dispatching a plain request."""
+        adapter = ASGIAdapter(self.create_app(threading.Event()))
+        messages = self.request(adapter, "/hello")
+
+        assert messages[0]["status"] == 200
+        body = b"".join(m.get("body", b"") for m in messages[1:])
+        assert body == b"hello"
+        assert not messages[-1].get("more_body", False)
+
+    def test_disconnect(self):
+        """Test closing the response when the client disconnects."""
+        closed = threading.Event()
+        adapter = ASGIAdapter(self.create_app(closed), queue_size=2)
+        messages = self.request(adapter, "/endless", disconnect_after=4)
+
+        assert messages[0]["status"] == 200
+        assert closed.wait(timeout=5)
+
+    def test_failure(self):
+        """Test aborting a response that fails while streaming."""
+        adapter = ASGIAdapter(self.create_app(threading.Event()))
+        messages = []
+        with pytest.raises(RuntimeError):
+            self.request(adapter, "/broken", messages=messages)
+
+        assert messages[0]["status"] == 200
+        body = b"".join(m.get("body", b"") for m in messages[1:])
+        assert body == b"data: x\n\n" + STREAM_ERROR
+        assert messages[-1]["more_body"]
@@ -0,0 +1,54 @@
+"""
+Test benchmarks of the serving performance.
+"""
+from basaran.bench import AppClient, Benchmark, load_app, percentile
+from basaran.bench.micro import BENCHMARKS, run
+
+
+class TestBenchmark:
+    """Test load generation for measuring the serving performance."""
+
+    def test_percentile(self):
+        """Test percentiles with linear interpolation."""
+        values = [4, 1, 3, 2]
+        assert percentile(values, 0) == 1
+        assert percentile(values, 50) == 2.5
+        assert percentile(values, 100) == 4
+        assert percentile([7], 90) == 7
+
+    def test_benchmark(self):
+        """Test measuring streaming and non-streaming requests in-process."""
+        client = AppClient(load_app("./tests/data/tiny-random-bloom"))
+        for stream in (True, False):
+            report = Benchmark(
+                client,
+                requests=4,
+                concurrency=2,
+                prompt_lengths=[4, 8],
+                max_tokens=4,
+                n=2,
+                logprobs=1,
+                stream=stream,
+            ).run()
+
+            assert report["completed"] == 4
+            assert not report["errors"]
+            assert report["completion_tokens"] == 32
+            assert report["tokens_per_second"] > 0
+            assert report["latency"]["p50"] > 0
+            if stream:
+                assert report["time_to_first_token"]["p90"] > 0
+            else:
+                assert report["time_to_first_token"] is None
+
+
+class TestMicroBenchmark:
+    """Test micro-benchmarks of the per-token functions."""
+
+    def test_run(self):
+        """Test running every micro-benchmark with few iterations."""
+        results = run("./tests/data/tiny-random-bloom", number=4, repeat=2)
+        assert set(results) == set(BENCHMARKS)
+        for result in results.values():
+            assert result["min"] > 0
+            assert result["calls_per_second"] > 0
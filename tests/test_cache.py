@@ -0,0 +1,150 @@
+"""
+Test caches for reusing computation across requests.
+"""
+import torch
+from transformers import AutoTokenizer
+
+from basaran.cache import (
+    EncoderCache,
+    PrefixCache,
+    TokenCache,
+    expand_cache,
+    probe_layout,
+)
+from basaran.model import load_model
+
+
+class TestExpandCache:
+    """Test sharing a cache of a single sequence with a batch."""
+
+    def test_expand_cache(self):
+        """Test expanding standard and head-folded caches."""
+        standard = torch.rand(1, 4, 7, 8)
+        folded = torch.rand(4, 8, 7)
+        ((key, value),) = expand_cache(((standard, folded),), 3)
+
+        assert key.shape == (3, 4, 7, 8)
+        assert value.shape == (12, 8, 7)
+        assert key.data_ptr() == standard.data_ptr()
+        assert torch.equal(value[4:8], folded)
+
+
+class TestPrefixCache:
+    """Test reusing past key values of shared prompt prefixes."""
+
+    def complete(self, model, prompt):
+        """Complete a prompt using deterministic decoding."""
+        text = [""] * 2
+        for choice in model(prompt=prompt, max_tokens=8, temperature=0, n=2):
+            text[choice["index"]] += choice["text"]
+        return text
+
+    def test_prefix_cache(self):
+        """Test that cached prefixes do not change the completions."""
+        model = load_model("./tests/data/tiny-random-llama")
+        prompt = "hello world ABC " * 8
+        expected = self.complete(model, prompt)
+
+        layout = probe_layout(model.model, model.device)
+        assert layout is not None
+        model.prefix_cache = PrefixCache(layout, 1 << 20, block_size=4)
+
+        # The first request fills the cache and the second one reuses it.
+        assert self.complete(model, prompt) == expected
+        assert len(model.prefix_cache.entries) == 1
+        length, _ = model.prefix_cache.get(model.tokenize(prompt))
+        assert length > 0
+        assert self.complete(model, prompt) == expected
+
+    def test_eviction(self):
+        """Test evicting least recently used prompts."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        layout = probe_layout(model.model, model.device)
+        model.prefix_cache = PrefixCache(layout, 1 << 20, block_size=2)
+        self.complete(model, "once upon a time")
+        model.prefix_cache.max_size = model.prefix_cache.size
+        self.complete(model, "hello world ABC")
+
+        assert len(model.prefix_cache.entries) == 1
+        assert model.prefix_cache.size <= model.prefix_cache.max_size
+
+
+class TestEncoderCache:
+    """Test reusing encoder outputs of repeated inputs."""
+
+    def complete(self, model, prompt):
+        """Complete prompts using deterministic decoding."""
+        text = [""] * 2 * (len(prompt) if isinstance(prompt, list) else 1)
+        for choice in model(prompt=prompt, max_tokens=8, temperature=0, n=2):
+            text[choice["index"]] += choice["text"]
+        return text
+
+    def test_encoder_cache(self):
+        """Test that cached encoder outputs do not change the completions."""
+        model = load_model("./tests/data/tiny-random-t5")
+        prompts = ["hello world ABC", "once upon a time"]
+        expected = [self.complete(model, p) for p in prompts]
+        expected_batch = self.complete(model, prompts)
+        model.encoder_cache = EncoderCache(1 << 20)
+
+        # Repeated sequences of the same input are encoded only once.
+        assert self.complete(model, prompts[0]) == expected[0]
+        assert len(model.encoder_cache.entries) == 1
+        assert self.complete(model, prompts[0]) == expected[0]
+        assert self.complete(model, prompts[1]) == expected[1]
+        assert len(model.encoder_cache.entries) == 2
+        assert self.complete(model, prompts) == expected_batch
+
+    def test_eviction(self):
+        """Test evicting least recently used inputs."""
+        cache = EncoderCache(768)
+        cache.put((1, 2), torch.zeros(2, 64))
+        cache.put((3,), torch.zeros(1, 64))
+        cache.put((4,), torch.zeros(1, 64))
+        assert cache.get((1, 2)) is None
+        assert cache.get((3,)) is not None
+        assert cache.size <= cache.max_size
+        cache.put((5,), torch.zeros(8, 64))
+        assert cache.get((5,)) is None
+
+
+class TestTokenCache:
+    """Test reusing token IDs of repeated texts and headers."""
+
+    def test_segments(self):
+        """Test that segmented encoding matches the tokenizer."""
+        path = "./tests/data/tiny-random-bloom"
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        cache = TokenCache(tokenizer, 1 << 16, segment_size=32)
+        header = "You are a helpful assistant.\n  Answer briefly.\n" * 4
+        for question in ("What is 1 + 1?", "Where is the sun?"):
+            text = header + question
+            assert len(cache._split(text)) > 1
+            assert cache.encode(text) == tokenizer.encode(text)
+            assert cache.encode(text) == tokenizer.encode(text)
+
+        # Segments of the shared header are only stored once.
+        assert len(cache.entries) < 2 * len(cache._split(text))
+
+    def test_eviction(self):
+        """Test evicting least recently used texts."""
+        tokenizer = AutoTokenizer.from_pretrained("./tests/data/tiny-random-t5")
+        cache = TokenCache(tokenizer, 16)
+        assert cache.segment_size == 0
+
+        cache.encode("once upon a time")
+        cache.encode("hello world ABC")
+        cache.encode("the quick brown fox jumps over the lazy dog")
+        assert cache.size <= cache.max_size
+        assert ("once upon a time", True) not in cache.entries
+
+    def test_disabled(self):
+        """Test encoding in batched segments without caching."""
+        path = "./tests/data/tiny-random-bloom"
+        tokenizer = AutoTokenizer.from_pretrained(path)
+        cache = TokenCache(tokenizer, 0, segment_size=32)
+        text = "You are a helpful assistant.\n  Answer briefly.\n" * 4
+        assert len(cache._split(text)) > 1
+        assert cache.encode(text) == tokenizer.encode(text)
+        assert cache.encode("") == tokenizer.encode("")
+        assert not cache.entries
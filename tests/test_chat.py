@@ -0,0 +1,136 @@
+"""
+Test prompt rendering for chat completions.
+"""
+import json
+
+from transformers import AutoTokenizer
+
+from basaran.bench import load_app
+from basaran.chat import ChatTemplate
+
+BLOOM = "./tests/data/tiny-random-bloom"
+LLAMA = "./tests/data/tiny-random-llama"
+T5 = "./tests/data/tiny-random-t5"
+
+# Template whose turns do not end in line breaks.
+INLINE_TEMPLATE = (
+    "{% for message in messages %}<{{ message.role }}>: "
+    "{{ message.content }} {% endfor %}<assistant>: "
+)
+
+
+class TestChatTemplate:
+    """Test rendering chat history into the tokens of a prompt."""
+
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Hello!"},
+        {"role": "assistant", "content": "Hi, how can I help?"},
+        {"role": "user", "content": "Tell me a story."},
+    ]
+
+    def test_render(self):
+        """Test rendering with the default template."""
+        tokenizer = AutoTokenizer.from_pretrained(BLOOM)
+        template = ChatTemplate.load("", tokenizer)
+        prompt = template.render(self.messages)
+
+        assert prompt.startswith("You are a helpful assistant.\n")
+        assert "<user>: Hello!\n" in prompt
+        assert prompt.endswith("<assistant>: ")
+        assert "".join(template.segments(self.messages)) == prompt
+
+    def test_incremental(self):
+        """Test that tokens of earlier turns are kept as the chat grows."""
+        tokenizer = AutoTokenizer.from_pretrained(BLOOM)
+        template = ChatTemplate.load("", tokenizer)
+        assert template.incremental
+
+        # Only the last segment depends on the turns that follow.
+        head = "".join(template.segments(self.messages[:2])[:-1])
+        previous = tokenizer.encode(head)
+        tokens = template.tokenize(self.messages)
+        assert head
+        assert tokens[: len(previous)] == previous
+        assert len(tokens) > len(previous)
+
+    def test_encode(self):
+        """Test that tokens equal those of encoding the whole prompt."""
+        for path in (BLOOM, LLAMA, T5):
+            tokenizer = AutoTokenizer.from_pretrained(path)
+            templates = [
+                ChatTemplate.load("", tokenizer),
+                ChatTemplate(INLINE_TEMPLATE, tokenizer),
+            ]
+            for template in templates:
+                for i in range(1, len(self.messages) + 1):
+                    messages = self.messages[:i]
+                    prompt = template.render(messages)
+                    tokens = template.tokenize(messages)
+                    assert tokens == tokenizer.encode(prompt)
+
+    def test_inline(self):
+        """Test not splitting prompts without line breaks between turns."""
+        tokenizer = AutoTokenizer.from_pretrained(BLOOM)
+        template = ChatTemplate(INLINE_TEMPLATE, tokenizer)
+        prompt = template.render(self.messages)
+        assert template.segments(self.messages) == [prompt]
+
+    def test_fallback(self):
+        """Test tokenizing whole prompts if segments cannot be joined."""
+        tokenizer = AutoTokenizer.from_pretrained(T5)
+        template = ChatTemplate.load("", tokenizer)
+        assert not template.incremental
+
+        prompt = template.render(self.messages)
+        assert template.tokenize(self.messages) == tokenizer.encode(prompt)
+
+
+class TestChatEndpoint:
+    """Test serving chat completions over the API."""
+
+    messages = [{"role": "user", "content": "Hello!"}]
+
+    def test_json(self):
+        """Test creating a chat completion in plain JSON."""
+        client = load_app(BLOOM).test_client()
+        response = client.post(
+            "/v1/chat/completions",
+            json={"messages": self.messages, "max_tokens": 4, "n": 2},
+        )
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data["object"] == "chat.completion"
+        assert len(data["choices"]) == 2
+        for choice in data["choices"]:
+            assert choice["message"]["role"] == "assistant"
+            assert choice["finish_reason"] in ("length", "stop")
+
+    def test_stream(self):
+        """Test creating a chat completion in an event stream."""
+        client = load_app(BLOOM).test_client()
+        response = client.post(
+            "/v1/chat/completions",
+            json={
+                "messages": self.messages,
+                "max_tokens": 4,
+                "stream": True,
+                "logit_bias": {"1": 1},
+            },
+        )
+        assert response.status_code == 200
+        events = response.get_data(as_text=True).split("\n\n")
+        assert events[-2] == "data: [DONE]"
+        chunk = json.loads(events[0][len("data: ") :])
+        assert chunk["object"] == "chat.completion.chunk"
+        assert chunk["choices"][0]["delta"]["role"] == "assistant"
+
+    def test_invalid(self):
+        """Test rejecting invalid options after the model is acquired."""
+        client = load_app(BLOOM).test_client()
+        for token in ("-1", "1024", "x"):
+            response = client.post(
+                "/v1/chat/completions",
+                json={"messages": self.messages, "logit_bias": {token: 1}},
+            )
+            assert response.status_code == 400
@@ -0,0 +1,162 @@
+"""
+Test generation engine with continuous batching.
+"""
+import threading
+
+from basaran.engine import GenerationEngine
+from basaran.model import load_model
+
+
+def count_rows(model):
+    """Record the number of sequences in each forward pass of a model."""
+    rows = []
+    forward = model.model.forward
+
+    def counted(*args, **kwargs):
+        outputs = forward(*args, **kwargs)
+        rows.append(outputs.logits.shape[0])
+        return outputs
+
+    model.model.forward = counted
+    return rows
+
+
+def complete(model, **kwargs):
+    """Collect the text of each choice of a completion."""
+    text = [""] * len(kwargs["prompt"])
+    for choice in model(**kwargs):
+        text[choice["index"]] += choice["text"]
+    return text
+
+
+class TestEngine:
+    """Test generation engine with continuous batching."""
+
+    def assert_concurrent(self, model):
+        """Test completions of concurrent requests sharing the engine."""
+        model.engine = GenerationEngine(model, max_batch_size=4)
+        prompts = ["once upon a time", "hello", "", "hello world ABC"]
+        results = [None] * len(prompts)
+
+        def complete(i):
+            n = 2
+            text = [""] * n
+            finish_reasons = [None] * n
+            for choice in model(
+                prompt=prompts[i],
+                min_tokens=i,
+                max_tokens=8 + i,
+                temperature=0,
+                n=n,
+                logprobs=1,
+            ):
+                index = choice["index"]
+                text[index] += choice["text"]
+                finish_reasons[index] = choice["finish_reason"]
+            results[i] = (text, finish_reasons)
+
+        threads = [
+            threading.Thread(target=complete, args=(i,))
+            for i in range(len(prompts))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for text, finish_reasons in results:
+            assert text[0] == text[1]
+            assert all(finish_reasons)
+
+    def assert_cancelled(self, model):
+        """Test evicting sequences whose consumer has gone away."""
+        model.engine = GenerationEngine(model)
+        stream = model(prompt="once upon a time", max_tokens=1000)
+        next(stream)
+        stream.close()
+
+        # The engine should still serve new requests afterwards.
+        choices = list(model(prompt="hello", max_tokens=4, n=2))
+        assert len(choices) > 0
+
+        # Sequences past their deadline are reported as cancelled.
+        choices = list(
+            model(
+                prompt="hello",
+                max_tokens=100,
+                n=2,
+                is_cancelled=lambda: True,
+            )
+        )
+        assert len(choices) == 2
+        assert all(c["finish_reason"] == "cancelled" for c in choices)
+
+    def assert_closed(self, model):
+        """Test stopping the engine when the model is unloaded."""
+        model.engine = GenerationEngine(model)
+        engine = model.engine
+        assert len(list(model(prompt="hello", max_tokens=4))) > 0
+
+        model.close()
+        engine.thread.join(timeout=10)
+        assert model.engine is None
+        assert not engine.thread.is_alive()
+
+
+class TestDecoderOnlyEngine(TestEngine):
+    """Test continuous batching using decoder-only models."""
+
+    def test_concurrent(self):
+        """Test completions of concurrent requests sharing the engine."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        self.assert_concurrent(model)
+
+    def test_dropped(self):
+        """Test dropping sequences that hit a stop sequence from the batch."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        model.engine = GenerationEngine(model)
+        rows = count_rows(model)
+        kwargs = {
+            "prompt": ["once upon a time", "hello world ABC"],
+            "max_tokens": 16,
+            "temperature": 0,
+        }
+        expected = complete(model, **kwargs)
+        total = sum(rows)
+        stop = expected[0][:3]
+        assert stop not in expected[1]
+
+        # The other sequence is decoded alone once the first one stopped.
+        rows.clear()
+        text = complete(model, stop=stop, **kwargs)
+        assert text == ["", expected[1]]
+        assert rows[-1] == 1
+        assert sum(rows) < total
+
+    def test_cancelled(self):
+        """Test evicting sequences whose consumer has gone away."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        self.assert_cancelled(model)
+
+    def test_closed(self):
+        """Test stopping the engine when the model is unloaded."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        self.assert_closed(model)
+
+
+class TestEncoderDecoderEngine(TestEngine):
+    """Test continuous batching using encoder-decoder models."""
+
+    def test_concurrent(self):
+        """Test completions of concurrent requests sharing the engine."""
+        model = load_model("./tests/data/tiny-random-t5")
+        self.assert_concurrent(model)
+
+
+class TestLlamaEngine(TestEngine):
+    """Test continuous batching using LLaMA models."""
+
+    def test_concurrent(self):
+        """Test completions of concurrent requests sharing the engine."""
+        model = load_model("./tests/data/tiny-random-llama")
+        self.assert_concurrent(model)
@@ -0,0 +1,74 @@
+"""
+Test liveness and saturation reports of the generation loops.
+"""
+import time
+
+from basaran import metrics
+from basaran.admission import AdmissionController
+from basaran.health import check_health, memory_info
+
+
+class FakeEngine:
+    """FakeEngine reports a fixed number of pending requests."""
+
+    def __init__(self, pending, waited):
+        self.pending = pending
+        self.waited = waited
+
+    def stats(self):
+        return self.pending, self.waited
+
+
+class FakeModel:
+    """FakeModel holds an optional batching engine."""
+
+    def __init__(self, engine=None):
+        self.engine = engine
+
+
+class TestHealth:
+    """Test reporting whether the generation loops make progress."""
+
+    def test_idle(self):
+        """Test reporting an idle server as healthy."""
+        active = metrics.ACTIVE_SEQUENCES.value
+        metrics.ACTIVE_SEQUENCES.set(0)
+        try:
+            health = check_health([FakeModel()], timeout=1)
+        finally:
+            metrics.ACTIVE_SEQUENCES.set(active)
+        assert health["status"] == "ok"
+        assert not health["saturated"]
+        assert health["seconds_since_progress"] == 0
+
+    def test_stalled(self):
+        """Test detecting sequences and requests that make no progress."""
+        active = metrics.ACTIVE_SEQUENCES.value
+        progress = metrics.LAST_PROGRESS.value
+        try:
+            metrics.ACTIVE_SEQUENCES.set(2)
+            metrics.LAST_PROGRESS.set(time.time() - 10)
+            assert check_health([], timeout=5)["status"] == "stalled"
+            assert check_health([], timeout=30)["status"] == "ok"
+
+            metrics.ACTIVE_SEQUENCES.set(0)
+            models = [FakeModel(FakeEngine(3, 10))]
+            health = check_health(models, timeout=5)
+            assert health["status"] == "stalled"
+            assert health["pending_requests"] == 3
+        finally:
+            metrics.ACTIVE_SEQUENCES.set(active)
+            metrics.LAST_PROGRESS.set(progress)
+
+    def test_saturated(self):
+        """Test reporting a full admission queue as saturated."""
+        admission = AdmissionController(100, max_queue=0)
+        health = check_health([], admission)
+        assert health["saturated"]
+        assert health["queued_requests"] == 0
+
+    def test_memory(self):
+        """Test reporting the memory headroom."""
+        memory = memory_info()
+        if memory is not None:
+            assert 0 <= memory["free_bytes"] <= memory["total_bytes"]
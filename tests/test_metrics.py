@@ -0,0 +1,43 @@
+"""
+Test metrics of request and generation phases.
+"""
+from basaran import metrics
+from basaran.model import load_model
+
+
+class TestMetrics:
+    """Test metrics of request and generation phases."""
+
+    def test_render(self):
+        """Test rendering metrics in the text exposition format."""
+        text = metrics.render()
+        assert "# TYPE basaran_generated_tokens_total counter" in text
+        assert "# TYPE basaran_active_sequences gauge" in text
+        assert 'basaran_batch_size_bucket{le="+Inf"}' in text
+
+    def test_histogram(self):
+        """Test cumulative bucket counts of histograms."""
+        histogram = metrics.BATCH_SIZE
+        before = dict((s[1], s[2]) for s in histogram.samples())
+        histogram.observe(3)
+        after = dict((s[1], s[2]) for s in histogram.samples())
+
+        assert after['{le="2"}'] == before['{le="2"}']
+        assert after['{le="4"}'] == before['{le="4"}'] + 1
+        assert after['{le="+Inf"}'] == before['{le="+Inf"}'] + 1
+
+    def test_generation(self):
+        """Test that generation updates counters and releases gauges."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        generated = metrics.GENERATED_TOKENS.value
+        prefills = metrics.PREFILL_TIME.samples()[-1][2]
+        active = metrics.ACTIVE_SEQUENCES.value
+        cache_bytes = metrics.KV_CACHE_BYTES.value
+
+        for _ in model(prompt="once upon a time", max_tokens=4, n=2):
+            assert metrics.ACTIVE_SEQUENCES.value == active + 2
+
+        assert generated < metrics.GENERATED_TOKENS.value <= generated + 8
+        assert metrics.PREFILL_TIME.samples()[-1][2] == prefills + 1
+        assert metrics.ACTIVE_SEQUENCES.value == active
+        assert metrics.KV_CACHE_BYTES.value == cache_bytes
@@ -4,6 +4,28 @@ Test text generation model with stream decoding.
 from basaran.model import load_model
 
 
+def count_rows(model):
+    """Record the number of sequences in each forward pass of a model."""
+    rows = []
+    forward = model.model.forward
+
+    def counted(*args, **kwargs):
+        outputs = forward(*args, **kwargs)
+        rows.append(outputs.logits.shape[0])
+        return outputs
+
+    model.model.forward = counted
+    return rows
+
+
+def complete(model, **kwargs):
+    """Collect the text of each choice of a completion."""
+    text = [""] * len(kwargs["prompt"])
+    for choice in model(**kwargs):
+        text[choice["index"]] += choice["text"]
+    return text
+
+
 class TestModel:
     """Test text generation model with stream decoding."""
 
@@ -54,10 +76,106 @@ class TestModel:
                 assert text[i] == text[i - 1]
             assert counts[i] >= 10 and counts[i] <= 16
 
+    def assert_batched(self, model):
+        """Test completion of multiple prompts in a single batch."""
+        prompts = ["once upon a time", "", model.tokenize("hello").tolist()]
+        n = 2
+        text = [""] * len(prompts) * n
+        for choice in model(
+            prompt=prompts,
+            max_tokens=8,
+            temperature=0,
+            n=n,
+            echo=True,
+        ):
+            text[choice["index"]] += choice["text"]
+
+        assert text[0].startswith(prompts[0])
+        for i in range(0, len(text), n):
+            assert text[i] == text[i + 1]
+
+        # Padding must not change the completion of a prompt.
+        expected = ""
+        for choice in model(prompt=prompts[0], max_tokens=8, temperature=0):
+            expected += choice["text"]
+        assert text[0] == prompts[0] + expected
+
 
 class TestDecoderOnlyModel(TestModel):
     """Test text generation using decoder-only models."""
 
+    def test_cancelled(self):
+        """Test stopping generation once a request is cancelled."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        choices = list(
+            model(
+                prompt="once upon a time",
+                max_tokens=100,
+                n=2,
+                is_cancelled=lambda: True,
+            )
+        )
+
+        assert len(choices) == 2
+        assert all(c["finish_reason"] == "cancelled" for c in choices)
+
+    def test_stop(self):
+        """Test stopping generation at the first stop sequence."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        kwargs = {"prompt": "once upon a time", "temperature": 0}
+        expected = "".join(c["text"] for c in model(max_tokens=16, **kwargs))
+        stop = expected[len(expected) // 2 :][:3]
+
+        choices = list(model(max_tokens=16, n=2, stop=["\0", stop], **kwargs))
+        text = "".join(c["text"] for c in choices if c["index"] == 0)
+        assert text == expected[: expected.index(stop)]
+        assert choices[-1]["finish_reason"] == "stop"
+        assert len(choices) < 32
+
+    def test_dropped(self):
+        """Test dropping sequences that hit a stop sequence from the batch."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        rows = count_rows(model)
+        kwargs = {
+            "prompt": ["once upon a time", "hello world ABC"],
+            "max_tokens": 16,
+            "temperature": 0,
+        }
+        expected = complete(model, **kwargs)
+        total = sum(rows)
+        stop = expected[0][:3]
+        assert stop not in expected[1]
+
+        # The other sequence is decoded alone once the first one stopped.
+        rows.clear()
+        text = complete(model, stop=stop, **kwargs)
+        assert text == ["", expected[1]]
+        assert rows[-1] == 1
+        assert sum(rows) < total
+
+    def test_penalties(self):
+        """Test biasing and penalizing tokens of a completion."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        kwargs = {"prompt": "hello", "max_tokens": 8, "temperature": 0}
+        token = model.tokenize(" world")[0].item()
+        word = model.token_strings[token]
+
+        # A large bias forces the same token at every step.
+        text = "".join(
+            c["text"] for c in model(logit_bias={token: 100}, **kwargs)
+        )
+        assert text == word * 8
+
+        # Penalties prevent the biased token from being repeated.
+        text = "".join(
+            c["text"]
+            for c in model(
+                logit_bias={token: 5}, frequency_penalty=2.0, **kwargs
+            )
+        )
+        assert text.startswith(word)
+        assert text.count(word) < 8
+
     def test_stochastic(self):
         """Test completion using stochastic decoding."""
         model = load_model("./tests/data/tiny-random-bloom")
@@ -68,6 +186,11 @@ class TestDecoderOnlyModel(TestModel):
         model = load_model("./tests/data/tiny-random-bloom")
         self.assert_deterministic(model)
 
+    def test_batched(self):
+        """Test completion of multiple prompts in a single batch."""
+        model = load_model("./tests/data/tiny-random-bloom")
+        self.assert_batched(model)
+
 
 class TestEncoderDecoderModel(TestModel):
     """Test text generation using encoder-decoder models."""
@@ -82,6 +205,11 @@ class TestEncoderDecoderModel(TestModel):
         model = load_model("./tests/data/tiny-random-t5")
         self.assert_deterministic(model)
 
+    def test_batched(self):
+        """Test completion of multiple prompts in a single batch."""
+        model = load_model("./tests/data/tiny-random-t5")
+        self.assert_batched(model)
+
 
 class TestLlamaModel(TestModel):
     """Test text generation using LLaMA models."""
@@ -95,3 +223,8 @@ class TestLlamaModel(TestModel):
         """Test completion using deterministic decoding."""
         model = load_model("./tests/data/tiny-random-llama")
         self.assert_deterministic(model)
+
+    def test_batched(self):
+        """Test completion of multiple prompts in a single batch."""
+        model = load_model("./tests/data/tiny-random-llama")
+        self.assert_batched(model)
@@ -0,0 +1,35 @@
+"""
+Test opt-in profiling of completion requests.
+"""
+import os
+
+from basaran.profiler import RequestProfiler
+
+
+class TestRequestProfiler:
+    """Test sampling requests and dumping their traces."""
+
+    def test_cprofile(self, tmp_path):
+        """Test profiling an iterator with cProfile."""
+        profiler = RequestProfiler("cprofile", str(tmp_path))
+        items = list(profiler.wrap("cmpl-0", iter(range(4))))
+
+        assert items == [0, 1, 2, 3]
+        assert os.path.exists(tmp_path / "cmpl-0.prof")
+
+    def test_closed(self, tmp_path):
+        """Test dumping traces of requests that are closed early."""
+        profiler = RequestProfiler("cprofile", str(tmp_path))
+        iterator = profiler.wrap("cmpl-1", iter(range(4)))
+        assert next(iterator) == 0
+        iterator.close()
+
+        assert os.path.exists(tmp_path / "cmpl-1.prof")
+
+    def test_sampling(self, tmp_path):
+        """Test skipping requests that are not sampled."""
+        profiler = RequestProfiler("cprofile", str(tmp_path), rate=0)
+        iterator = iter(range(4))
+
+        assert profiler.wrap("cmpl-2", iterator) is iterator
+        assert not os.listdir(tmp_path)
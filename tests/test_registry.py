@@ -0,0 +1,78 @@
+"""
+Test the registry of models served under different names.
+"""
+import threading
+
+import pytest
+
+from basaran.registry import ModelRegistry
+
+
+class FakeModel:
+    """FakeModel records whether it has been closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestModelRegistry:
+    """Test loading models on first use and unloading idle ones."""
+
+    def test_acquire(self):
+        """Test loading a model once for concurrent requests."""
+        loads = []
+
+        def loader(path):
+            loads.append(path)
+            return FakeModel(path)
+
+        registry = ModelRegistry(loader)
+        registry.register("small", "./small")
+        assert registry.names() == ["small"]
+        assert not registry.loaded()
+
+        models = []
+
+        def worker():
+            model, release = registry.acquire("small")
+            models.append(model)
+            release()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert loads == ["./small"]
+        assert all(m is models[0] for m in models)
+
+        with pytest.raises(KeyError):
+            registry.acquire("missing")
+
+    def test_evict(self):
+        """Test unloading models that are idle and not pinned."""
+        registry = ModelRegistry(FakeModel, idle_timeout=60)
+        default = FakeModel("./default")
+        registry.register("default", "./default", model=default, pinned=True)
+        registry.register("small", "./small")
+
+        model, release = registry.acquire("small")
+        now = registry.entries["small"].last_used + 120
+        assert registry.evict(now) == 0
+
+        release()
+        release()
+        assert registry.entries["small"].users == 0
+        assert registry.evict(now + 120) == 1
+        assert model.closed
+        assert not default.closed
+        assert registry.loaded() == [default]
+
+        # Evicted models are loaded again on the next use.
+        reloaded, release = registry.acquire("small")
+        assert reloaded is not model
+        release()
@@ -0,0 +1,78 @@
+"""
+Test caching of the results of deterministic completions.
+"""
+import os
+import time
+
+from basaran.results import ResultCache
+
+
+class TestResultCache:
+    """Test caching of the results of deterministic completions."""
+
+    def test_get(self):
+        """Test that values are returned as copies of what was stored."""
+        cache = ResultCache(1 << 20)
+        key = ResultCache.key("model", [[1, 2, 3]], {"temperature": 0})
+        assert cache.get(key) is None
+
+        value = {"choices": [{"text": "hello", "index": 0}], "count": 1}
+        cache.put(key, value)
+        cached = cache.get(key)
+        assert cached == value
+        cached["choices"].clear()
+        assert cache.get(key) == value
+
+    def test_key(self):
+        """Test that keys do not depend on the order of parameters."""
+        a = ResultCache.key("model", [[1]], {"n": 2, "stop": ["\n"]})
+        b = ResultCache.key("model", [[1]], {"stop": ["\n"], "n": 2})
+        assert a == b
+        assert a != ResultCache.key("model", [[2]], {"n": 2, "stop": ["\n"]})
+
+    def test_eviction(self):
+        """Test evicting least recently used and oversized values."""
+        cache = ResultCache(32)
+        cache.put("a", "x" * 10)
+        cache.put("b", "x" * 10)
+        cache.get("a")
+        cache.put("c", "x" * 10)
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.size <= cache.max_size
+
+        cache.put("d", "x" * 64)
+        assert cache.get("d") is None
+
+    def test_ttl(self):
+        """Test expiring values after their time to live."""
+        cache = ResultCache(1 << 20, ttl=1)
+        cache.put("a", 1)
+        assert cache.get("a") == 1
+        cache.entries["a"] = (cache.entries["a"][0], time.time() - 1)
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_directory(self, tmp_path):
+        """Test sharing values through the disk."""
+        directory = str(tmp_path / "results")
+        ResultCache(1 << 20, directory=directory).put("a", [1, 2])
+        assert len(os.listdir(directory)) == 1
+
+        # A new cache reads the value from disk and keeps it in memory.
+        cache = ResultCache(1 << 20, directory=directory)
+        assert cache.get("a") == [1, 2]
+        assert "a" in cache.entries
+        assert cache.get("b") is None
+
+    def test_prune(self, tmp_path):
+        """Test keeping the files on disk within the maximum size."""
+        directory = str(tmp_path)
+        cache = ResultCache(256, directory=directory)
+        for i in range(16):
+            cache.put(str(i), "x" * 32)
+        size = sum(
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        )
+        assert 0 < size <= cache.max_size
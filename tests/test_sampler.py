@@ -0,0 +1,156 @@
+"""
+Test batched sampling with per-sequence parameters.
+"""
+import pytest
+import torch
+from transformers import GenerationConfig
+
+from basaran.sampler import Sampler
+
+
+def make_sampler(temperature, top_p, top_k, min_tokens, eos_token_id=0):
+    """Create a sampler from lists of per-sequence parameters."""
+    temperature = torch.tensor(temperature, dtype=torch.float)
+    top_p = torch.tensor(top_p, dtype=torch.float)
+    ones = torch.ones_like(temperature)
+    return Sampler(
+        temperature=torch.where(temperature > 0, temperature, ones),
+        top_p=torch.where(top_p > 0, top_p, ones),
+        top_k=torch.tensor(top_k),
+        min_tokens=torch.tensor(min_tokens),
+        greedy=(temperature <= 0) | (top_p <= 0),
+        eos_token_id=torch.tensor([eos_token_id]),
+    )
+
+
+class TestSampler:
+    """Test batched sampling with per-sequence parameters."""
+
+    def test_from_config(self):
+        """Test disabled parameters read from a generation config."""
+        config = GenerationConfig(
+            temperature=0, top_p=0.9, top_k=0, eos_token_id=[2]
+        )
+        sampler = Sampler.from_config(config, torch.zeros((3, 1)).long(), 8)
+        assert sampler.all_greedy
+        assert not sampler.scaled
+        assert sampler.nucleus
+        assert sampler.max_top_k == 0
+        assert sampler.temperature.tolist() == [1.0] * 3
+
+    def test_rows(self):
+        """Test applying different parameters to each row."""
+        logits = torch.tensor([[1.0, 2.0, 3.0, 4.0]]).repeat(4, 1)
+        sampler = make_sampler(
+            temperature=[1.0, 0.5, 1.0, 1.0],
+            top_p=[1.0, 1.0, 0.5, 1.0],
+            top_k=[0, 0, 0, 2],
+            min_tokens=[0, 0, 0, 0],
+        )
+        scores = sampler.process(logits)
+
+        # Rows without any parameter are left intact.
+        assert torch.equal(scores[0], logits[0])
+        assert torch.allclose(scores[1], logits[1] / 0.5)
+        assert torch.isinf(scores[2, :3]).all()
+        assert scores[2, 3] == 4.0
+        assert torch.isinf(scores[3, :2]).all()
+        assert scores[3, 2:].tolist() == [3.0, 4.0]
+
+    def test_min_tokens(self):
+        """Test preventing eos tokens per sequence."""
+        logits = torch.zeros((2, 4))
+        logits[:, 0] = 10
+        sampler = make_sampler(
+            temperature=[0, 0],
+            top_p=[1.0, 1.0],
+            top_k=[0, 0],
+            min_tokens=[2, 0],
+        )
+
+        # Only the first row is prevented from selecting eos tokens.
+        tokens = sampler.select(sampler.process(logits).softmax(dim=-1))
+        assert tokens[0] != 0
+        assert tokens[1] == 0
+        sampler.update(tokens)
+        assert sampler.process(logits, offset=1)[0, 0] == 10
+        assert torch.isinf(sampler.process(logits)[0, 0])
+        sampler.update(tokens)
+        assert sampler.process(logits)[0, 0] == 10
+
+    def test_mixed(self):
+        """Test mixing greedy and stochastic sequences."""
+        probs = torch.tensor([[0.1, 0.9], [0.9, 0.1]])
+        sampler = make_sampler(
+            temperature=[0, 1.0],
+            top_p=[1.0, 1.0],
+            top_k=[0, 0],
+            min_tokens=[0, 0],
+        )
+        assert sampler.any_greedy
+        assert not sampler.all_greedy
+        for _ in range(10):
+            assert sampler.select(probs)[0] == 1
+
+    def test_cat_take(self):
+        """Test merging and selecting the rows of samplers."""
+        config = GenerationConfig(temperature=0.5, top_p=1.0, top_k=0)
+        a = Sampler.from_config(config, torch.zeros((2, 1)).long(), 8)
+        config = GenerationConfig(temperature=0, top_k=5, min_new_tokens=3)
+        b = Sampler.from_config(config, torch.zeros((1, 1)).long(), 8)
+        merged = Sampler.cat([a, b])
+        assert merged.greedy.tolist() == [False, False, True]
+        assert merged.max_top_k == 5
+
+        # Only the remaining rows decide which operations are applied.
+        taken = merged.take(torch.tensor([0, 1]))
+        assert taken.max_top_k == 0
+        assert not taken.any_greedy
+        assert taken.scaled
+
+    def test_penalties(self):
+        """Test penalizing tokens by their counts in each sequence."""
+        config = GenerationConfig(temperature=0, top_k=0)
+        config.frequency_penalty = 1.0
+        config.presence_penalty = 0.5
+        input_ids = torch.tensor([[1, 1], [2, 2]])
+        sampler = Sampler.from_config(config, input_ids, 4)
+        logits = torch.zeros((2, 4))
+
+        # Prompt tokens are not counted, only generated ones.
+        assert torch.equal(sampler.process(logits), logits)
+        sampler.update(torch.tensor([3, 1]))
+        sampler.update(torch.tensor([3, 2]))
+        scores = sampler.process(logits)
+        assert scores[0].tolist() == [0.0, 0.0, 0.0, -2.5]
+        assert scores[1].tolist() == [0.0, -1.5, -1.5, 0.0]
+
+    def test_repetition_penalty(self):
+        """Test penalizing tokens seen in the prompts, excluding padding."""
+        config = GenerationConfig(repetition_penalty=2.0, top_k=0)
+        input_ids = torch.tensor([[0, 1], [2, 3]])
+        attention_mask = torch.tensor([[0, 1], [1, 1]])
+        sampler = Sampler.from_config(config, input_ids, 4, attention_mask)
+        logits = torch.tensor([[2.0, 2.0, -2.0, 2.0]]).repeat(2, 1)
+        scores = sampler.process(logits)
+        assert scores[0].tolist() == [2.0, 1.0, -2.0, 2.0]
+        assert scores[1].tolist() == [2.0, 2.0, -4.0, 1.0]
+
+    def test_logit_bias(self):
+        """Test adding sparse biases to the logits of each sequence."""
+        config = GenerationConfig(top_k=0)
+        config.logit_bias = {1: 5.0, 3: -5.0}
+        a = Sampler.from_config(config, torch.zeros((2, 1)).long(), 4)
+        config.logit_bias = {0: 1.0}
+        b = Sampler.from_config(config, torch.zeros((1, 1)).long(), 4)
+        merged = Sampler.cat([a, b]).take(torch.tensor([1, 2]))
+        scores = merged.process(torch.zeros((2, 4)))
+        assert scores[0].tolist() == [0.0, 5.0, 0.0, -5.0]
+        assert scores[1].tolist() == [1.0, 0.0, 0.0, 0.0]
+
+    def test_invalid_logit_bias(self):
+        """Test rejecting biases of tokens beyond the logits."""
+        config = GenerationConfig(top_k=0)
+        config.logit_bias = {4: 1.0}
+        with pytest.raises(ValueError):
+            Sampler.from_config(config, torch.zeros((2, 1)).long(), 4)
@@ -0,0 +1,77 @@
+"""
+Test speculative decoding with a draft model.
+"""
+import torch
+from transformers import AutoModelForCausalLM
+
+from basaran.model import load_model
+from basaran.speculative import Speculator
+
+
+class TestSpeculator:
+    """Test proposing tokens with a draft model for verification."""
+
+    def complete(self, model, **kwargs):
+        """Complete a prompt and collect the text of each choice."""
+        text = [""] * kwargs.get("n", 1)
+        finish_reasons = [None] * len(text)
+        for choice in model(prompt="once upon a time", **kwargs):
+            text[choice["index"]] += choice["text"]
+            if choice["finish_reason"] is not None:
+                finish_reasons[choice["index"]] = choice["finish_reason"]
+        return text, finish_reasons
+
+    def draft(self, model):
+        """Create a draft model that disagrees with the model."""
+        torch.manual_seed(0)
+        draft_model = AutoModelForCausalLM.from_config(model.model.config)
+        return draft_model.eval().to(model.device)
+
+    def test_deterministic(self):
+        """Test that greedy decoding is unchanged by any draft model."""
+        for path in ("tiny-random-bloom", "tiny-random-llama"):
+            model = load_model(f"./tests/data/{path}")
+            kwargs = {"max_tokens": 12, "temperature": 0, "n": 2}
+            expected = self.complete(model, **kwargs)
+
+            for draft_model in (model.model, self.draft(model)):
+                model.speculator = Speculator(model, draft_model, 3)
+                assert model.speculator.supports(
+                    {
+                        "output_attentions": False,
+                        "output_hidden_states": False,
+                        "use_cache": True,
+                    }
+                )
+                assert self.complete(model, **kwargs) == expected
+
+    def test_stochastic(self):
+        """Test sampling with rejected proposals."""
+        model = load_model("./tests/data/tiny-random-llama")
+        model.speculator = Speculator(model, self.draft(model), 4)
+        text, finish_reasons = self.complete(
+            model,
+            min_tokens=10,
+            max_tokens=16,
+            temperature=0.95,
+            top_p=0.95,
+            n=3,
+            logprobs=2,
+        )
+
+        for i in range(3):
+            assert len(text[i]) > 0
+            assert finish_reasons[i] == "length"
+
+    def test_unsupported(self):
+        """Test falling back to regular decoding for encoder-decoder models."""
+        model = load_model("./tests/data/tiny-random-t5")
+        kwargs = {"max_tokens": 8, "temperature": 0}
+        expected = self.complete(model, **kwargs)
+
+        # Results are unchanged, even if the model generates no text.
+        model.speculator = Speculator(model, model.model, 4)
+        assert model.speculator.layout is None
+        text, finish_reasons = self.complete(model, **kwargs)
+        assert finish_reasons[0] in ("length", "stop")
+        assert (text, finish_reasons) == expected
@@ -0,0 +1,69 @@
+"""
+Test functions for serializing server-sent events.
+"""
+import json
+
+from basaran.choice import map_choice, reduce_choice
+from basaran.sse import StreamEncoder, serialize
+
+
+class TestStreamEncoder:
+    """Test buffering choices and serializing them into events."""
+
+    template = {
+        "id": "cmpl-0",
+        "object": "text_completion",
+        "created": 0,
+        "model": "test",
+        "choices": [],
+    }
+
+    def choices(self, index):
+        return [
+            map_choice(
+                text,
+                index,
+                token=i,
+                token_logprob=-0.5,
+                top_logprobs={text: -0.5},
+                text_offset=i,
+            )
+            for i, text in enumerate(["hello", ' "world"\n', "你好"])
+        ] + [map_choice("", index, finish_reason="length")]
+
+    def test_encode(self):
+        """Test serializing the same events as merging choices."""
+        encoder = StreamEncoder(self.template, max_interval=60_000)
+        choices = self.choices(0) + self.choices(1)
+        for choice in choices:
+            assert encoder.add(choice) is None
+
+        expected = dict(self.template)
+        expected["choices"] = [
+            reduce_choice(choices[:4]),
+            reduce_choice(choices[4:]),
+        ]
+        assert encoder.flush() == serialize(expected)
+        assert encoder.flush() is None
+
+    def test_threshold(self):
+        """Test flushing the buffer when it exceeds the maximum size."""
+        encoder = StreamEncoder(self.template, max_interval=60_000, max_size=8)
+        assert encoder.add(map_choice("hello", 0)) is None
+        assert encoder.add(map_choice(" world", 0)) is not None
+        assert not encoder.pending
+
+        # An interval of zero flushes the buffer as soon as time passes.
+        encoder = StreamEncoder(self.template, max_interval=0)
+        while encoder.add(map_choice("hello", 0)) is None:
+            pass
+        assert not encoder.pending
+
+    def test_chat(self):
+        """Test including the role only in the first delta of a choice."""
+        encoder = StreamEncoder(self.template, chat=True, max_size=0)
+        events = [encoder.add(c) for c in self.choices(0)]
+        deltas = [json.loads(e[6:])["choices"][0]["delta"] for e in events]
+        assert deltas[0] == {"role": "assistant", "content": "hello"}
+        assert deltas[1] == {"content": ' "world"\n'}
+        assert "logprobs" not in json.loads(events[0][6:])["choices"][0]
@@ -0,0 +1,66 @@
+"""
+Test background loading and timing of the server startup phases.
+"""
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from basaran.startup import Startup
+
+
+class TestStartup:
+    """Test reporting the progress of loading in the background."""
+
+    def test_progress(self):
+        """Test recording phases until loading is finished."""
+        startup = Startup(["import", "model"])
+        proceed = threading.Event()
+
+        def load():
+            with startup.measure("import"):
+                pass
+            with startup.measure("model"):
+                proceed.wait(timeout=10)
+
+        startup.start(load)
+        while startup.phase != "model":
+            startup.done.wait(timeout=0.01)
+        status = startup.status()
+        assert status["status"] == "loading"
+        assert status["phase"] == "model"
+        assert status["progress"] == 0.5
+        assert not startup.is_ready()
+
+        proceed.set()
+        assert startup.wait(timeout=10)
+        status = startup.status()
+        assert status["status"] == "ready"
+        assert status["progress"] == 1
+        assert set(status["phases"]) == {"import", "model"}
+        assert startup.is_ready()
+
+    def test_failed(self):
+        """Test reporting errors raised while loading."""
+        startup = Startup(["model"])
+
+        def load():
+            with startup.measure("model"):
+                raise ValueError("missing weights")
+
+        startup.start(load)
+        with pytest.raises(ValueError):
+            startup.wait(timeout=10)
+        assert startup.status()["status"] == "failed"
+        assert startup.status()["phase"] == "model"
+        assert not startup.is_ready()
+
+    def test_light_imports(self):
+        """Test that modules imported before binding avoid transformers."""
+        code = (
+            "import sys, basaran.chat, basaran.tokenizer; "
+            "assert 'transformers' not in sys.modules; "
+            "assert 'torch' not in sys.modules"
+        )
+        subprocess.run([sys.executable, "-c", code], check=True)
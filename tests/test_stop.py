@@ -0,0 +1,41 @@
+"""
+Test incremental matching of stop sequences in streamed text.
+"""
+from basaran.stop import StopMatcher
+
+
+class TestStopMatcher:
+    """Test finding stop sequences in streamed text."""
+
+    def scan(self, patterns, chunks):
+        scanner = StopMatcher(patterns).scanner()
+        released = []
+        for chunk in chunks:
+            text, stopped = scanner.feed(chunk)
+            released.append(text)
+            if stopped:
+                return released, True
+        released.append(scanner.flush())
+        return released, False
+
+    def test_hold_back(self):
+        """Test holding back only text that may start a stop sequence."""
+        released, stopped = self.scan(["\n\n", "###"], ["a\n", "b#", "#c"])
+        assert released == ["a", "\nb", "##c", ""]
+        assert not stopped
+
+    def test_stop(self):
+        """Test cutting text before a stop sequence split across chunks."""
+        released, stopped = self.scan(["###"], ["hello #", "#", "# world"])
+        assert "".join(released) == "hello "
+        assert stopped
+
+    def test_overlapping(self):
+        """Test matching patterns that are suffixes of each other."""
+        released, stopped = self.scan(["abcd", "bc"], ["xab", "cd"])
+        assert "".join(released) == "xa"
+        assert stopped
+
+        released, stopped = self.scan(["aab"], ["aaa", "ab"])
+        assert "".join(released) == "aa"
+        assert stopped
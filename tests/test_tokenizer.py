@@ -27,6 +27,26 @@ class TestTokenizer:
         assert actual == expected
         assert detokenizer.end == len(expected)
 
+    def test_clean_up_tokenization_spaces(self):
+        """Test cleaning up spaces as in full decoding."""
+        tokenizer = AutoTokenizer.from_pretrained(
+            pretrained_model_name_or_path="./tests/data/tiny-random-bloom",
+            local_files_only=True,
+            clean_up_tokenization_spaces=True,
+        )
+        detokenizer = StreamTokenizer(tokenizer)
+        assert detokenizer.vocab is None
+
+        tokens = tokenizer.encode("Hello , world .")
+        expected = tokenizer.decode(tokens)
+        assert expected == "Hello, world."
+
+        actual = ""
+        for token in tokens:
+            actual += detokenizer.decode(token)
+
+        assert actual == expected
+
     def test_sentence_piece(self):
         """Test with SentencePiece."""
         tokenizer = AutoTokenizer.from_pretrained(
@@ -62,3 +82,28 @@ class TestTokenizer:
 
         assert actual == expected
         assert detokenizer.end == len(expected)
+
+    def test_incomplete_characters(self):
+        """Test holding back bytes of incomplete characters."""
+        for name in ("tiny-random-bloom", "tiny-random-llama"):
+            tokenizer = AutoTokenizer.from_pretrained(
+                pretrained_model_name_or_path=f"./tests/data/{name}",
+                local_files_only=True,
+            )
+            detokenizer = StreamTokenizer(tokenizer)
+
+            # Characters of several bytes that every fixture can encode.
+            expected = "multi-byte 你好世界 and 世界"
+            tokens = tokenizer.encode(expected)
+            assert tokenizer.decode(tokens, skip_special_tokens=True) == (
+                expected
+            )
+
+            actual = ""
+            for token in tokens:
+                text = detokenizer.decode(token)
+                assert chr(0xFFFD) not in text
+                actual += text
+
+            assert actual == expected
+            assert detokenizer.end == len(expected)